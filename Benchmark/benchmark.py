@@ -0,0 +1,283 @@
+"""
+震度計算・センサ取得・system_data保存のホットパスのベンチマーク
+
+ハードウェア(spidev, smbus, gpiozero)は偽物に置き換えるため、実機以外でも実行できる。
+TestData/AA06EA01.csvと合成データを、複数の判定窓・サンプリング周波数で計測し、
+レイテンシのパーセンタイルと1回あたりのメモリ確保量を表示する。
+
+    python Benchmark/benchmark.py                 # 計測してbaselineと比較
+    python Benchmark/benchmark.py --save-baseline # 計測結果をbaselineとして保存
+    python Benchmark/benchmark.py -k scale        # 名前に'scale'を含むものだけ計測
+
+baselineより中央値がthreshold以上遅くなったものがあれば、終了コード1を返す。
+"""
+import argparse
+import asyncio
+import atexit
+import json
+import logging
+import shutil
+import struct
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+TEST_DATA = ROOT / 'TestData' / 'AA06EA01.csv'
+DEF_BASELINE = Path(__file__).resolve().parent / 'baseline.json'
+
+
+class FakeSpiDev:
+    """
+    LIS2DH12の代わりに応答するspidev.SpiDev
+    FIFO_SRC_REGには常に32個、OUT_X_Lには固定の加速度を返す。
+    """
+    FIFO_SRC_REG = 0x2F
+    OUT_X_L = 0x28
+
+    def __init__(self):
+        self.max_speed_hz = 0
+        self.__sample = list(struct.pack('<hhh', 120, -340, 16000))
+
+    def open(self, bus, device):
+        pass
+
+    def xfer2(self, data):
+        reg = data[0] & 0x3F
+        if reg == self.FIFO_SRC_REG:
+            return [0x00, 0x40]
+        if reg == self.OUT_X_L:
+            return [0x00] + self.__sample * ((len(data) - 1) // 6)
+        return [0x00] * len(data)
+
+
+class FakeDigitalInputDevice:
+    def __init__(self, *args, **kwargs):
+        self.is_active = False
+        self.when_activated = None
+
+
+def install_fake_hardware():
+    """
+    ハードウェア依存のモジュールを偽物に置き換える。
+    """
+    sys.modules['spidev'] = types.SimpleNamespace(SpiDev=FakeSpiDev)
+    sys.modules['smbus'] = types.SimpleNamespace(SMBus=lambda bus: None)
+    if 'gpiozero' not in sys.modules:
+        try:
+            import gpiozero  # noqa: F401
+        except ImportError:
+            sys.modules['gpiozero'] = types.SimpleNamespace(
+                DigitalInputDevice=FakeDigitalInputDevice, LED=FakeDigitalInputDevice,
+                Button=FakeDigitalInputDevice)
+
+
+def percentile(sorted_values, p):
+    index = min(len(sorted_values) - 1, int(round(p / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def measure(fn, iterations, warmup=3):
+    """
+    fnを繰り返し実行し、レイテンシ(ms)のパーセンタイルと1回あたりのメモリ確保量を返す。
+    メモリの計測はtracemallocの影響を避けるため、時間計測とは別に行う。
+    """
+    for _ in range(warmup):
+        fn()
+    latencies = []
+    for _ in range(iterations):
+        start = time.perf_counter_ns()
+        fn()
+        latencies.append((time.perf_counter_ns() - start) / 1e6)
+    latencies.sort()
+    alloc_iterations = max(1, min(iterations, 20))
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    tracemalloc.reset_peak()
+    for _ in range(alloc_iterations):
+        fn()
+    _, peak = tracemalloc.get_traced_memory()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    stats = after.compare_to(before, 'filename')
+    blocks = sum(max(stat.count_diff, 0) for stat in stats)
+    return {
+        'p50_ms': percentile(latencies, 50),
+        'p90_ms': percentile(latencies, 90),
+        'p99_ms': percentile(latencies, 99),
+        'max_ms': latencies[-1],
+        'peak_kib': peak / 1024.0,
+        'retained_blocks_per_call': blocks / alloc_iterations,
+    }
+
+
+def load_test_data():
+    """
+    TestDataの加速度(gal)をshape (3, n)で返す。
+    """
+    import numpy as np
+    from sensor_replay import KnetCsvReader
+    reader = KnetCsvReader(str(TEST_DATA))
+    return reader.fs, np.concatenate(list(reader.iter_chunks()), axis=1)
+
+
+def synthetic_data(fs, seconds, seed=0):
+    """
+    ノイズに数Hzの正弦波を重ねた合成データ(gal)をshape (3, n)で返す。
+    """
+    import numpy as np
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(fs * seconds)) / fs
+    wave = 30.0 * np.sin(2 * np.pi * 1.5 * t) + 10.0 * np.sin(2 * np.pi * 6.0 * t)
+    return rng.normal(scale=0.5, size=(3, t.size)) + wave
+
+
+def build_cases():
+    """
+    (名前, 実行関数)のリストを返す。
+    """
+    from lis2dh12 import LIS2DH12
+    from seismometer import Seismometer, StreamingIntensity, calc_scale, mix_filtered_3axis
+    cases = []
+
+    # TestData: 100Hz, 5.12sの判定窓で地震動のピーク付近
+    fs, data = load_test_data()
+    window = data[:, 6000:6000 + int(fs * 5.12)].copy()
+    cases.append(('get_scale/testdata/fs100/w5.12', lambda: calc_scale(window, fs)))
+    cases.append(('mix_filtered_3axis/testdata/fs100/w5.12', lambda: mix_filtered_3axis(window, fs)))
+
+    # 合成データ: サンプリング周波数と判定窓を変える。
+    for syn_fs in (50.0, 100.0, 200.0):
+        for window_sec in (2.56, 5.12, 10.24):
+            syn = synthetic_data(syn_fs, window_sec)
+            name = f'fs{int(syn_fs)}/w{window_sec}'
+            cases.append((f'get_scale/synthetic/{name}',
+                          lambda syn=syn, syn_fs=syn_fs: calc_scale(syn, syn_fs)))
+            cases.append((f'mix_filtered_3axis/synthetic/{name}',
+                          lambda syn=syn, syn_fs=syn_fs: mix_filtered_3axis(syn, syn_fs)))
+
+    # Seismometer経由(リングバッファへの格納 + 計算)
+    loop = asyncio.new_event_loop()
+    seismometer = Seismometer(fs=fs, window_sec=5.12, sensor=types.SimpleNamespace())
+    batch = data[:, 6000:6032] / 100.0
+
+    def seismometer_cycle():
+        seismometer.set_accel_array(batch[0], batch[1], batch[2])
+        loop.run_until_complete(seismometer.get_scale())
+    seismometer.set_accel_array(*(window / 100.0))
+    cases.append(('seismometer/set32+get_scale/fs100/w5.12', seismometer_cycle))
+
+    # 逐次計算(1回のFIFO分 = 32サンプル)
+    stream = StreamingIntensity(fs, int(fs * 5.12))
+    stream.update(window)
+    stream_batch = data[:, 6000:6032].copy()
+    cases.append(('stream_update/testdata/batch32',
+                  lambda: (stream.update(stream_batch), stream.get_scale())))
+
+    # LIS2DH12のFIFO読み出しとデコード(32サンプル)
+    lis2dh12 = LIS2DH12()
+    cases.append(('lis2dh12/get_accel_array/fifo32', lis2dh12.get_accel_array))
+
+    # system_dataの保存
+    cases.append(('file_process/save_system_data', build_save_case(loop)))
+    return cases
+
+
+def build_save_case(loop):
+    """
+    一時ディレクトリにsystem_dataを保存するケースを作る。
+    サーバとの同期スクリプトは何もしないものに置き換える。
+    """
+    from file_process import FileProcess
+    from soft_config import SoftConfig
+    tmp = tempfile.mkdtemp(prefix='pvsw_bench_')
+    atexit.register(shutil.rmtree, tmp, ignore_errors=True)
+    Path(tmp, 'noop.sh').write_text('exit 0\n', encoding='utf-8')
+    file_config = SoftConfig.FileConfig(data_path=tmp + '/')
+    file_config.script_path = tmp + '/'
+    file_config.script_name = 'noop.sh'
+    file_process = FileProcess(file_config)
+    record = {'parameters': {
+        'mainParameter': {'time': '2024-01-01T00:00:00.000+09:00', 'status': 0, 'temperature': 31.5,
+                          'ac_in': 1, 'in_24V': 1, 'seismometer': 1.25, 'wet': 0.01},
+        'slave_0001': {'programName': 'pvsw_slave', 'volt': 24.1}}}
+
+    async def wait_stopped():
+        tasks = asyncio.all_tasks() - {asyncio.current_task()}
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def close():
+        # アップロード中のプロセスを停止してからループを閉じる。
+        file_process.stop()
+        loop.run_until_complete(wait_stopped())
+        loop.close()
+    atexit.register(close)
+
+    def save():
+        loop.run_until_complete(file_process.save_system_data(record))
+    return save
+
+
+def compare(results, baseline, threshold):
+    """
+    baselineと比較し、中央値がthreshold以上遅くなったものの名前を返す。
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        base = baseline[name]['p50_ms']
+        if base > 0 and result['p50_ms'] > base * (1.0 + threshold):
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--iterations', type=int, default=200, help='1ケースあたりの計測回数')
+    parser.add_argument('-k', '--filter', default='', help='名前にこの文字列を含むケースのみ計測する')
+    parser.add_argument('--baseline', type=Path, default=DEF_BASELINE, help='baselineのJSONファイル')
+    parser.add_argument('--save-baseline', action='store_true', help='計測結果をbaselineとして保存する')
+    parser.add_argument('--threshold', type=float, default=0.2, help='regressionと判定する中央値の増加率')
+    args = parser.parse_args()
+
+    install_fake_hardware()
+    # ログ出力の時間を計測に含めないようにする。
+    logging.disable(logging.CRITICAL)
+    baseline = {}
+    if args.baseline.exists():
+        with open(args.baseline, 'r', encoding='utf-8') as file:
+            baseline = json.load(file)
+
+    results = {}
+    print(f'{"case":48} {"p50":>9} {"p90":>9} {"p99":>9} {"max":>9} {"peakKiB":>9} {"blocks":>7} {"vs base":>8}')
+    for name, fn in build_cases():
+        if args.filter not in name:
+            continue
+        result = measure(fn, args.iterations)
+        results[name] = result
+        ratio = ''
+        if name in baseline and baseline[name]['p50_ms'] > 0:
+            ratio = f'{result["p50_ms"] / baseline[name]["p50_ms"]:7.2f}x'
+        print(f'{name:48} {result["p50_ms"]:9.3f} {result["p90_ms"]:9.3f} {result["p99_ms"]:9.3f} '
+              f'{result["max_ms"]:9.3f} {result["peak_kib"]:9.1f} {result["retained_blocks_per_call"]:7.1f} {ratio:>8}')
+
+    if args.save_baseline:
+        baseline.update(results)
+        with open(args.baseline, 'w', encoding='utf-8') as file:
+            json.dump(baseline, file, indent=4)
+        print(f'baseline saved: {args.baseline}')
+        return 0
+
+    regressions = compare(results, baseline, args.threshold)
+    for name in regressions:
+        print(f'REGRESSION: {name} (p50 > baseline x {1.0 + args.threshold:.2f})')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,223 @@
+"""
+CAN通信(PvswSlave・PollScheduler)のスループットのベンチマーク
+
+python-canのvirtualバス(または--bustype socketcan --channel vcan0)上に仮想slaveを起動し、
+CanCommunicationとPvswSlaveで読み出しを繰り返して、slave数に対する
+1秒あたりの要求数とレイテンシのパーセンタイルを表示する。
+virtualバスはビットレートの制約がないため、bus loadはPollSchedulerの見積もりとなる。
+
+    python Benchmark/can_throughput.py                       # 1, 4, 8, 16, 32, 48台
+    python Benchmark/can_throughput.py --slaves 32 --single  # 'CR'のみ(従来のファームウェア)
+    python Benchmark/can_throughput.py --latency 0.002 --loss 0.01
+    python Benchmark/can_throughput.py --slaves 1 4 --download 65536   # ファームウェアのダウンロード
+"""
+import argparse
+import asyncio
+import logging
+import random
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+from benchmark import install_fake_hardware, percentile  # noqa: E402
+
+
+def slave_param(param_num):
+    """
+    programNameとparam_num-1個のfloatを持つslaveのパラメータのdictを返す関数
+    """
+    def factory(address):
+        parameters = {'programName': {'command': '0000', 'type': {'type': 'str', 'value': f'sim{address:02x}'}}}
+        for index in range(1, param_num):
+            parameters[f'param{index:02d}'] = {'command': f'{index:04x}',
+                                               'type': {'type': 'float', 'value': float(index)}}
+        return {'parameters': parameters}
+    return factory
+
+
+class TimedSlave:
+    """
+    PvswSlave.requestの所要時間を記録する。
+    """
+    def __init__(self, slave, latencies):
+        self.__request = slave.request
+
+        async def request(command, data, count_timeout=True, timeout=None):
+            start = time.perf_counter()
+            result = await self.__request(command, data, count_timeout, timeout)
+            if result is not None:
+                latencies.append((time.perf_counter() - start) * 1000.0)
+            return result
+        slave.request = request
+
+
+async def run_load(slaves, params, duration, batch):
+    """
+    全slaveに対してduration秒間、読み出しを繰り返す。
+    :return: 読み出したパラメータの数
+    """
+    deadline = time.monotonic() + duration
+    done = 0
+
+    async def worker(slave, nodes):
+        nonlocal done
+        while time.monotonic() < deadline:
+            if batch:
+                await slave.send_batch(['B', 'R'], nodes)
+            else:
+                await asyncio.gather(*(slave.send(['C', 'R'], node) for node in nodes))
+            done += len(nodes)
+    await asyncio.gather(*(worker(slave, nodes) for slave, nodes in zip(slaves, params)))
+    return done
+
+
+async def run_case(args, slave_num):
+    from can_communication import CanCommunication
+    from can_simulator import CanSimulator
+    from poll_scheduler import PollScheduler
+    from pvsw_slave import PvswSlave
+    from soft_config import SoftConfig
+
+    factory = slave_param(args.params)
+    can_config = SoftConfig.CanConfig(bitrate=args.bitrate, bustype=args.bustype, channel=args.channel)
+    can_communication = CanCommunication(can_config, SoftConfig.J1939Config(max_cmdt_packets=args.cmdt_packets))
+    await can_communication.start()
+    # masterが各slaveのアドレスクレームを受信できるよう、masterの後に起動する。
+    simulator = CanSimulator(slave_num, factory, bustype=args.bustype, channel=args.channel,
+                             bitrate=args.bitrate, latency=args.latency, loss=args.loss, batch=not args.single,
+                             echo_header=args.echo_header, max_cmdt_packets=args.cmdt_packets,
+                             claim=args.claim, claim_delay=args.claim_delay,
+                             conflicts=args.conflicts, conflict_wins=args.conflict_wins)
+    simulator.wait_ready(timeout=5.0 + args.claim_delay)
+    try:
+        latencies = []
+        slaves = []
+        params = []
+        for virtual in simulator.slaves:
+            param = factory(virtual.address)
+            slave = PvswSlave(can_communication, param, address=virtual.address,
+                              response_timeout=args.timeout, pipeline_depth=args.pipeline)
+            TimedSlave(slave, latencies)
+            slaves.append(slave)
+            params.append(list(param['parameters'].values()))
+        # アドレスクレームで見つかったslave数(確認用)
+        claimed = len({address for (address, _) in can_communication.slave_list if address != 0xFE})
+        if args.download > 0:
+            return await run_download(args, slaves, simulator, claimed, can_communication)
+        done = await run_load(slaves, params, args.duration, batch=not args.single)
+        failures = sum(slave.failure_count for slave in slaves)
+        # PollSchedulerで1周期読み出した場合
+        scheduler = PollScheduler(args.bitrate, bus_load_limit=args.bus_load_limit, default_freshness=args.interval)
+        for slave, nodes in zip(slaves, params):
+            scheduler.add_slave(slave, [PollSlot(node) for node in nodes])
+        await scheduler.poll(args.interval)
+        latencies.sort()
+        return {
+            'slaves': slave_num,
+            'claimed': claimed,
+            'tps': len(latencies) / args.duration,
+            'params_per_sec': done / args.duration,
+            'p50_ms': percentile(latencies, 50) if latencies else 0.0,
+            'p99_ms': percentile(latencies, 99) if latencies else 0.0,
+            'max_ms': latencies[-1] if latencies else 0.0,
+            'failures': failures,
+            'cycle_s': scheduler.cycle_time,
+            'bus_load': scheduler.bus_load,
+            'deferred': scheduler.deferred_count,
+            'rx_drops': can_communication.drop_count,
+            'rx_queue_max': can_communication.rx_queue_max,
+        }
+    finally:
+        can_communication.stop()
+        simulator.stop()
+
+
+async def run_download(args, slaves, simulator, claimed, can_communication):
+    """
+    全slaveへ並列にargs.downloadバイトのイメージをダウンロードする。
+    """
+    from firmware_download import FirmwareDownloader
+
+    image = random.Random(0).randbytes(args.download)
+    downloader = FirmwareDownloader(args.bitrate, args.cmdt_packets, bus_load_limit=args.bus_load_limit,
+                                    window=args.window, response_timeout=args.timeout)
+    start = time.perf_counter()
+    results = await downloader.download_all([(slave, image) for slave in slaves])
+    elapsed = time.perf_counter() - start
+    verified = sum(virtual.firmware == image for virtual in simulator.slaves)
+    return {
+        'slaves': len(slaves),
+        'claimed': claimed,
+        'success': sum(results),
+        'verified': verified,
+        'elapsed': elapsed,
+        'throughput': args.download * sum(results) / elapsed,
+        'retries': sum(result['retries'] for result in downloader.results.values()),
+        'block_size': downloader.block_size,
+        'rx_drops': can_communication.drop_count,
+    }
+
+
+class PollSlot:
+    """
+    PollSchedulerに登録するためのslot(ParamSlotのcommandとnodeのみ)
+    """
+    def __init__(self, node):
+        self.node = node
+        self.command = node['command']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--slaves', type=int, nargs='+', default=[1, 4, 8, 16, 32, 48], help='slave数')
+    parser.add_argument('--params', type=int, default=10, help='slave 1台あたりのパラメータ数')
+    parser.add_argument('--duration', type=float, default=3.0, help='1ケースの計測時間(sec)')
+    parser.add_argument('--latency', type=float, default=0.0, help='仮想slaveの応答時間(sec)')
+    parser.add_argument('--loss', type=float, default=0.0, help='仮想slaveが応答しない確率')
+    parser.add_argument('--single', action='store_true', help="'BR'を使わず'CR'のみで読み出す")
+    parser.add_argument('--pipeline', type=int, default=4, help='slave 1台あたりのpipeline_depth')
+    parser.add_argument('--echo-header', action='store_true',
+                        help="仮想slaveが'CR'/'CW'の応答にヘッダを付ける(付けない場合、pipelineは使われない)")
+    parser.add_argument('--timeout', type=float, default=0.5, help='応答を待つ時間(sec)')
+    parser.add_argument('--interval', type=float, default=2.0, help='PollSchedulerの周期(sec)')
+    parser.add_argument('--bus-load-limit', type=float, default=0.5, help='PollSchedulerのバス使用率の上限')
+    parser.add_argument('--cmdt-packets', type=int, default=10, help='J1939のmax_cmdt_packets')
+    parser.add_argument('--claim', default='immediate', choices=('immediate', 'delayed', 'none'),
+                        help='仮想slaveのアドレスクレームの方法')
+    parser.add_argument('--claim-delay', type=float, default=0.0, help="'delayed'の場合のアドレスクレームまでの時間(sec)")
+    parser.add_argument('--conflicts', type=int, default=0, help='同じアドレスを要求する仮想slaveを追加する数')
+    parser.add_argument('--conflict-wins', action='store_true', help='追加した仮想slaveがアドレスを得る')
+    parser.add_argument('--bustype', default='virtual', help="python-canのbustype('virtual' or 'socketcan')")
+    parser.add_argument('--channel', default='pvsw_sim', help="チャンネル名(vcanの場合は'vcan0'など)")
+    parser.add_argument('--bitrate', type=int, default=125000, help='ビットレート(bit/s)')
+    parser.add_argument('--download', type=int, default=0,
+                        help='0以外の場合、このバイト数のファームウェアを全slaveへダウンロードする')
+    parser.add_argument('--window', type=int, default=2, help='ダウンロードで確認応答を待つブロック数')
+    args = parser.parse_args()
+
+    install_fake_hardware()
+    logging.disable(logging.CRITICAL)
+    if args.download > 0:
+        print(f'{"slaves":>6} {"claimed":>7} {"ok":>4} {"verify":>6} {"block":>6} {"sec":>8} {"bytes/s":>9} '
+              f'{"retry":>6} {"rxdrop":>6}')
+        for slave_num in args.slaves:
+            result = asyncio.run(run_case(args, slave_num))
+            print(f'{result["slaves"]:6} {result["claimed"]:7} {result["success"]:4} {result["verified"]:6} '
+                  f'{result["block_size"]:6} {result["elapsed"]:8.2f} {result["throughput"]:9.0f} '
+                  f'{result["retries"]:6} {result["rx_drops"]:6}')
+        return 0
+    print(f'{"slaves":>6} {"claimed":>7} {"req/s":>9} {"param/s":>9} {"p50ms":>8} {"p99ms":>8} {"maxms":>8} '
+          f'{"fail":>5} {"cycle_s":>8} {"busload":>8} {"defer":>6} {"rxdrop":>6} {"rxqmax":>6}')
+    for slave_num in args.slaves:
+        result = asyncio.run(run_case(args, slave_num))
+        print(f'{result["slaves"]:6} {result["claimed"]:7} {result["tps"]:9.1f} {result["params_per_sec"]:9.1f} '
+              f'{result["p50_ms"]:8.2f} {result["p99_ms"]:8.2f} {result["max_ms"]:8.2f} {result["failures"]:5} '
+              f'{result["cycle_s"]:8.3f} {result["bus_load"]:8.1%} {result["deferred"]:6} '
+              f'{result["rx_drops"]:6} {result["rx_queue_max"]:6}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
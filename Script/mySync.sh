@@ -10,21 +10,26 @@ if [ "$1" = "-U" ]; then
 	# rsyncを使用してデータを転送
 	rsync -avz -e "ssh -p 1919" --partial --progress $2 $DESTINATION_USER@$DESTINATION_HOST:$DESTINATION_PATH$3
 	# rsyncの終了ステータスをチェック
-	if [ $? -eq 0 ]; then
+	status=$?
+	if [ $status -eq 0 ]; then
 	    echo "Data transferred successfully."
 	else
 	    echo "Data transfer failed."
 	fi
+	exit $status
 #第一引数:0(Download)の場合
 elif [ "$1" = "-D" ]; then
 	# rsyncを使用してデータを転送
 	rsync -avz -e "ssh -p 1919" --partial --progress $DESTINATION_USER@$DESTINATION_HOST:$DESTINATION_PATH$3 $2
 	# rsyncの終了ステータスをチェック
-	if [ $? -eq 0 ]; then
+	status=$?
+	if [ $status -eq 0 ]; then
 	    echo "Data transferred successfully."
 	else
 	    echo "Data transfer failed."
 	fi
+	exit $status
 else
 	echo "Invalid arg1 param."
+	exit 2
 fi
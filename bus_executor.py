@@ -0,0 +1,163 @@
+import asyncio
+import queue
+import threading
+import time
+from logging import getLogger
+from metrics import REGISTRY
+
+
+class DeviceLatency:
+    """
+    デバイス1つ分のI/Oの所要時間の記録
+    """
+
+    def __init__(self, bus, device):
+        self.histogram = REGISTRY.histogram('pvsw_io_seconds', 'Latency of bus I/O including the queue wait.',
+                                            {'bus': bus, 'device': device})
+        self.count = 0
+        # 要求から結果を受け取るまで(キューの待ち時間 + 実行時間)(sec)
+        self.last_latency = 0.0
+        self.max_latency = 0.0
+        self.total_latency = 0.0
+        # 実行時間(sec)
+        self.last_service = 0.0
+        self.max_service = 0.0
+        # 同じ読み出しがまとめられた要求の数
+        self.batched_count = 0
+        self.failure_count = 0
+
+    @property
+    def mean_latency(self):
+        return self.total_latency / self.count if self.count > 0 else 0.0
+
+    def record(self, latency, service):
+        self.histogram.observe(latency)
+        self.count += 1
+        self.last_latency = latency
+        self.max_latency = max(self.max_latency, latency)
+        self.total_latency += latency
+        self.last_service = service
+        self.max_service = max(self.max_service, service)
+
+    def as_dict(self):
+        return {'count': self.count, 'last_latency': self.last_latency, 'max_latency': self.max_latency,
+                'mean_latency': self.mean_latency, 'last_service': self.last_service,
+                'max_service': self.max_service, 'batched_count': self.batched_count,
+                'failure_count': self.failure_count}
+
+
+class BusExecutor:
+    """
+    1つのバス(SPI, I2C, GPIO)のブロッキングするI/Oを専用のスレッドで実行する。
+    イベントループは要求をキューに入れて結果を待つのみとし、バスが遅くてもアラームの処理を止めない。
+    スレッドはキューに溜まった要求をまとめて取り出して順に実行し、結果はまとめてイベントループへ返す。
+    同じkeyの読み出しが溜まっている場合は1回だけ実行し、全ての要求に同じ結果を返す。
+    threaded=Falseの場合はイベントループ上でその場で実行する。(従来の動作。記録は同様に行う。)
+    """
+
+    def __init__(self, name, threaded=True):
+        """
+        :param name: バスの名前(スレッド名とログに使用する)
+        :param threaded: 専用のスレッドで実行するか
+        """
+        self.logger = getLogger(__name__)
+        self.name = name
+        # デバイス名: DeviceLatency
+        self.latency = {}
+        self.__queue = None
+        self.__thread = None
+        if threaded:
+            self.__queue = queue.SimpleQueue()
+            self.__thread = threading.Thread(target=self.__run, name=f'io-{name}', daemon=True)
+            self.__thread.start()
+
+    def __device(self, device):
+        latency = self.latency.get(device)
+        if latency is None:
+            latency = DeviceLatency(self.name, device)
+            self.latency[device] = latency
+        return latency
+
+    async def call(self, device, function, key=None):
+        """
+        functionをバスのスレッドで実行し、結果を返す。functionの例外はそのまま送出する。
+        :param device: デバイス名(所要時間の記録に使用する)
+        :param function: 引数なしの関数
+        :param key: 読み出しをまとめるためのkey。Noneの場合はまとめない。(書き込みなど)
+        """
+        start = time.perf_counter()
+        if self.__queue is None:
+            try:
+                result = function()
+            except Exception:
+                self.__device(device).failure_count += 1
+                raise
+            end = time.perf_counter()
+            self.__device(device).record(end - start, end - start)
+            return result
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.__queue.put((device, function, key, future, loop, start))
+        return await future
+
+    def __run(self):
+        """
+        バスのスレッド。キューに溜まった要求を全て取り出し、まとめて実行する。
+        """
+        while True:
+            requests = [self.__queue.get()]
+            while True:
+                try:
+                    requests.append(self.__queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in requests
+            requests = [request for request in requests if request is not None]
+            results = {}  # key: (結果, 例外, 実行時間)
+            done = []
+            for (device, function, key, future, loop, start) in requests:
+                if key is not None and (device, key) in results:
+                    # 同じ読み出しは1回の結果を共有する。
+                    done.append((device, future, loop, start, *results[(device, key)], True))
+                    continue
+                service_start = time.perf_counter()
+                result = None
+                error = None
+                try:
+                    result = function()
+                except Exception as e:
+                    error = e
+                outcome = (result, error, time.perf_counter() - service_start)
+                if key is not None:
+                    results[(device, key)] = outcome
+                done.append((device, future, loop, start, *outcome, False))
+            for loop in {entry[2] for entry in done}:
+                loop.call_soon_threadsafe(self.__deliver, [entry for entry in done if entry[2] is loop])
+            if stop:
+                return
+
+    def __deliver(self, done):
+        """
+        実行結果を待機側へ返す。イベントループ上で呼ばれる。
+        """
+        end = time.perf_counter()
+        for (device, future, _, start, result, error, service, batched) in done:
+            latency = self.__device(device)
+            if batched:
+                latency.batched_count += 1
+            if error is not None:
+                latency.failure_count += 1
+            latency.record(end - start, service)
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def shutdown(self):
+        """
+        スレッドを終了する。キューに溜まっている要求は実行してから終了する。
+        """
+        if self.__queue is not None and self.__thread.is_alive():
+            self.__queue.put(None)
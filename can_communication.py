@@ -1,10 +1,11 @@
-import os
 import time
 import asyncio
-from logging import getLogger, config
+from collections import deque
+from logging import getLogger, config, DEBUG
 import j1939
 from enum import IntEnum
 from soft_config import SoftConfig
+from metrics import REGISTRY
 from gpiozero import LED
 
 class CAListenAddressClaimed(j1939.ControllerApplication):
@@ -42,13 +43,20 @@ class CanCommunication:
         Acknowledgement = 0x00E800
         ProprietaryA    = 0x00EF00
 
+    # アドレスクレームの完了を待つ時間(sec)。socketcan以外(virtual, vcanのシミュレータなど)で使用する。
+    ADDRESS_CLAIM_TIMEOUT = 5.0
+    # 受信スレッドからイベントループへ渡すフレームの上限数。超えた分は破棄して数える。
+    RX_QUEUE_SIZE = 1024
+
     def __init__(self, can_config : SoftConfig.CanConfig, j1939_config : SoftConfig.J1939Config):
+        """
+        設定のみ行う。CANの起動(インターフェース・接続・slaveの起動待ち)はstart()で行う。
+        """
         self.logger = getLogger(__name__)
-        # gpioの設定
-        self.slave_en = LED(self.SLAVE_EN_GPIO)
-        self.slave_en.on()
-        # CANとJ1939の設定
-        os.system('sudo ip link set can0 up type can bitrate ' + f'{can_config.bitrate}' )
+        self.__can_config = can_config
+        # 実機(socketcan)の場合のみ、slaveの電源とCANインターフェースを操作する。
+        self.__is_device = can_config.bustype == 'socketcan'
+        self.slave_en = None
         name = j1939.Name(
             arbitrary_address_capable=0,
             industry_group=j1939.Name.IndustryGroup.Industrial, #Industrialに固定
@@ -62,20 +70,74 @@ class CanCommunication:
         )
         self.ca = CAListenAddressClaimed(name, j1939_config.master_address)
         self.ecu = j1939.ElectronicControlUnit(max_cmdt_packets=j1939_config.max_cmdt_packets)
-        self.ecu.connect(bustype=can_config.bustype , channel=can_config.channel, bitrate=can_config.bitrate)
-        self.ecu.add_ca(controller_application=self.ca)
-        self.ca.subscribe(self.__on_ca_receive)
-        self.ca.add_listener(self.__listener)
-        # self.ca.add_timer(2, self.__ca_timer_callback)
+        # 受信したフレームはイベントループ上で(PGN, 送信元アドレス)ごとのhandlerへ渡す。
+        self.__loop = None
+        self.__rx_queue = deque()
+        self.__rx_scheduled = False
+        self.__handlers = {}
+        self.rx_count = 0
+        self.drop_count = 0
+        self.rx_queue_max = 0
         self.slave_list = []
-        self.ca.start()
-        self.__fn_received = []
+        self.__started = False
+        REGISTRY.counter('pvsw_can_rx_frames', 'Received J1939 messages.', function=lambda: self.rx_count)
+        REGISTRY.counter('pvsw_can_rx_drops', 'J1939 messages dropped because the rx queue was full.',
+                         function=lambda: self.drop_count)
+        REGISTRY.gauge('pvsw_can_rx_queue_max', 'Maximum length of the rx queue.', function=lambda: self.rx_queue_max)
+
+    async def start(self):
+        """
+        CANを起動する。インターフェースの設定・接続・slaveの起動待ちはイベントループを止めずに行う。
+        """
+        self.attach_loop()
+        if self.__is_device:
+            # gpioの設定
+            self.slave_en = LED(self.SLAVE_EN_GPIO)
+            self.slave_en.on()
+            # CANとJ1939の設定
+            proc = await asyncio.create_subprocess_exec(
+                'sudo', 'ip', 'link', 'set', self.__can_config.channel, 'up',
+                'type', 'can', 'bitrate', f'{self.__can_config.bitrate}')
+            await proc.wait()
+        await asyncio.to_thread(self.__connect)
         self.logger.info('can start')
-        time.sleep(5)
+        if self.__is_device:
+            # slaveの起動を待つ。
+            await asyncio.sleep(5)
+        else:
+            await self.__wait_address_claim()
         # self.slave_en.off()
         # self.ca.send_request(0, self.PGN.ACKNOWLEDGEMENT, 0xFF)
         # self.ca.send_pgn(0, 0xEF, 0x08, 6, list(range(0,64,1)))
-    
+
+    def __connect(self):
+        """
+        バスに接続し、アドレスクレームを開始する。(別スレッドで呼ぶ)
+        """
+        self.ecu.connect(bustype=self.__can_config.bustype, channel=self.__can_config.channel,
+                         bitrate=self.__can_config.bitrate)
+        self.ecu.add_ca(controller_application=self.ca)
+        self.ca.subscribe(self.__on_ca_receive)
+        self.ca.add_listener(self.__listener)
+        # self.ca.add_timer(2, self.__ca_timer_callback)
+        self.ca.start()
+        self.__started = True
+
+    async def __wait_address_claim(self):
+        """
+        自身のアドレスクレームが完了するまで待機する。
+        """
+        deadline = time.monotonic() + self.ADDRESS_CLAIM_TIMEOUT
+        while self.ca.state != j1939.ControllerApplication.State.NORMAL and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+
+    def stop(self):
+        if self.__started:
+            self.__started = False
+            self.ca.stop()
+            self.ecu.disconnect()
+            self.logger.info('can end')
+
     def __listener(self, mid, data, timestamp):
         self.logger.info(f'id:{mid.source_address:07x}')
         # 1番目:アドレス、2番目:製品コード(仮に0を格納している。)
@@ -91,29 +153,71 @@ class CanCommunication:
             self.logger.info('send')
         return True
     
+    def attach_loop(self, loop=None):
+        """
+        受信したフレームを渡すイベントループを設定する。それまでに受信したフレームは破棄する。
+        :param loop: イベントループ。Noneの場合は実行中のイベントループ
+        """
+        if self.__loop is None:
+            self.__loop = loop if loop is not None else asyncio.get_running_loop()
+
     def __on_ca_receive(self, priority, pgn, sa, timestamp, data):
-        """process receive"""
-        self.logger.info(f'PGN {pgn:06x} length {len(data)} sa {sa:02x}')
-        self.logger.info(''.join([chr(value) for value in data]))
-        match pgn:
-            case self.PGN.Acknowledgement:
+        """
+        j1939の受信スレッドから呼ばれる。
+        フレームをキューに入れ、イベントループでの処理を予約するのみとする。
+        """
+        if self.__loop is None or len(self.__rx_queue) >= self.RX_QUEUE_SIZE:
+            self.drop_count += 1
+            return
+        self.__rx_queue.append((pgn, sa, data))
+        if not self.__rx_scheduled:
+            # 処理の予約はキューが空になるまでに1回とする。
+            self.__rx_scheduled = True
+            self.__loop.call_soon_threadsafe(self.__dispatch)
+
+    def __dispatch(self):
+        """
+        イベントループ上で、キューのフレームを(PGN, 送信元アドレス)のhandlerへ渡す。
+        """
+        self.__rx_scheduled = False
+        self.rx_queue_max = max(self.rx_queue_max, len(self.__rx_queue))
+        debug = self.logger.isEnabledFor(DEBUG)
+        while len(self.__rx_queue) > 0:
+            (pgn, sa, data) = self.__rx_queue.popleft()
+            self.rx_count += 1
+            if debug:
+                self.logger.debug('PGN %06x length %d sa %02x', pgn, len(data), sa)
+            if pgn == self.PGN.Acknowledgement:
                 # register slave address from ack
                 if sa not in self.slave_list:
                     self.slave_list.append(sa)
                     self.logger.info('add slave %d', sa)
-            case self.PGN.ProprietaryA:
-                for fn in self.__fn_received:
+            for key in ((pgn, sa), (pgn, None)):
+                for fn in self.__handlers.get(key, ()):
                     fn(sa, data)
-            case _:
-                return
+
+    def subscribe(self, pgn, sa, fn):
+        """
+        受信したフレームのhandlerを登録する。handlerはイベントループ上で呼ばれる。
+        :param pgn: PGN
+        :param sa: 送信元アドレス。Noneの場合は全てのアドレス
+        :param fn: fn(sa, data)
+        """
+        self.__handlers.setdefault((pgn, sa), []).append(fn)
+
+    def unsubscribe(self, pgn, sa, fn):
+        handlers = self.__handlers.get((pgn, sa), [])
+        if fn in handlers:
+            handlers.remove(fn)
 
     def set_on_ca_received(self, fn):
-        self.__fn_received.append(fn)
+        """
+        全てのアドレスからのProprietaryAのhandlerを登録する。
+        """
+        self.subscribe(self.PGN.ProprietaryA, None, fn)
 
     def del_on_ca_received(self, fn):
-        self.__fn_received.remove(fn)
+        self.unsubscribe(self.PGN.ProprietaryA, None, fn)
 
     def __del__(self):
-        self.ca.stop()
-        self.ecu.disconnect()
-        self.logger('can end')
+        self.stop()
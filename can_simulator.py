@@ -0,0 +1,304 @@
+import random
+import struct
+import time
+import zlib
+from logging import getLogger
+import j1939
+from can_communication import CanCommunication
+
+
+class VirtualSlave:
+    """
+    仮想のslave ECU
+    python-canのvirtualバスまたはvcanに接続し、アドレスクレームを行った後、
+    ProprietaryAの'CR'/'CW'(と'BR'/'BW')にパラメータリストの値で応答する。
+    ファームウェアのダウンロード('DS'/'DB'/'DE')を受け付け、完了したイメージをfirmwareに格納する。
+    アドレスクレームは以下から選ぶ。(masterのアドレスクレームの処理の試験用)
+        'immediate': 起動後すぐに行う。
+        'delayed': claim_delay後に行う。それまでは応答しない。
+        'none': アドレスクレームを送信せずに応答する。
+    同じアドレスのslaveを複数起動すると、NAME(identity_number)の小さい方がアドレスを得る。
+    """
+    # masterへのtransport protocolの送信が終わるのを待つ間隔(sec)
+    TP_BUSY_INTERVAL = 0.005
+    CLAIM_IMMEDIATE = 'immediate'
+    CLAIM_DELAYED = 'delayed'
+    CLAIM_NONE = 'none'
+
+    def __init__(self, address, param, bustype='virtual', channel='pvsw_sim', bitrate=125000,
+                 latency=0.0, loss=0.0, batch=True, echo_header=False, seed=None, max_cmdt_packets=10,
+                 claim=CLAIM_IMMEDIATE, claim_delay=0.0, identity_number=None, arbitrary_address=False):
+        """
+        :param address: J1939アドレス
+        :param param: パラメータのdict({'parameters': {...}})。parameterListSlaveと同じ形式
+        :param bustype: python-canのbustype('virtual' or 'socketcan'(vcan))
+        :param channel: チャンネル名(virtualの場合は任意の名前、vcanの場合は'vcan0'など)
+        :param bitrate: ビットレート(bit/s)
+        :param latency: 要求を受信してから応答するまでの時間(sec)
+        :param loss: 要求に応答しない確率(0.0-1.0)
+        :param batch: 'BR'/'BW'に応答するか。Falseの場合は従来のファームウェアと同様に無視する。
+        :param echo_header: 'CR'/'CW'の応答の先頭に要求のヘッダ(4byte)を付けるか
+        :param seed: 応答しない要求を選ぶ乱数のseed
+        :param max_cmdt_packets: transport protocolの受信時にCTS 1回で要求するパケット数
+        :param claim: アドレスクレームの方法('immediate', 'delayed' or 'none')
+        :param claim_delay: 'delayed'の場合、アドレスクレームを開始するまでの時間(sec)
+        :param identity_number: NAMEのidentity_number。Noneの場合はaddress。アドレスの競合時の優先度になる。
+        :param arbitrary_address: アドレスの競合に負けた場合に次のアドレスを取得するか。
+                                  Falseの場合はアドレスを取得できない(cannot claim)状態になる。
+        """
+        self.logger = getLogger(__name__)
+        self.address = address
+        self.claim = claim
+        self.latency = latency
+        self.loss = loss
+        self.batch = batch
+        self.echo_header = echo_header
+        self.__random = random.Random(seed)
+        # command(2byte): パラメータのdict
+        self.__commands = {}
+        for node in self.__iter_nodes(param['parameters']):
+            self.__commands[struct.pack('<H', int(node['command'], 16))] = node
+        # 受信・応答の記録
+        self.request_count = 0
+        self.drop_count = 0
+        # ダウンロード中のイメージ((大きさ, ブロックの大きさ, CRC32), 受信したデータ)と完了したイメージ
+        self.__download = None
+        self.firmware = None
+        name = j1939.Name(
+            arbitrary_address_capable=1 if arbitrary_address else 0,
+            industry_group=j1939.Name.IndustryGroup.Industrial,
+            vehicle_system_instance=1,
+            vehicle_system=1,
+            function=2,
+            function_instance=1,
+            ecu_instance=1,
+            manufacture_code=0x100,
+            identity_number=address if identity_number is None else identity_number,
+        )
+        self.ca = j1939.ControllerApplication(name, address, bypass_address_claim=claim == self.CLAIM_NONE)
+        self.ecu = j1939.ElectronicControlUnit(max_cmdt_packets=max_cmdt_packets)
+        self.ecu.connect(bustype=bustype, channel=channel, bitrate=bitrate)
+        self.ecu.add_ca(controller_application=self.ca)
+        self.ca.subscribe(self.__on_receive)
+        match claim:
+            case self.CLAIM_IMMEDIATE:
+                self.ca.start()
+            case self.CLAIM_DELAYED:
+                self.ecu.add_timer(claim_delay, self.__start_claim)
+            case self.CLAIM_NONE:
+                pass
+            case _:
+                raise ValueError(f'unknown claim {claim}')
+
+    def __start_claim(self, cookie):
+        """
+        遅らせたアドレスクレームを開始する。(1回のみ)
+        """
+        self.ca.start()
+        return False
+
+    @property
+    def claimed_address(self):
+        """
+        取得したアドレス。取得していない(クレーム中、cannot claim)場合はNone
+        """
+        if self.ca.state != j1939.ControllerApplication.State.NORMAL:
+            return None
+        return self.ca.device_address
+
+    @staticmethod
+    def __iter_nodes(params):
+        """
+        commandを持つパラメータのdictを順に返す。
+        """
+        stack = [params]
+        while len(stack) > 0:
+            for value in stack.pop().values():
+                if isinstance(value, dict):
+                    if 'command' in value and 'type' in value:
+                        yield value
+                    else:
+                        stack.append(value)
+
+    @staticmethod
+    def __encode(node, batch):
+        """
+        パラメータの値をtypeに従ってbytesにする。
+        strは'CR'では文字列のみ、'BR'では長さ(1byte) + 文字列とする。
+        """
+        value = node['type']['value']
+        match node['type']['type']:
+            case 'uint':
+                return struct.pack('<I', value)
+            case 'int':
+                return struct.pack('<i', value)
+            case 'float':
+                return struct.pack('<f', value)
+            case 'str' | 'string':
+                text = str(value).encode('ascii', errors='replace')
+                return bytes([len(text)]) + text if batch else text
+            case _:
+                return b''
+
+    @staticmethod
+    def __decode(node, data):
+        match node['type']['type']:
+            case 'uint':
+                node['type']['value'] = struct.unpack('<I', data)[0]
+            case 'int':
+                node['type']['value'] = struct.unpack('<i', data)[0]
+            case 'float':
+                node['type']['value'] = struct.unpack('<f', data)[0]
+
+    def __on_receive(self, priority, pgn, sa, timestamp, data):
+        """
+        ECUの受信スレッドから呼ばれる。要求に対する応答を作成して送信する。
+        """
+        if pgn != CanCommunication.PGN.ProprietaryA or len(data) < 3:
+            return
+        self.request_count += 1
+        if self.loss > 0.0 and self.__random.random() < self.loss:
+            self.drop_count += 1
+            return
+        data = bytes(data)
+        match chr(data[0]):
+            case 'C':
+                reply = self.__single(data)
+            case 'B' if self.batch:
+                reply = self.__batch(data)
+            case 'D':
+                reply = self.__firmware(data)
+            case _:
+                reply = None
+        if reply is None:
+            return
+        if self.latency > 0.0:
+            self.ecu.add_timer(self.latency, self.__send, (sa, reply))
+        elif self.__send((sa, reply)):
+            self.ecu.add_timer(self.TP_BUSY_INTERVAL, self.__send, (sa, reply))
+
+    def __single(self, data):
+        """
+        'CR'/'CW'の応答。値のみ(echo_headerの場合はヘッダ + 値)を返す。
+        """
+        node = self.__commands.get(data[2:4])
+        if node is None:
+            return None
+        if chr(data[1]) == 'W' and len(data) >= 8:
+            self.__decode(node, data[4:8])
+        reply = self.__encode(node, batch=False)
+        return data[:4] + reply if self.echo_header else reply
+
+    def __batch(self, data):
+        """
+        'BR'/'BW'の応答。pre_command, 数, 値 × 数(要求の順)を返す。
+        """
+        count = data[2]
+        is_write = chr(data[1]) == 'W'
+        offset = 3
+        reply = bytearray(data[:3])
+        for _ in range(count):
+            node = self.__commands.get(data[offset:offset + 2])
+            offset += 2
+            if node is None:
+                return None
+            if is_write:
+                self.__decode(node, data[offset:offset + 4])
+                offset += 4
+            reply += self.__encode(node, batch=True)
+        return bytes(reply)
+
+    def __firmware(self, data):
+        """
+        ファームウェアのダウンロードの応答。ブロックは順番どおりのもののみ受け付ける。
+        同じイメージの'DS'を受信した場合は、受信済みのブロック数を返して続きから受け付ける。
+        """
+        match chr(data[1]):
+            case 'S' if len(data) >= 12:
+                key = struct.unpack('<IHI', data[2:12])
+                if self.__download is None or self.__download[0] != key:
+                    self.__download = (key, bytearray())
+                (_, block_size, _) = key
+                return data[:2] + struct.pack('<I', len(self.__download[1]) // block_size)
+            case 'B' if len(data) >= 10 and self.__download is not None:
+                ((_, block_size, _), image) = self.__download
+                (index, crc) = struct.unpack('<II', data[2:10])
+                block = data[10:]
+                status = 0
+                if index * block_size > len(image) or zlib.crc32(block) != crc:
+                    status = 1
+                elif index * block_size == len(image):
+                    image += block
+                return b'DA' + data[2:6] + bytes([status])
+            case 'E' if len(data) >= 10 and self.__download is not None:
+                ((size, _, crc), image) = self.__download
+                if len(image) != size or zlib.crc32(image) != crc:
+                    return data[:2] + bytes([1])
+                self.firmware = bytes(image)
+                self.__download = None
+                return data[:2] + bytes([0])
+            case _:
+                return None
+
+    def __send(self, cookie):
+        """
+        応答を送信する。masterへのtransport protocolの送信中(send_pgnがFalse)の場合はTrueを返し、
+        add_timerで繰り返し呼ばれて、送信中のものが終わってから送信する。
+        """
+        (dest, reply) = cookie
+        return self.ca.send_pgn(0, CanCommunication.PGN.ProprietaryA >> 8, dest, 6, list(reply)) is False
+
+    def stop(self):
+        self.ca.stop()
+        self.ecu.disconnect()
+
+
+class CanSimulator:
+    """
+    複数の仮想slave ECUを同じバスで動作させる。
+    PvswMasterのCanCommunicationをbustype='virtual'で同じchannelに接続すると、実機なしで通信できる。
+    """
+
+    def __init__(self, slave_num, param_factory, bustype='virtual', channel='pvsw_sim', bitrate=125000,
+                 first_address=0x10, conflicts=0, conflict_wins=False, **slave_kwargs):
+        """
+        :param slave_num: slaveの数
+        :param param_factory: アドレスを受け取り、そのslaveのパラメータのdictを返す関数
+        :param bustype: python-canのbustype
+        :param channel: チャンネル名
+        :param bitrate: ビットレート(bit/s)
+        :param first_address: 1台目のJ1939アドレス。以降は連番とする。
+        :param conflicts: 先頭からこの数のslaveと同じアドレスを要求するslave(contenders)を追加する。
+        :param conflict_wins: Trueの場合はcontendersのNAMEを優先させ、元のslaveがアドレスを失う。
+        :param slave_kwargs: VirtualSlaveへ渡す引数(latency, loss, batch, echo_header, max_cmdt_packets,
+                             claim, claim_delayなど)
+        """
+        self.slaves = []
+        self.contenders = []
+        for index in range(slave_num):
+            address = first_address + index
+            self.slaves.append(VirtualSlave(address, param_factory(address), bustype=bustype, channel=channel,
+                                            bitrate=bitrate, seed=address, **slave_kwargs))
+        for slave in self.slaves[:conflicts]:
+            # identity_numberが小さいほどNAMEの優先度が高い。(元のslaveはidentity_number = address)
+            identity_number = 0 if conflict_wins else 0x10000 + slave.address
+            self.contenders.append(VirtualSlave(slave.address, param_factory(slave.address), bustype=bustype,
+                                                channel=channel, bitrate=bitrate, seed=slave.address,
+                                                identity_number=identity_number, **slave_kwargs))
+
+    def wait_ready(self, timeout=5.0):
+        """
+        全slave(contendersを含む)のアドレスクレームが終わる(取得した、またはcannot claim)まで待機する。
+        :return: 終わったか
+        """
+        settled = (j1939.ControllerApplication.State.NORMAL, j1939.ControllerApplication.State.CANNOT_CLAIM)
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if all(slave.ca.state in settled for slave in self.slaves + self.contenders):
+                return True
+            time.sleep(0.01)
+        return False
+
+    def stop(self):
+        for slave in self.slaves + self.contenders:
+            slave.stop()
@@ -0,0 +1,118 @@
+import asyncio
+import ctypes
+import ctypes.util
+import os
+import struct
+from logging import getLogger
+
+
+class ControlWatcher:
+    """
+    controlディレクトリに指令ファイル(*control.json)が追加・更新されたことを検出する。
+    Linuxではinotifyで変更を待ち受け、使用できない場合はファイルのmtimeとsizeを周期的に比較する。
+    """
+    # inotifyのイベント(linux/inotify.h)
+    IN_ATTRIB       = 0x00000004
+    IN_CLOSE_WRITE  = 0x00000008
+    IN_MOVED_TO     = 0x00000080
+    IN_NONBLOCK     = 0x00000800
+    IN_CLOEXEC      = 0x00080000
+    EVENT_HEADER    = struct.Struct('iIII')
+
+    def __init__(self, dir_path, name, poll_interval_time=0.2):
+        """
+        :param dir_path: 監視するディレクトリ
+        :param name: 指令ファイル名(例: control.json)。これを含むファイルのみ対象とする。
+        :param poll_interval_time: inotifyが使用できない場合の確認周期(sec)
+        """
+        self.logger = getLogger(__name__)
+        self.dir_path = dir_path
+        self.name = name
+        self.poll_interval_time = poll_interval_time
+        self.__fd = None
+        self.__event = None
+        self.__snapshot = None
+
+    def start(self):
+        """
+        監視を開始する。イベントループ上で呼ぶこと。
+        """
+        self.__event = asyncio.Event()
+        self.__fd = self.__open_inotify()
+        if self.__fd is not None:
+            asyncio.get_running_loop().add_reader(self.__fd, self.__on_inotify)
+            self.logger.info(f'watch {self.dir_path} with inotify')
+        else:
+            self.__snapshot = self.__scan()
+            self.logger.info(f'watch {self.dir_path} with polling')
+
+    def __open_inotify(self):
+        """
+        inotifyを初期化し、ファイルディスクリプタを返す。使用できない場合はNone
+        """
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+            if fd < 0:
+                return None
+            # 書き込み完了・移動(rsyncの一時ファイルからの置換)・タイムスタンプ変更を検出する。
+            mask = self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_ATTRIB
+            if libc.inotify_add_watch(fd, os.fsencode(self.dir_path), mask) < 0:
+                self.logger.warning(f'inotify_add_watch failed: {os.strerror(ctypes.get_errno())}')
+                os.close(fd)
+                return None
+            return fd
+        except (OSError, AttributeError) as e:
+            self.logger.warning('%s', e)
+            return None
+
+    def __on_inotify(self):
+        """
+        inotifyのイベントを読み出し、指令ファイルに関するものがあれば通知する。
+        """
+        try:
+            data = os.read(self.__fd, 4096)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset + self.EVENT_HEADER.size <= len(data):
+            (_, _, _, length) = self.EVENT_HEADER.unpack_from(data, offset)
+            offset += self.EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0').decode(errors='replace')
+            offset += length
+            # rsyncの一時ファイル(.から始まる)は無視する。
+            if self.name in name and not name.startswith('.'):
+                self.__event.set()
+
+    def __scan(self):
+        """
+        指令ファイルの(名前, mtime, size)の集合を返す。
+        """
+        try:
+            with os.scandir(self.dir_path) as entries:
+                return frozenset((entry.name, entry.stat().st_mtime_ns, entry.stat().st_size)
+                                 for entry in entries
+                                 if self.name in entry.name and not entry.name.startswith('.'))
+        except FileNotFoundError:
+            return frozenset()
+
+    async def wait(self):
+        """
+        指令ファイルが追加・更新されるまで待機する。
+        """
+        if self.__fd is not None:
+            await self.__event.wait()
+            self.__event.clear()
+            return
+        while True:
+            await asyncio.sleep(self.poll_interval_time)
+            snapshot = self.__scan()
+            if snapshot != self.__snapshot:
+                self.__snapshot = snapshot
+                return
+
+    def stop(self):
+        if self.__fd is not None:
+            asyncio.get_running_loop().remove_reader(self.__fd)
+            os.close(self.__fd)
+            self.__fd = None
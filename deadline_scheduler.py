@@ -0,0 +1,162 @@
+import asyncio
+import math
+import time
+from logging import getLogger
+from metrics import REGISTRY
+
+
+class TaskStats:
+    """
+    周期タスク1つ分の実行の記録
+    """
+
+    def __init__(self, name, interval, policy):
+        self.name = name
+        self.interval = interval
+        self.policy = policy
+        self.run_count = 0
+        # 処理が次の周期の開始時刻を超えて遅れ始めた回数(遅れを取り戻すまでは1回とする)
+        self.overrun_count = 0
+        # 開始時刻を過ぎた周期の数と、そのうち実行しなかった数、待たずに続けて実行した数
+        self.missed_count = 0
+        self.skipped_count = 0
+        self.caught_up_count = 0
+        self.failure_count = 0
+        # 開始時刻の予定からの遅れ(sec)
+        self.last_jitter = 0.0
+        self.max_jitter = 0.0
+        self.total_jitter = 0.0
+        # 処理時間(sec)
+        self.last_duration = 0.0
+        self.max_duration = 0.0
+
+    @property
+    def mean_jitter(self):
+        return self.total_jitter / self.run_count if self.run_count > 0 else 0.0
+
+    def as_dict(self):
+        return {'interval': self.interval, 'policy': self.policy, 'run_count': self.run_count,
+                'overrun_count': self.overrun_count, 'missed_count': self.missed_count,
+                'skipped_count': self.skipped_count, 'caught_up_count': self.caught_up_count,
+                'failure_count': self.failure_count, 'last_jitter': self.last_jitter,
+                'max_jitter': self.max_jitter, 'mean_jitter': self.mean_jitter,
+                'last_duration': self.last_duration, 'max_duration': self.max_duration}
+
+
+class DeadlineScheduler:
+    """
+    周期タスクを単調増加の時刻(time.monotonic)の絶対的な期限で実行する。
+    n回目の開始時刻を 開始 + n × interval とするため、処理時間やsleepの誤差で周期がずれない。
+    処理が次の開始時刻を超えた(overrun)場合の動作はタスクごとに指定する。
+    overrunは遅れ始めた時に1回のみ数え、過ぎた周期の数は動作によらずmissed_countに数える。
+        'skip': 過ぎた周期は実行せず、次の開始時刻まで待つ。
+        'catch_up': 過ぎた周期を待たずに続けて実行する。(max_catch_upを超える分はskip)
+        'coalesce': 過ぎた周期をまとめて直ちに1回実行し、以降は元の開始時刻に合わせる。
+    処理で発生した例外はログに出力して数え、そのタスクの次の周期と他のタスクは継続する。
+    """
+    SKIP = 'skip'
+    CATCH_UP = 'catch_up'
+    COALESCE = 'coalesce'
+    POLICIES = (SKIP, CATCH_UP, COALESCE)
+
+    def __init__(self, max_catch_up=10):
+        """
+        :param max_catch_up: 'catch_up'で続けて実行する周期の数の上限
+        """
+        self.logger = getLogger(__name__)
+        self.max_catch_up = max_catch_up
+        # タスク名: TaskStats
+        self.stats = {}
+
+    async def run(self, name, function, interval, policy=COALESCE):
+        """
+        functionを周期的に実行する。キャンセルされるまで戻らない。
+        :param name: タスク名(記録とログに使用する)
+        :param function: 引数なしのコルーチン関数
+        :param interval: 周期(sec)
+        :param policy: overrun時の動作('skip', 'catch_up' or 'coalesce')
+        """
+        if policy not in self.POLICIES:
+            self.logger.error(f'{name}: unknown overrun policy {policy}, {self.COALESCE} is used')
+            policy = self.COALESCE
+        stats = TaskStats(name, interval, policy)
+        self.stats[name] = stats
+        labels = {'task': name}
+        duration_seconds = REGISTRY.histogram('pvsw_task_duration_seconds', 'Duration of a periodic task run.', labels)
+        jitter_seconds = REGISTRY.histogram('pvsw_task_jitter_seconds', 'Delay of a periodic task run from its deadline.',
+                                            labels)
+        REGISTRY.counter('pvsw_task_overruns', 'Times a periodic task fell behind its deadlines.', labels,
+                         function=lambda: stats.overrun_count)
+        REGISTRY.counter('pvsw_task_missed', 'Periods whose deadline passed during an overrun.', labels,
+                         function=lambda: stats.missed_count)
+        REGISTRY.counter('pvsw_task_skipped', 'Periods skipped after overruns.', labels,
+                         function=lambda: stats.skipped_count)
+        REGISTRY.counter('pvsw_task_caught_up', 'Periods run late back to back to catch up.', labels,
+                         function=lambda: stats.caught_up_count)
+        REGISTRY.counter('pvsw_task_failures', 'Periodic task runs that raised an exception.', labels,
+                         function=lambda: stats.failure_count)
+        start = time.monotonic()
+        index = 0
+        catch_up = 0
+        failures = 0
+        behind = False  # 遅れを取り戻していない間はTrue
+        missed_index = -1  # missed_countに数えた最後の周期
+        while True:
+            deadline = start + index * interval
+            now = time.monotonic()
+            if deadline > now:
+                behind = False
+                await asyncio.sleep(deadline - now)
+                now = time.monotonic()
+            stats.last_jitter = now - deadline
+            stats.max_jitter = max(stats.max_jitter, stats.last_jitter)
+            stats.total_jitter += stats.last_jitter
+            jitter_seconds.observe(stats.last_jitter)
+            stats.run_count += 1
+            try:
+                await function()
+                failures = 0
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # 失敗したタスクのみ数え、他のタスクを止めない。続けて失敗する場合、tracebackは最初のみ出力する。
+                stats.failure_count += 1
+                failures += 1
+                if failures == 1:
+                    self.logger.exception(f'{name}: {e}')
+                else:
+                    self.logger.error(f'{name}: {e} ({failures} times in a row)')
+            end = time.monotonic()
+            stats.last_duration = end - now
+            stats.max_duration = max(stats.max_duration, stats.last_duration)
+            duration_seconds.observe(stats.last_duration)
+            index += 1
+            next_deadline = start + index * interval
+            if end <= next_deadline:
+                catch_up = 0
+                behind = False
+                continue
+            # overrun: 過ぎた開始時刻の数
+            missed = math.floor((end - next_deadline) / interval) + 1
+            # catch_upで続けて実行している間に過ぎた周期は、まだ数えていないもののみ加える。
+            stats.missed_count += index + missed - 1 - max(missed_index, index - 1)
+            missed_index = index + missed - 1
+            if not behind:
+                behind = True
+                stats.overrun_count += 1
+            if policy == self.CATCH_UP and catch_up < self.max_catch_up:
+                # 過ぎた周期を待たずに順に実行する。
+                catch_up += 1
+                stats.caught_up_count += 1
+                if catch_up == 1:
+                    self.logger.warning(f'{name}: overrun {end - next_deadline:.3f}s, catching up {missed} periods '
+                                        f'(total {stats.overrun_count})')
+                continue
+            catch_up = 0
+            if policy == self.COALESCE:
+                # 最後の過ぎた周期として直ちに1回実行する。開始時刻は元のまま。
+                missed -= 1
+            index += missed
+            stats.skipped_count += missed
+            self.logger.warning(f'{name}: overrun {end - next_deadline:.3f}s, '
+                                f'{missed} periods skipped ({policy}, total {stats.overrun_count})')
@@ -3,8 +3,11 @@ from datetime import datetime
 import json
 from logging import getLogger
 from soft_config import SoftConfig
-from os import walk, remove
+from os import walk
 from pathlib import Path
+from segment_log import SegmentManager
+from upload_manager import UploadManager
+from metrics import REGISTRY
 
 
 class FileProcess:
@@ -19,30 +22,11 @@ class FileProcess:
         self.logger = getLogger(__name__)
         self.file_config = file_config
         self.last_control_updatetime = None
-
-    def __get_system_data_file_name(self):
-        """
-        周期的に保存するpythonデータの保存先ファイル名を返す。
-        """
-        # ディレクトリ内のファイルを検索、ソート
-        file_names = []
-        for _, _, files in walk(self.file_config.system_data_path):
-            for name in files:
-                if self.file_config.system_data_name in name:
-                    file_names.append(name)
-        file_names = sorted(file_names)
-
-        if len(file_names) <= 0:
-            # ファイルが存在しない場合、作成する。
-            file_name = datetime.now().strftime('%Y%m%d%H%M%S') + '_' + \
-                self.file_config.system_data_name
-            file_names.append(file_name)
-        elif len(file_names) > \
-                self.file_config.system_data_file_num:
-            # ファイル数が上限を超えた場合、最も数字の若いファイルを削除。
-            remove(self.file_config.system_data_path +
-                   file_names.pop(0))
-        return self.file_config.system_data_path + file_names[-1]
+        self.__segments = None  # system_dataのセグメントの管理
+        self.__background_tasks = set()
+        self.__uploader = None
+        self.__save_seconds = REGISTRY.histogram('pvsw_save_system_data_seconds',
+                                                 'Time to append a system_data record.')
 
     async def __do_script(self, direction, local_dir_path, server_dir_path):
         """
@@ -55,63 +39,126 @@ class FileProcess:
         cmd += local_dir_path + '/ '
         # 3番目の引数 server directoryのパス(一部)
         cmd += server_dir_path + '/'
-        await asyncio.create_subprocess_shell(cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        with REGISTRY.histogram('pvsw_script_seconds', 'Time taken by the server sync script.',
+                                {'direction': direction}).time():
+            proc = await asyncio.create_subprocess_shell(cmd, stdout=asyncio.subprocess.PIPE,
+                                                         stderr=asyncio.subprocess.PIPE)
+            # 出力を読み捨てて終了を待つ。(プロセスを残さないため)
+            await proc.communicate()
+        if proc.returncode != 0:
+            REGISTRY.counter('pvsw_script_failures', 'Failed server sync script runs.', {'direction': direction}).inc()
+            self.logger.warning(f'script {direction} {server_dir_path} failed({proc.returncode})')
+
+    def __get_segment_manager(self):
+        """
+        初回の保存時にディレクトリを走査し、セグメントの管理を開始する。
+        """
+        if self.__segments is None:
+            self.__segments = SegmentManager(self.file_config.system_data_path,
+                                             self.file_config.system_data_name,
+                                             self.file_config.system_data_len,
+                                             self.file_config.system_data_file_num,
+                                             self.file_config.system_data_legacy_export)
+        return self.__segments
+
+    def __get_uploader(self):
+        """
+        system_dataのアップロードを管理するUploadManagerを返す。
+        """
+        if self.__uploader is None:
+            self.__uploader = UploadManager(
+                ['bash', self.file_config.script_path + self.file_config.script_name, '-U'], 'Data',
+                min_interval=self.file_config.system_data_upload_interval)
+        return self.__uploader
+
+    def needs_keyframe(self):
+        """
+        次に保存するレコードがセグメントの先頭になるか。
+        セグメント単独で値を復元できるよう、先頭は全ての値を保存する(keyframe)。
+        """
+        segments = self.__segments
+        return segments is None or segments.active is None or segments.active.count == 0
 
     async def save_system_data(self, master_dict):
-        self.logger.debug('save data.json')
+        """
+        system_dataをセグメントの末尾に1レコード追記する。
+        セグメントがsystem_data_len分に達したら封をして、次の保存から新しいセグメントに書き込む。
+        :return: 追記できたか
+        """
+        self.logger.debug('save data.jsonl')
         try:
-            system_file_name = self.__get_system_data_file_name()
-            # json.loadを行うためには'r+'で開く必要がある。
-            with open(system_file_name, 'r+', encoding='utf-8') as file:
-                try:
-                    # jsonデータをDict型で読み込む。(最後尾にデータを追加するため。)
-                    json_data = json.load(file)
-                except json.JSONDecodeError:
-                    # 読み込むjsonデータがおかしいときは、全てクリアする。
-                    self.logger.warning('json decode error. File cleared.')
-                    json_data = {}
-                file.seek(0)
-                file.truncate()
-                key = ''
-                # 最後尾を検索する。
-                for i in range(self.file_config.system_data_len):
-                    key = f'master_data_{i:08x}'
-                    if key not in json_data:
-                        break
-                # 最後尾の場合は次の更新のため、新しいファイルを生成する。
-                if key in f'master_data_{(self.file_config.system_data_len - 1):08x}':
-                    new_file_name = datetime.now().strftime('%Y%m%d%H%M%S') + \
-                        '_' + self.file_config.system_data_name
-                    with open(new_file_name, 'r+', encoding='utf-8') as file:
-                        # 空のjsonデータを格納
-                        json.dump({}, new_file_name, indent=4)
-                # 一旦ファイル内容を消去し、その後追加したデータを格納する。
-                json_data.update({key: master_dict})
-                self.logger.debug('dict add.')
-                json.dump(json_data, file, indent=4)
-            # スレーブとサーバのファイルを同期させる。
-            await self.__do_script('-U', self.file_config.system_data_path, 'Data')
-        except FileNotFoundError:
-            # ファイルが見つからない場合は作成する。
-            self.logger.info('create system_data.json')
-            with open(system_file_name, 'w', encoding='utf-8') as file:
-                json_data = {}
-                json.dump(json_data, file, indent=4)
+            with self.__save_seconds.time():
+                segments = self.__get_segment_manager()
+                (path, sealed) = segments.append(master_dict)
+            self.logger.debug('record appended.')
+        except Exception as e:
+            # 追記できない場合は記録し、呼び出し側で次のレコードを変化前の値と比べさせる。
+            self.logger.error('%s', e)
+            return False
+        try:
+            expired = segments.take_expired()
+            if len(expired) > 0:
+                # 保持数を超えたセグメントはバックグラウンドで削除する。
+                self.__start_background(asyncio.to_thread(segments.remove_files, expired))
+            for segment in segments.take_exports():
+                # 封をしたセグメントの従来形式での出力もバックグラウンドで行う。
+                self.__start_background(self.__export_legacy(segment))
+            # サーバへのアップロードを予約する。(転送はUploadManagerがまとめて行う。)
+            self.__get_uploader().mark_dirty(path, sealed)
         except Exception as e:
             # その他のエラーを記録する。
             self.logger.error('%s', e)
-          
+        return True
+
+    def __start_background(self, coroutine):
+        """
+        保存を待たせない処理をバックグラウンドで実行する。
+        """
+        task = asyncio.create_task(coroutine)
+        self.__background_tasks.add(task)
+        task.add_done_callback(self.__background_tasks.discard)
+
+    async def __export_legacy(self, segment):
+        """
+        封をしたセグメントを従来のdata.jsonの形式で出力する。
+        """
+        try:
+            with REGISTRY.histogram('pvsw_legacy_export_seconds',
+                                    'Time to export a sealed segment in the legacy format.').time():
+                legacy_path = await asyncio.to_thread(segment.export_legacy)
+            self.logger.debug(f'{legacy_path} exported.')
+            # 従来形式のファイルもサーバへアップロードする。
+            self.__get_uploader().mark_dirty(legacy_path, sealed=True)
+        except Exception as e:
+            self.logger.error('%s', e)
+
+    def stop(self):
+        """
+        アップロードとバックグラウンドの処理を停止する。
+        """
+        if self.__uploader is not None:
+            self.__uploader.stop()
+        for task in self.__background_tasks:
+            task.cancel()
+
+    async def fetch_control_files(self):
+        """
+        サーバ上にあるcontrolファイルをダウンロードする。
+        ダウンロードされたファイルはControlWatcherが検出し、load_control_fileで読み込む。
+        """
+        await self.__do_script('-D', self.file_config.control_path, 'Control')
+
     async def load_control_file(self):
         """
         config.jsonで指定されたものに年月日時秒を付与したファイルが存在したとき、
         そのファイルの命令に従い操作を実行する。
+        サーバとの同期は行わず、ローカルのファイルのみ確認する。
         """
-        await self.__do_script('-D', self.file_config.control_path, 'Control')
         file_names = []
-        # ディレクトリ内のファイルを検索
+        # ディレクトリ内のファイルを検索(rsyncの一時ファイルは除く)
         for _, _, files in walk(self.file_config.control_path):
             for name in files:
-                if self.file_config.control_name in name:
+                if self.file_config.control_name in name and not name.startswith('.'):
                     file_names.append(name)
         # 一致するファイルがない場合は、何もしない。
         if len(file_names) <= 0:
@@ -0,0 +1,266 @@
+import asyncio
+import math
+import mmap
+import os
+import struct
+import time
+import zlib
+from collections import deque
+from logging import getLogger
+from poll_scheduler import PollScheduler
+
+
+class FirmwareImage:
+    """
+    ダウンロードするファームウェアのイメージ
+    ファイルのパスの場合はmmapで開き、ブロックごとにmemoryviewで切り出して読む。(全体をリストにしない)
+    """
+    # イメージ全体のCRCを計算する単位(byte)
+    CRC_CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, source):
+        """
+        :param source: ファイルのパス、またはbytes-likeなバイナリデータ
+        """
+        self.__file = None
+        self.__mmap = None
+        if isinstance(source, (str, os.PathLike)):
+            self.__file = open(source, 'rb')
+            size = os.fstat(self.__file.fileno()).st_size
+            if size > 0:
+                self.__mmap = mmap.mmap(self.__file.fileno(), 0, access=mmap.ACCESS_READ)
+                self.view = memoryview(self.__mmap)
+            else:
+                self.view = memoryview(b'')
+        else:
+            self.view = memoryview(source).cast('B')
+        self.size = len(self.view)
+        self.crc = 0
+        for offset in range(0, self.size, self.CRC_CHUNK_SIZE):
+            self.crc = zlib.crc32(self.view[offset:offset + self.CRC_CHUNK_SIZE], self.crc)
+
+    def block(self, index, block_size):
+        """
+        index番目のブロックのmemoryviewを返す。
+        """
+        return self.view[index * block_size:(index + 1) * block_size]
+
+    def close(self):
+        self.view.release()
+        if self.__mmap is not None:
+            self.__mmap.close()
+        if self.__file is not None:
+            self.__file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class FirmwareDownloader:
+    """
+    slaveへのファームウェアのダウンロード
+    イメージをブロックに分け、1ブロックを1つのtransport protocol(RTS/CTS)のメッセージで送信する。
+    ブロックの大きさはCTSの窓(max_cmdt_packets)の整数倍とし、ブロックごとにCRCを付けてslaveの確認応答を待つ。
+    確認応答を待つブロックはwindowまでとし、失敗した場合は確認済みの次のブロックから送り直す。
+    開始時にslaveが受信済みのブロック数を返すため、中断したダウンロードはその続きから再開する。
+    複数のslaveへのダウンロードは並列に行い、全体の送信はバス使用率の上限に合わせて間隔を空ける。
+    要求('D' + 種類, 応答も同じ先頭2byte):
+        'DS': 大きさ(4byte), ブロックの大きさ(2byte), イメージのCRC32(4byte) -> 受信済みのブロック数(4byte)
+        'DB': ブロック番号(4byte), ブロックのCRC32(4byte), データ -> 'DA', ブロック番号(4byte), 結果(1byte)
+        'DE': ブロック数(4byte), イメージのCRC32(4byte) -> 結果(1byte)
+    結果は0が成功、それ以外は失敗(ブロックのCRCの不一致、順序の不一致、イメージのCRCの不一致)とする。
+    """
+    # 'DB'のヘッダ(pre_command 2byte + ブロック番号 4byte + CRC32 4byte)
+    HEADER_SIZE = 10
+    # 1ブロックのCTSの窓の数
+    BLOCK_WINDOWS = 16
+    # transport protocolで送信できる最大のメッセージ長(byte)
+    TP_MAX_SIZE = 1785
+    # 応答の結果
+    STATUS_OK = 0
+
+    def __init__(self, bitrate, max_cmdt_packets, bus_load_limit=0.3, window=2, retries=3,
+                 response_timeout=0.5, on_progress=None):
+        """
+        :param bitrate: CANのビットレート(bit/s)
+        :param max_cmdt_packets: J1939のCTS 1回あたりのパケット数
+        :param bus_load_limit: ダウンロードに使用するバス使用率の上限(0.0-1.0)
+        :param window: slave 1台あたり、確認応答を待たずに送信するブロック数
+        :param retries: 1ブロックを送り直す回数の上限
+        :param response_timeout: slaveの処理を待つ時間(sec)。ブロックの送信時間に加算する。
+        :param on_progress: 進捗を受け取る関数(address, 送信済みのbyte数, 全体のbyte数)
+        """
+        self.logger = getLogger(__name__)
+        self.bitrate = bitrate
+        self.bus_load_limit = bus_load_limit
+        self.window = window
+        self.retries = retries
+        self.response_timeout = response_timeout
+        self.on_progress = on_progress
+        self.block_size = min(max_cmdt_packets * 7 * self.BLOCK_WINDOWS, self.TP_MAX_SIZE) - self.HEADER_SIZE
+        self.__next_send_time = 0.0
+        # ダウンロード中のslaveのアドレス
+        self.__active = set()
+        # アドレス: 直近のダウンロードの結果
+        self.results = {}
+
+    def block_bits(self, size):
+        """
+        sizeバイトのブロックの送信と確認応答に使用するバスのビット数
+        """
+        return PollScheduler.FRAME_BITS * (PollScheduler.frames(self.HEADER_SIZE + size) + 1)
+
+    async def __reserve(self, bits):
+        """
+        全slaveへの送信がバス使用率の上限を超えないよう、送信を開始できる時刻まで待機する。
+        """
+        now = time.monotonic()
+        start = max(now, self.__next_send_time)
+        self.__next_send_time = start + bits / (self.bitrate * self.bus_load_limit)
+        if start > now:
+            await asyncio.sleep(start - now)
+
+    async def download_all(self, targets):
+        """
+        複数のslaveへ並列にダウンロードする。
+        :param targets: (PvswSlave, ファイルのパスまたはバイナリデータ)のリスト
+        :return: slaveごとの成否のリスト
+        """
+        return list(await asyncio.gather(*(self.download(slave, source) for (slave, source) in targets)))
+
+    async def download(self, slave, source):
+        """
+        slaveへファームウェアをダウンロードする。
+        :param slave: PvswSlave
+        :param source: ファイルのパス、またはbytes-likeなバイナリデータ
+        :return: 成功したか
+        """
+        address = slave.address
+        if address in self.__active:
+            self.logger.error(f'slave {address:02x}: download is already running')
+            return False
+        self.__active.add(address)
+        try:
+            with FirmwareImage(source) as image:
+                return await self.__download(slave, image)
+        except OSError as e:
+            self.logger.error('%s', e)
+            return False
+        finally:
+            self.__active.discard(address)
+
+    async def __download(self, slave, image):
+        address = slave.address
+        count = math.ceil(image.size / self.block_size)
+        start_time = time.monotonic()
+        result = {'size': image.size, 'blocks': count, 'resumed_from': 0, 'sent_bytes': 0, 'retries': 0,
+                  'elapsed': 0.0, 'throughput': 0.0, 'success': False}
+        self.results[address] = result
+        first = await self.__start(slave, image)
+        if first is None:
+            return False
+        if first > 0:
+            self.logger.info(f'slave {address:02x}: download resumed from block {first}/{count}')
+        result['resumed_from'] = first
+        acked = first
+        next_index = first
+        retry_count = 0
+        window = deque()
+        last_report = -1
+        try:
+            while acked < count:
+                while next_index < count and len(window) < self.window:
+                    window.append(asyncio.create_task(self.__send_block(slave, image, next_index)))
+                    result['sent_bytes'] += min(self.block_size, image.size - next_index * self.block_size)
+                    next_index += 1
+                if await window.popleft():
+                    acked += 1
+                    retry_count = 0
+                    done = min(acked * self.block_size, image.size)
+                    if self.on_progress is not None:
+                        self.on_progress(address, done, image.size)
+                    # 進捗は10%ごとにログへ出力する。
+                    percent = done * 10 // image.size
+                    if percent != last_report:
+                        last_report = percent
+                        self.logger.info(f'slave {address:02x}: download {done}/{image.size} bytes')
+                    continue
+                # slaveは順番どおりのブロックのみ受け付けるため、確認応答を待つブロックを破棄し、
+                # 確認済みの次のブロックから送り直す。
+                await asyncio.gather(*window)
+                window.clear()
+                next_index = acked
+                retry_count += 1
+                result['retries'] += 1
+                if retry_count > self.retries:
+                    self.logger.error(f'slave {address:02x}: download failed at block {acked}/{count}')
+                    self.__finish(result, start_time)
+                    return False
+        finally:
+            # キャンセルや例外で終了した場合も、送信中のブロックを止めてからイメージを閉じる。
+            for task in window:
+                task.cancel()
+            await asyncio.gather(*window, return_exceptions=True)
+        status = await self.__end(slave, count, image.crc)
+        result['success'] = status
+        self.__finish(result, start_time)
+        if status:
+            self.logger.info(f'slave {address:02x}: downloaded {image.size} bytes in {result["elapsed"]:.2f}s '
+                             f'({result["throughput"]:.0f} bytes/s, retries {result["retries"]})')
+        else:
+            self.logger.error(f'slave {address:02x}: image verification failed')
+        return status
+
+    @staticmethod
+    def __finish(result, start_time):
+        """
+        所要時間と、送り直しを含む送信量のスループット(bytes/s)を記録する。
+        """
+        result['elapsed'] = time.monotonic() - start_time
+        result['throughput'] = result['sent_bytes'] / result['elapsed'] if result['elapsed'] > 0.0 else 0.0
+
+    def __timeout(self, bits):
+        """
+        bitsの送信を待つ時間。同じslaveへの送信はwindow分の順番待ちを含む。
+        """
+        return self.response_timeout + self.window * bits / (self.bitrate * self.bus_load_limit)
+
+    async def __start(self, slave, image):
+        """
+        ダウンロードを開始する。
+        :return: slaveが受信済みのブロック数。応答がない場合はNone
+        """
+        data = list(b'DS' + struct.pack('<IHI', image.size, self.block_size, image.crc))
+        for _ in range(self.retries + 1):
+            await self.__reserve(self.block_bits(len(data)))
+            reply = await slave.request(b'DS', data, timeout=self.__timeout(self.block_bits(len(data))))
+            if reply is not None and len(reply) >= 4:
+                return min(struct.unpack('<I', bytes(reply[:4]))[0], math.ceil(image.size / self.block_size))
+        self.logger.error(f'slave {slave.address:02x}: download is not accepted')
+        return None
+
+    async def __send_block(self, slave, image, index):
+        """
+        ブロックを送信し、確認応答を待つ。
+        イメージのmemoryviewは送信データを作成した時点で解放し、待機中は保持しない。(mmapを閉じられるように)
+        :return: 成功したか
+        """
+        with image.block(index, self.block_size) as block:
+            size = len(block)
+            data = list(b'DB' + struct.pack('<II', index, zlib.crc32(block)) + block)
+        bits = self.block_bits(size)
+        await self.__reserve(bits)
+        reply = await slave.request(b'DA' + struct.pack('<I', index), data, timeout=self.__timeout(bits))
+        return reply is not None and len(reply) >= 1 and reply[0] == self.STATUS_OK
+
+    async def __end(self, slave, count, crc):
+        """
+        ダウンロードを終了し、slaveにイメージ全体のCRCを確認させる。
+        """
+        data = list(b'DE' + struct.pack('<II', count, crc))
+        await self.__reserve(self.block_bits(len(data)))
+        reply = await slave.request(b'DE', data, timeout=self.__timeout(self.block_bits(len(data))))
+        return reply is not None and len(reply) >= 1 and reply[0] == self.STATUS_OK
@@ -1,5 +1,8 @@
+import asyncio
 from logging import getLogger
 from enum import IntEnum
+from gpiozero import DigitalInputDevice
+import numpy as np
 import spidev
 import time
 
@@ -14,6 +17,9 @@ class LIS2DH12:
     TEMP_MAX    = 85.0
     INT1_GPIO   = 26
     ACCEL_G     = 9.80665
+    FIFO_SIZE   = 32
+    # 出力データレート(Hz)とCTRL_REG1のODR[3:0]の対応
+    ODR = {1: 0x1, 10: 0x2, 25: 0x3, 50: 0x4, 100: 0x5, 200: 0x6, 400: 0x7}
 
     class REG(IntEnum):
         """
@@ -41,8 +47,19 @@ class LIS2DH12:
         FIFO_CTRL_REG   = 0x2E
         FIFO_SRC_REG    = 0x2F
 
-    def __init__(self):
+    def __init__(self, odr=100):
+        """
+        :param odr: 出力データレート(Hz)。ODRのキーのいずれか。
+        """
         self.logger = getLogger(__name__)
+        self.odr = odr
+        # FIFOが満杯(32個)になり、データを取りこぼした可能性のある回数
+        self.overrun_count = 0
+        self.__int1 = None
+        self.__int1_event = None
+        # INT1のレベル(エッジの通知で更新する。イベントループ上でgpioを読まないため)
+        self.__int1_level = False
+        self.__loop = None
         self.spi = spidev.SpiDev()
         self.spi.open(1, 0)
         self.spi.max_speed_hz = 500000
@@ -51,10 +68,12 @@ class LIS2DH12:
         time.sleep(0.05)
         # FIFO enable
         self.__write(self.REG.CTRL_REG5, [0x40])
-        # 100Hz, enable XYZ
-        self.__write(self.REG.CTRL_REG1, [0x57])
+        # ODR, enable XYZ
+        self.__write(self.REG.CTRL_REG1, [(self.ODR[odr] << 4) | 0x07])
         # HR, +-2g, set BDU for temp
         self.max_g = 2.0
+        # 生データ(int16)から重力加速度(m/s^2)への変換係数
+        self.__accel_scale = self.max_g * self.ACCEL_G / 0x7FFF
         self.__write(self.REG.CTRL_REG4, [0x08])
         # TEMP enable
         self.__write(self.REG.TEMP_CFG_REG, [0xC0])
@@ -98,7 +117,10 @@ class LIS2DH12:
         data = self.__read(self.REG.FIFO_SRC_REG)
         if (data[0] & 0x40) > 0:
             # ovrnのときは32個のデータがfifoに残留している。
-            return 32
+            # 次のサンプルで最古のデータが上書きされるため、取りこぼしとして数える。
+            self.overrun_count += 1
+            self.logger.warning(f'fifo overrun:{self.overrun_count:0}')
+            return self.FIFO_SIZE
         return data[0] & 0x1F
 
     def get_accel(self):
@@ -111,21 +133,73 @@ class LIS2DH12:
         z_data = self.__conv_accel(z_data)
         return x_data, y_data, z_data
 
-    def get_accel_array(self) -> ([], [], []):
+    def get_accel_array(self) -> (np.ndarray, np.ndarray, np.ndarray):
         """
         FIFOに溜まっているデータを配列状にして返す。
+        FIFO有効時はOUT_Z_Hの次がOUT_X_Lに戻るため、
+        FIFOの全データを1回のSPI転送(自動インクリメント)で読み出す。
         """
         fifo_len = self.__fifo_len()
-        # self.logger.info(f'fifo len is {fifo_len:0}')
-        x_array, y_array, z_array = [], [], []
-        for i in range(fifo_len):
-            (x, y, z) = self.get_accel()
-            x_array.append(x)
-            y_array.append(y)
-            z_array.append(z)
-        # self.logger.debug(f'X:{x_array[0]:0} Y:{y_array[0]:0} Z:{z_array[0]:0}')
         self.logger.debug(f'fifo_len:{fifo_len:0}')
-        return (x_array, y_array, z_array)
+        if fifo_len <= 0:
+            empty = np.empty(0)
+            return (empty, empty, empty)
+        data = self.__read(self.REG.OUT_X_L, 6 * fifo_len)
+        # X_L, X_H, Y_L, Y_H, Z_L, Z_Hの順に並んだリトルエンディアンの符号付き16bit
+        raw = np.frombuffer(bytes(data), dtype='<i2').reshape(fifo_len, 3)
+        accel = raw.T * self.__accel_scale
+        return (accel[0], accel[1], accel[2])
+
+    def enable_fifo_interrupt(self, watermark=16, pin_factory=None):
+        """
+        FIFOのウォーターマークをINT1へ出力し、割り込みでデータを取得できるようにする。
+        :param watermark: INT1をアクティブにするFIFOのデータ数(1-31)
+        :param pin_factory: gpiozeroのpin factory。試験時はMockFactoryを指定する。
+        """
+        self.watermark = watermark
+        # WTMをINT1へ出力
+        self.__write(self.REG.CTRL_REG3, [0x04])
+        # Stream mode + watermark
+        self.__write(self.REG.FIFO_CTRL_REG, [0x80 | (watermark & 0x1F)])
+        self.__int1_event = asyncio.Event()
+        self.__int1 = DigitalInputDevice(self.INT1_GPIO, pull_up=False, pin_factory=pin_factory)
+        self.__int1.when_activated = self.__on_int1
+        self.__int1.when_deactivated = self.__on_int1_released
+        self.__int1_level = self.__int1.is_active
+
+    def __on_int1(self):
+        """
+        INT1の立ち上がりで、gpiozeroのスレッドから呼ばれる。
+        """
+        self.__int1_level = True
+        if self.__loop is not None and not self.__loop.is_closed():
+            self.__loop.call_soon_threadsafe(self.__int1_event.set)
+
+    def __on_int1_released(self):
+        """
+        INT1の立ち下がりで、gpiozeroのスレッドから呼ばれる。
+        """
+        self.__int1_level = False
+
+    async def wait_accel_array(self, io=None) -> (np.ndarray, np.ndarray, np.ndarray):
+        """
+        ウォーターマークに達するまで待機し、FIFOに溜まっているデータを返す。
+        enable_fifo_interrupt()の呼び出しが必要。
+        割り込みを取りこぼした場合に備え、ウォーターマーク2回分の時間で読み出しを行う。
+        :param io: SPIのBusExecutor。指定した場合はFIFOの読み出しをそのスレッドで行う。
+        """
+        self.__loop = asyncio.get_running_loop()
+        # INT1はレベル信号なので、既にアクティブであれば待たずに読み出す。
+        # レベルはエッジの通知で記録したものを使い、イベントループ上でgpioを読まない。
+        if not self.__int1_level:
+            try:
+                await asyncio.wait_for(self.__int1_event.wait(), 2.0 * self.watermark / self.odr)
+            except TimeoutError:
+                self.logger.debug('int1 timeout')
+        self.__int1_event.clear()
+        if io is not None:
+            return await io.call('lis2dh12', self.get_accel_array)
+        return self.get_accel_array()
 
     def get_temp(self):
         """
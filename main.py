@@ -1,12 +1,11 @@
-import asyncio
 import time
-import sys
+# 起動時間の計測の基準(モジュールの読み込みを含める。)
+START_TIME = time.perf_counter()
+import argparse
+import asyncio
 import json
 from logging import getLogger, config
 from pvsw_master import PvswMaster
-from lis2dh12 import LIS2DH12
-from seismometer import Seismometer
-import pandas as pd
 
 
 def set_logger(name=None):
@@ -18,33 +17,22 @@ def set_logger(name=None):
 
 
 if __name__ == "__main__":
-    # コンソールの標準入力より、停止時間を定めることが出来る。
-    args = sys.argv
+    # コンソールの引数より、停止時間を定めることが出来る。
+    parser = argparse.ArgumentParser()
+    parser.add_argument('delay', nargs='?', type=float, default=0.0,
+                        help='停止までの時間(sec)。0の場合は停止しない。')
+    # ハードウェアなしで動作させる場合は、K-NET形式のCSVを再生する。
+    parser.add_argument('--replay', help='LIS2DH12の代わりに再生するK-NET形式のCSV')
+    parser.add_argument('--speed', type=float, default=1.0, help='再生速度(実時間の何倍か)')
+    args = parser.parse_args()
     set_logger()
-    pvsw = PvswMaster()
-    # #標準入力にデータが入っている場合のみ入力する。
-    delay = float(args[1]) if len(args) == 2 else 0.0
-    asyncio.run(pvsw.start(delay))
-
-    # seismometer = Seismometer(fs = 10.0)
-
-    # df = pd.read_csv('./TestData/AA06EA01.csv', skiprows=6,
-    #                  skipinitialspace=True)
-    # scale_list = []
-    # iter = 0
-    # start = end = 0.0
-    # loop = asyncio.get_event_loop()
-    # for x, y, z in zip(df['NS'], df['EW'], df['UD']):
-    #     if iter % 5 == 0:
-    #         seismometer.set_accel_data(x, y, z)
-    #     if iter % 500 == 0:
-    #         start = time.time()
-    #         is_full, scale = asyncio.run(seismometer.get_scale())
-    #         scale_list.append(scale)
-    #         end = time.time()
-    #         print(f'time: {end - start:0} bool: {is_full:0}')
-    #     iter += 1
-    # print(max(scale_list))
+    if args.replay is not None:
+        from sensor_replay import ReplayAccelSensor, ReplayWetSensor
+        pvsw = PvswMaster(accel_sensor=ReplayAccelSensor(args.replay, speed=args.speed),
+                          wet_sensor=ReplayWetSensor(speed=args.speed), start_time=START_TIME)
+    else:
+        pvsw = PvswMaster(start_time=START_TIME)
+    asyncio.run(pvsw.start(args.delay))
 
     # acc_ic = LIS2DH12()
     # while(True):
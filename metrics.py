@@ -0,0 +1,238 @@
+import asyncio
+import math
+import os
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from logging import getLogger
+
+
+class Counter:
+    """
+    増加のみする値。functionを指定した場合は、出力時にその戻り値(既存の記録)を値とする。
+    """
+    TYPE = 'counter'
+
+    def __init__(self, function=None):
+        self.value = 0
+        self.function = function
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self, name, labels):
+        value = self.function() if self.function is not None else self.value
+        yield (name + '_total', labels, value)
+
+
+class Gauge(Counter):
+    """
+    増減する値。functionを指定した場合は、出力時にその戻り値を値とする。
+    """
+    TYPE = 'gauge'
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self, name, labels):
+        value = self.function() if self.function is not None else self.value
+        yield (name, labels, value)
+
+
+class Histogram:
+    """
+    固定のバケットのヒストグラム
+    記録は境界の二分探索と加算のみのため、常時有効にしても負荷は小さい。
+    """
+    TYPE = 'histogram'
+    # 処理時間(sec)の既定のバケットの上限
+    DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        # バケットごとの数(累積ではない)。最後は+Inf
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    @contextmanager
+    def time(self):
+        """
+        withブロックの処理時間(sec)を記録する。
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def samples(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), self.counts):
+            cumulative += count
+            yield (name + '_bucket', labels + (('le', MetricsRegistry.format_value(bound)),), cumulative)
+        yield (name + '_sum', labels, self.sum)
+        yield (name + '_count', labels, self.count)
+
+
+class MetricsRegistry:
+    """
+    プロセス内のメトリクス(counter, gauge, histogram)を保持し、Prometheusのテキスト形式で出力する。
+    同じ名前・ラベルのメトリクスは1つのみ作成し、2回目以降は同じものを返す。
+    """
+
+    def __init__(self):
+        # 名前: (種類, 説明, {ラベルのタプル: メトリクス})
+        self.__families = {}
+
+    def __get(self, cls, name, help_text, labels, factory):
+        family = self.__families.get(name)
+        if family is None:
+            family = (cls.TYPE, help_text, {})
+            self.__families[name] = family
+        key = tuple(sorted((labels or {}).items()))
+        metric = family[2].get(key)
+        if metric is None:
+            metric = factory()
+            family[2][key] = metric
+        return metric
+
+    def counter(self, name, help_text, labels=None, function=None):
+        """
+        :param name: 名前(出力時は末尾に_totalを付ける)
+        :param help_text: 説明
+        :param labels: ラベルのdict
+        :param function: 値を返す関数。既存の記録(xxx_countなど)をそのまま出力する場合に指定する。
+        """
+        counter = self.__get(Counter, name, help_text, labels, lambda: Counter(function))
+        if function is not None:
+            counter.function = function
+        return counter
+
+    def gauge(self, name, help_text, labels=None, function=None):
+        gauge = self.__get(Gauge, name, help_text, labels, lambda: Gauge(function))
+        if function is not None:
+            gauge.function = function
+        return gauge
+
+    def histogram(self, name, help_text, labels=None, buckets=Histogram.DEFAULT_BUCKETS):
+        return self.__get(Histogram, name, help_text, labels, lambda: Histogram(buckets))
+
+    @staticmethod
+    def format_value(value):
+        if value == math.inf:
+            return '+Inf'
+        if isinstance(value, float):
+            return repr(value)
+        return str(value)
+
+    @staticmethod
+    def __escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    def render(self):
+        """
+        Prometheusのテキスト形式の文字列を返す。値を返す関数の例外は記録し、そのメトリクスのみ省略する。
+        """
+        lines = []
+        for name, (kind, help_text, metrics) in self.__families.items():
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, metric in metrics.items():
+                try:
+                    samples = list(metric.samples(name, labels))
+                except Exception as e:
+                    getLogger(__name__).warning(f'metrics {name}: {e}')
+                    continue
+                for (sample_name, sample_labels, value) in samples:
+                    if len(sample_labels) > 0:
+                        label_text = ','.join(f'{key}="{self.__escape(value)}"' for key, value in sample_labels)
+                        sample_name += '{' + label_text + '}'
+                    lines.append(f'{sample_name} {self.format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+# プロセス全体で共有するレジストリ
+REGISTRY = MetricsRegistry()
+
+
+class MetricsExporter:
+    """
+    メトリクスをファイル(node_exporterのtextfile collector形式)に出力し、
+    http_portを指定した場合はローカルのHTTP(GET /metrics)でも提供する。
+    """
+
+    def __init__(self, path, registry=REGISTRY, http_host='127.0.0.1', http_port=0):
+        """
+        :param path: 出力するファイルのパス(例: /home/pi/App/Data/metrics.prom)
+        :param registry: MetricsRegistry
+        :param http_host: HTTPで待ち受けるアドレス
+        :param http_port: HTTPで待ち受けるポート。0の場合はHTTPで提供しない。
+        """
+        self.logger = getLogger(__name__)
+        self.path = str(path)
+        self.registry = registry
+        self.http_host = http_host
+        self.http_port = http_port
+        self.__server = None
+
+    def write_file(self, text):
+        """
+        途中まで書き込んだファイルを読まれないよう、一時ファイルに書き込んでから置き換える。(別スレッドで呼ぶ)
+        """
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            file.write(text)
+        os.replace(tmp_path, self.path)
+
+    async def export(self):
+        """
+        メトリクスをファイルに出力する。文字列の作成はイベントループ上、書き込みは別スレッドで行う。
+        """
+        try:
+            await asyncio.to_thread(self.write_file, self.registry.render())
+        except OSError as e:
+            self.logger.error('%s', e)
+
+    async def start_http(self):
+        """
+        HTTPでの提供を開始する。
+        """
+        if self.http_port <= 0 or self.__server is not None:
+            return
+        try:
+            self.__server = await asyncio.start_server(self.__handle, self.http_host, self.http_port)
+            self.logger.info(f'metrics http://{self.http_host}:{self.http_port}/metrics')
+        except OSError as e:
+            self.logger.error('%s', e)
+
+    async def __handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 5.0)
+            # ヘッダは読み捨てる。
+            while (await asyncio.wait_for(reader.readline(), 5.0)) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] in ('/', '/metrics'):
+                body = self.registry.render().encode('utf-8')
+                header = ('HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                          f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n')
+            else:
+                body = b'not found\n'
+                header = f'HTTP/1.1 404 Not Found\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n'
+            writer.write(header.encode('latin-1') + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError) as e:
+            self.logger.debug('%s', e)
+        finally:
+            writer.close()
+
+    def stop(self):
+        if self.__server is not None:
+            self.__server.close()
+            self.__server = None
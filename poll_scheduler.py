@@ -0,0 +1,182 @@
+import asyncio
+import math
+import time
+from logging import getLogger
+from metrics import REGISTRY
+
+
+class PollItem:
+    """
+    周期的に読み出すslaveのパラメータ1つ分
+    """
+    __slots__ = ('slave', 'slot', 'freshness', 'last_time')
+
+    def __init__(self, slave, slot, freshness):
+        """
+        :param slave: PvswSlave
+        :param slot: パラメータのParamSlot
+        :param freshness: 値が古くなったとみなす時間(sec)
+        """
+        self.slave = slave
+        self.slot = slot
+        self.freshness = freshness
+        self.last_time = -math.inf
+
+    def urgency(self, now):
+        """
+        freshnessに対する経過時間の比。大きいほど優先して読み出す。
+        """
+        return (now - self.last_time) / self.freshness
+
+
+class PollScheduler:
+    """
+    全slaveのパラメータの読み出しを、CANバスの使用率の上限内で並列に行う。
+    古くなった(freshnessに対する経過時間の比が大きい)パラメータから読み出し、
+    上限を超える分は次の周期へ回す。送信は使用率の上限に合わせて間隔を空けて開始し、
+    応答待ちはslaveごとのpipelineで並列に行う。
+    'BR'に対応したslaveは、batch_sizeまでのパラメータを1回の要求にまとめる。
+    """
+    # 拡張フォーマット・データ8byteのフレームのビット数(ビットスタッフィングの最悪値を含む)
+    FRAME_BITS = 160
+    # 'BR'の応答の値1つの大きさ(byte)。strは見積もり
+    VALUE_SIZE = 4
+
+    def __init__(self, bitrate, bus_load_limit=0.5, default_freshness=5.0):
+        """
+        :param bitrate: CANのビットレート(bit/s)
+        :param bus_load_limit: 読み出しに使用するバス使用率の上限(0.0-1.0)
+        :param default_freshness: freshnessが指定されていないパラメータのfreshness(sec)
+        """
+        self.logger = getLogger(__name__)
+        self.bitrate = bitrate
+        self.bus_load_limit = bus_load_limit
+        self.default_freshness = default_freshness
+        self.__items = []
+        self.__last_end_time = None
+        # 直前の周期の記録
+        self.cycle_time = 0.0
+        self.bus_load = 0.0
+        self.poll_count = 0
+        self.transaction_count = 0
+        self.failure_count = 0
+        self.deferred_count = 0
+        self.__cycle_seconds = REGISTRY.histogram('pvsw_poll_cycle_seconds', 'Time to poll the slaves in one cycle.')
+        REGISTRY.gauge('pvsw_poll_bus_load', 'CAN bus load of the last poll cycle (0-1).', function=lambda: self.bus_load)
+        REGISTRY.gauge('pvsw_poll_params', 'Parameters read in the last poll cycle.', function=lambda: self.poll_count)
+        REGISTRY.gauge('pvsw_poll_deferred', 'Parameters deferred to the next poll cycle.',
+                       function=lambda: self.deferred_count)
+        REGISTRY.gauge('pvsw_poll_failures', 'Parameters failed in the last poll cycle.',
+                       function=lambda: self.failure_count)
+
+    @staticmethod
+    def frames(size):
+        """
+        sizeバイトのメッセージの送信に必要なフレーム数
+        9byte以上はtransport protocol(RTS, CTS, データ7byteずつ, EndOfMsgAck)で送信される。
+        """
+        if size <= 8:
+            return 1
+        return math.ceil(size / 7) + 3
+
+    def transaction_bits(self, count):
+        """
+        count個のパラメータを1回で読み出す場合のバスのビット数(要求 + 応答)
+        """
+        if count == 1:
+            return self.FRAME_BITS * 2
+        request = 3 + 2 * count
+        reply = 3 + self.VALUE_SIZE * count
+        return self.FRAME_BITS * (self.frames(request) + self.frames(reply))
+
+    def add_slave(self, slave, slots):
+        """
+        slaveの読み出すパラメータを登録する。
+        パラメータのdictに'freshness'(sec)があれば、その間隔で読み出す。
+        :param slave: PvswSlave
+        :param slots: slaveのパラメータのParamSlotのリスト。commandを持つもののみ読み出す。
+        """
+        for slot in slots:
+            if slot.command is None:
+                continue
+            freshness = slot.node.get('freshness', self.default_freshness)
+            self.__items.append(PollItem(slave, slot, freshness))
+
+    def __plan(self, now, deadline):
+        """
+        この周期の読み出しを優先度順に決める。
+        次の周期までにfreshnessを超えるものが対象で、deadline内に使用率の上限で送れるビット数までとする。
+        :return: ([(slave, [PollItem, ...], ビット数), ...], 次の周期へ回した数)
+        """
+        due = [item for item in self.__items if now - item.last_time + deadline >= item.freshness]
+        due.sort(key=lambda item: item.urgency(now), reverse=True)
+        budget = deadline * self.bitrate * self.bus_load_limit
+        transactions = []
+        open_batches = {}  # slave: 追加中のtransaction
+        used = 0
+        deferred = 0
+        for item in due:
+            slave = item.slave
+            batch_size = slave.batch_size if slave.batch_supported is not False else 1
+            transaction = open_batches.get(slave)
+            if transaction is not None and len(transaction[1]) < batch_size:
+                cost = self.transaction_bits(len(transaction[1]) + 1) - transaction[2]
+            else:
+                transaction = None
+                cost = self.transaction_bits(1)
+            # 1つ目は上限を超えても読み出す。
+            if used + cost > budget and len(transactions) > 0:
+                deferred += 1
+                continue
+            used += cost
+            if transaction is None:
+                transaction = [slave, [], 0]
+                transactions.append(transaction)
+                open_batches[slave] = transaction
+            transaction[1].append(item)
+            transaction[2] += cost
+        return (transactions, deferred)
+
+    async def poll(self, deadline):
+        """
+        1周期分の読み出しを行う。
+        :param deadline: 読み出しに使用できる時間(sec)
+        """
+        start = time.monotonic()
+        (transactions, deferred) = self.__plan(start, deadline)
+        rate = self.bitrate * self.bus_load_limit
+        tasks = []
+        bits = 0
+        for (slave, items, cost) in transactions:
+            tasks.append(self.__poll_transaction(slave, items, start + bits / rate))
+            bits += cost
+        results = await asyncio.gather(*tasks)
+        end = time.monotonic()
+        # 使用率は前の周期の終了からの時間(この周期の送信を全て含む)で計算する。最初の周期はdeadlineとする。
+        elapsed = end - self.__last_end_time if self.__last_end_time is not None else max(end - start, deadline)
+        self.__last_end_time = end
+        self.cycle_time = end - start
+        self.__cycle_seconds.observe(self.cycle_time)
+        self.poll_count = sum(len(items) for (_, items, _) in transactions)
+        self.transaction_count = len(transactions)
+        self.failure_count = sum(result.count(False) for result in results)
+        self.deferred_count = deferred
+        self.bus_load = bits / (elapsed * self.bitrate) if elapsed > 0.0 else 0.0
+        self.logger.debug(f'poll {self.poll_count} params by {self.transaction_count} requests in {self.cycle_time:.3f}s '
+                          f'(bus load {self.bus_load:.1%}, failed {self.failure_count}, deferred {deferred})')
+        if deferred > 0 or self.cycle_time > deadline:
+            self.logger.warning(f'poll over budget: {self.cycle_time:.3f}s/{deadline:.3f}s, deferred {deferred}')
+
+    async def __poll_transaction(self, slave, items, start_time):
+        """
+        start_timeまで待機してから、itemsを1回の要求で読み出す。
+        """
+        delay = start_time - time.monotonic()
+        if delay > 0.0:
+            await asyncio.sleep(delay)
+        results = await slave.send_batch(['B', 'R'], [item.slot.node for item in items])
+        now = time.monotonic()
+        for item, result in zip(items, results):
+            if result:
+                item.last_time = now
+        return results
@@ -1,20 +1,18 @@
 import asyncio
 import re
+import time
 from datetime import datetime
-from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from enum import IntEnum
-from os import remove
 from logging import getLogger
-from typing import List
-from adc081c021 import ADC081C021
-from can_communication import CanCommunication
 from file_process import FileProcess
+from control_watcher import ControlWatcher
 from soft_config import SoftConfig
-from seismometer import Seismometer
-from pvsw_slave import PvswSlave
+from seismometer import Seismometer, ScaleExecutor
+from poll_scheduler import PollScheduler
+from deadline_scheduler import DeadlineScheduler
+from bus_executor import BusExecutor
+from metrics import REGISTRY, MetricsExporter
 from pvsw_parameter import PvswParam
-from pathlib import Path
-from gpiozero import LED, Button
 
 
 class PvswMaster:
@@ -32,37 +30,116 @@ class PvswMaster:
         AlmWater    = -1
         AlmSeismic  = -2
 
-    def __init__(self):
+    class MainParam:
+        """
+        mainParameterのうち、周期処理で参照するもののslot
+        """
+        __slots__ = ('time', 'status', 'temperature', 'ac_in', 'in_24V', 'en_24V', 'reset',
+                     'seismometer', 'wet', 'seismic_threshold', 'wet_threshold')
+
+        def __init__(self, pvsw_param):
+            for name in self.__slots__:
+                setattr(self, name, pvsw_param.handle('mainParameter', name))
+
+    def __init__(self, accel_sensor=None, wet_sensor=None, start_time=None):
         """
         Masterを起動。設定ファイル等を読み込む。
+        ハードウェアの初期化は時間がかかるため、start()で並列に行う。
+        :param accel_sensor: LIS2DH12の代わりに使用する加速度センサ(ReplayAccelSensorなど)
+        :param wet_sensor: ADC081C021の代わりに使用する水センサ(ReplayWetSensorなど)
+        :param start_time: 起動時間の計測の基準(time.perf_counter())。Noneの場合はこの時点とする。
         """
         self.logger = getLogger(__name__)
+        self.__start_time = start_time if start_time is not None else time.perf_counter()
+        # 起動の各段階の完了時間(sec)
+        self.startup_times = {}
+        self.__soft_config = SoftConfig()
         # accel ic
-        self.__seismometer = Seismometer(fs=100.0, window_sec=5.12)
+        # 計測震度の計算はイベントループ外で行い、センサの読み出しを妨げないようにする。
+        scale_executor = self.__soft_config.pvsw_config.scale_executor
+        self.__scale_executor = None if scale_executor == 'none' else ScaleExecutor(scale_executor)
+        # SPI, I2C, gpioの読み書きはバスごとのスレッドで行い、イベントループを止めない。
+        threaded = self.__soft_config.pvsw_config.io_executor == 'thread'
+        self.__io = {bus: BusExecutor(bus, threaded=threaded) for bus in ('spi', 'i2c', 'gpio')}
+        self.__accel_sensor = accel_sensor
+        self.__seismometer = None
         # water adc
-        self.__wet_sensor = ADC081C021()
+        self.__wet_sensor = wet_sensor
         # can parameter
-        self.__soft_config = SoftConfig()
         self.__address = self.__soft_config.j1939_config.master_address
         self.__bitrate = self.__soft_config.can_config.bitrate
         self.__bustype = self.__soft_config.can_config.bustype
         self.__channel = self.__soft_config.can_config.channel
         self.__master_interval_time = self.__soft_config.pvsw_config.master_interval_time
         self.__control_filecheck_interval_time = self.__soft_config.pvsw_config.control_filecheck_interval_time
+        self.__remote_fetch_interval_time = self.__soft_config.pvsw_config.remote_fetch_interval_time
         self.__accel_sensor_interval_time = self.__soft_config.pvsw_config.accel_sensor_interval_time
+        self.__accel_interrupt = self.__soft_config.pvsw_config.accel_acquisition_mode == 'interrupt'
         self.__system_data_len = self.__soft_config.file_config.system_data_len
         # file操作を司る.
         self.__file_process = FileProcess(self.__soft_config.file_config)
         # parameter類を読み込む
         self.pvsw_param = PvswParam(self.__soft_config.file_config)
+        self.__main = self.MainParam(self.pvsw_param)
         # master内のステータスデータを設定する。
-        self.pvsw_param.param['parameters']['mainParameter']['parameters']['temperature']['type']['value'] = 31.5
-        self.pvsw_param.param['parameters']['mainParameter']['parameters']['ac_in']['type']['value'] = 1
-        self.pvsw_param.param['parameters']['mainParameter']['parameters']['en_24V']['type']['value'] = 0
-        self.pvsw_param.param['parameters']['mainParameter']['parameters']['wet']['type']['value'] = 0
+        self.__main.temperature.value = 31.5
+        self.__main.ac_in.value = 1
+        self.__main.en_24V.value = 0
+        self.__main.wet.value = 0
         self.__tasks = []
         self.__slaves = []
-        # gpioの設定
+        self.__can_communication = None
+        self.__firmware_downloader = None
+        # 周期タスクは絶対的な期限で実行し、1つのタスクの失敗で他を止めない。
+        self.__deadline_scheduler = DeadlineScheduler()
+        # メトリクスはData directoryへ周期的に出力し、ポートを指定した場合はHTTPでも提供する。
+        pvsw_config = self.__soft_config.pvsw_config
+        self.__metrics_exporter = MetricsExporter(
+            f'{self.__soft_config.file_config.system_data_path}/{pvsw_config.metrics_file_name}',
+            http_port=pvsw_config.metrics_http_port)
+        REGISTRY.gauge('pvsw_status', 'Master alarm status.', function=lambda: self.__main.status.value)
+        # slaveのパラメータはバス使用率の上限内で並列に読み出す。
+        self.__poll_scheduler = PollScheduler(self.__bitrate,
+                                              bus_load_limit=self.__soft_config.pvsw_config.slave_bus_load_limit,
+                                              default_freshness=self.__master_interval_time)
+        self.__mark_startup('config')
+
+    def __mark_startup(self, stage):
+        """
+        起動の段階の完了時間を記録する。
+        """
+        self.startup_times[stage] = time.perf_counter() - self.__start_time
+        REGISTRY.gauge('pvsw_startup_seconds', 'Time from process start to each startup stage.',
+                       {'stage': stage}).set(self.startup_times[stage])
+        self.logger.info(f'startup {stage}: {self.startup_times[stage]:.3f}s')
+        if stage == 'first_alarm_cycle':
+            self.logger.info('startup report: ' + ', '.join(f'{name} {elapsed:.3f}s'
+                                                            for name, elapsed in self.startup_times.items()))
+
+    def __init_sensors(self):
+        """
+        センサとgpioを初期化する。(別スレッドで呼ぶ)
+        """
+        self.__seismometer = Seismometer(fs=100.0, window_sec=5.12,
+                                         mode=self.__soft_config.pvsw_config.seismometer_mode,
+                                         executor=self.__scale_executor,
+                                         sensor=self.__accel_sensor,
+                                         io=self.__io['spi'])
+        # 加速度センサを割り込みで取得する場合は、FIFOウォーターマークをINT1に出力する。
+        if self.__accel_interrupt:
+            self.__seismometer.lis2dh12.enable_fifo_interrupt(self.__soft_config.pvsw_config.accel_fifo_watermark)
+        if self.__wet_sensor is None:
+            from adc081c021 import ADC081C021
+            self.__wet_sensor = ADC081C021()
+        sensor = self.__seismometer.lis2dh12
+        REGISTRY.counter('pvsw_accel_fifo_overruns', 'Accelerometer FIFO overruns.',
+                         function=lambda: getattr(sensor, 'overrun_count', 0))
+
+    def __init_gpio(self):
+        """
+        gpioを初期化する。(別スレッドで呼ぶ)
+        """
+        from gpiozero import LED, Button
         self.__dc24V_en = LED(self.DC24V_EN_GPIO)
         self.__dc24V_en.off()
         self.__dc24V_in = Button(self.DC24V_IN_GPIO)
@@ -70,18 +147,54 @@ class PvswMaster:
         self.__reset_button = Button(self.J5_GPIO)
         self.__led2_gpio = LED(self.LED2_GPIO)
         self.__led2_gpio.off()
+
+    async def __init_can(self):
+        """
+        CAN通信とslaveを初期化する。センサ・アラームの処理はこの完了を待たない。
+        """
         # CAN通信を行う。
+        # from can_communication import CanCommunication
+        # from pvsw_slave import PvswSlave
         # self.__can_communication = CanCommunication(self.__soft_config.can_config, self.__soft_config.j1939_config)
-        self.__can_communication = None 
+        # await self.__can_communication.start()
         # 試験用:スレーブを追加する。
-        # self.__slaves.append(PvswSlave(self.__can_communication, self.pvsw_param.param['parameters']['slave_0001']))
+        # self.__slaves.append(PvswSlave(self.__can_communication, self.pvsw_param.param['parameters']['slave_0001'],
+        #                                address=0x01,
+        #                                response_timeout=self.__soft_config.pvsw_config.slave_response_timeout,
+        #                                pipeline_depth=self.__soft_config.pvsw_config.slave_pipeline_depth,
+        #                                batch_size=self.__soft_config.pvsw_config.slave_batch_size))
+        for slave in self.__slaves:
+            slave_key = f'slave_{slave.address:04x}'
+            self.__poll_scheduler.add_slave(slave, [slot for slot in self.pvsw_param.slots if slot.path[0] == slave_key])
+        self.__mark_startup('can')
+
+    async def __init_can_isolated(self):
+        """
+        CANの初期化(ip link, ecu.connectなど)で例外が発生しても、同じTaskGroupのセンサ・アラームの処理を止めない。
+        """
+        try:
+            await self.__init_can()
+        except Exception as e:
+            self.logger.exception(f'init can: {e}')
 
     async def start(self, expire_time=0.0):
-        """Masterの動作を開始する。"""
+        """
+        Masterの動作を開始する。
+        センサ・gpioとCANの初期化を並列に行い、センサ・アラームの処理はセンサの初期化が終わり次第開始する。
+        """
         # 周期タスクを実行する。(並列実行)
-        # slaveの設定を行う。 todo slaveの数、種類により変更する。
         async with asyncio.TaskGroup() as tg:
+            # ハードウェアに依存しない処理は先に開始する。
+            self.__tasks.append(tg.create_task(self.task_control_watch()))
+            self.__tasks.append(tg.create_task(self.task_remote_fetch_cyclic()))
+            self.__tasks.append(tg.create_task(self.task_metrics_export_cyclic()))
+            # slaveの設定を行う。 todo slaveの数、種類により変更する。
+            self.__tasks.append(tg.create_task(self.__init_can_isolated()))
+            await asyncio.gather(asyncio.to_thread(self.__init_sensors), asyncio.to_thread(self.__init_gpio))
+            self.__mark_startup('sensors')
             self.__tasks.append(tg.create_task(self.task_sensor_cyclic()))
+            if self.__accel_interrupt:
+                self.__tasks.append(tg.create_task(self.task_accel_interrupt()))
             self.__tasks.append(tg.create_task(self.task_control_file_check_cyclic()))
             self.__tasks.append(tg.create_task(self.task_system_data_cyclic()))
             if expire_time > 0.0:
@@ -93,14 +206,55 @@ class PvswMaster:
     def stop(self):
         for task in self.__tasks:
             task.cancel()
+        if self.__scale_executor is not None:
+            self.__scale_executor.shutdown()
+        for io in self.__io.values():
+            io.shutdown()
+        self.__metrics_exporter.stop()
+        self.__file_process.stop()
+        if self.__can_communication is not None:
+            self.__can_communication.stop()
     
+    @property
+    def io_stats(self):
+        """
+        バスごと、デバイスごとのI/Oの所要時間の記録(バス名: {デバイス名: DeviceLatency})
+        """
+        return {bus: io.latency for bus, io in self.__io.items()}
+
+    @property
+    def task_stats(self):
+        """
+        周期タスクごとの実行の記録(タスク名: TaskStats)
+        """
+        return self.__deadline_scheduler.stats
+
     def subscribe(self, callback):
         """slaveから情報を得るごとにcallbackで返す。"""
         self.callback.append(callback)
     
-    def download_slave_soft(self, address, binary_data):
-        """指定したアドレスにバイナリデータのソフトをダウンロードする。"""
-        pass
+    async def download_slave_soft(self, address, binary_data):
+        """
+        指定したアドレスにバイナリデータのソフトをダウンロードする。
+        複数のslaveへのダウンロードを並列に呼んだ場合も、合わせてバス使用率の上限内で送信する。
+        中断した場合は、再度呼ぶとslaveが受信済みのブロックの続きから送信する。
+        :param address: slaveのJ1939アドレス
+        :param binary_data: ソフトのファイルのパス、またはbytes-likeなバイナリデータ
+        :return: 成功したか
+        """
+        slave = next((slave for slave in self.__slaves if slave.address == address), None)
+        if slave is None:
+            self.logger.error(f'slave {address:02x} is not found')
+            return False
+        if self.__firmware_downloader is None:
+            from firmware_download import FirmwareDownloader
+            pvsw_config = self.__soft_config.pvsw_config
+            self.__firmware_downloader = FirmwareDownloader(
+                self.__bitrate, self.__soft_config.j1939_config.max_cmdt_packets,
+                bus_load_limit=pvsw_config.slave_download_bus_load_limit,
+                window=pvsw_config.slave_download_window,
+                response_timeout=pvsw_config.slave_response_timeout)
+        return await self.__firmware_downloader.download(slave, binary_data)
 
     async def __set_control(self):
         """
@@ -110,110 +264,197 @@ class PvswMaster:
         # None(更新されていない、存在しない)の場合は何もしない。
         if json_data is None:
             return
-        # paramを更新する。
-        self.pvsw_param.set_param_write_value(json_data)
+        # 全ての項目を検証してからparamを更新する。(不正な項目があれば何も反映しない。)
+        changed = self.pvsw_param.set_param_write_value(json_data)
+        if len(changed) == 0:
+            return
+        self.logger.info('control: ' + ', '.join('/'.join(slot.path) for slot in changed))
+        # masterの値は周期処理で反映される。slaveの値は通信で送信する。
+        await self.__set_control_slaves([slot for slot in changed if slot.path[0] != 'mainParameter'])
 
-    def __set_control_slaves(self, json_data):
-        for slave_key, slave_value in json_data.items():
+    async def __set_control_slaves(self, slots):
+        """
+        値が変化したslaveのパラメータを、slaveごとにまとめて送信する。
+        """
+        slave_slots = {}
+        for slot in slots:
+            slave_slots.setdefault(slot.path[0], []).append(slot)
+        for slave_key, key_slots in slave_slots.items():
             # slave_keyからアドレスデータを読み出す。（正規表現で_(アンダーバ)以降の文字列を抽出）
-            key_number = re.search('(?<=_)[0-9a-bA-B]+', slave_key)
-            slave_address = int(key_number.group(), 16)
-            # 指定されたアドレスのslaveに制御データを導入する。
-            slave_found_flg = False
-            # for slave in self.__slaves:
-            #     if slave.address == slave_address:
-            #         slave_found_flg = True
-            #         slave.set_control(slave_value)
-            #         break
-            # もし指定アドレスのslaveが見つからない場合は、ログを残す。
-            if slave_found_flg is False:
+            key_number = re.search('(?<=_)[0-9a-fA-F]+', slave_key)
+            slave_address = int(key_number.group(), 16) if key_number is not None else None
+            # 指定されたアドレスのslaveに制御データを送信する。
+            slave = next((slave for slave in self.__slaves if slave.address == slave_address), None)
+            if slave is None:
+                # もし指定アドレスのslaveが見つからない場合は、ログを残す。
                 self.logger.warning('In control.json, ' + slave_key + ' is not found')
+                continue
+            await slave.set_control(key_slots)
 
-    def __get_parameter(self, master_param):
+    def __read_gpio_inputs(self):
+        """
+        gpioの入力をまとめて読み出す。(gpioのスレッドで呼ぶ)
+        :return: (dc24V_in, ac_in, reset_button)のis_pressed
+        """
+        return (self.__dc24V_in.is_pressed, self.__ac_in.is_pressed, self.__reset_button.is_pressed)
+
+    async def __get_gpio_inputs(self):
+        """
+        gpioの入力を取得する。同時に要求された読み出しは1回にまとめる。
+        """
+        return await self.__io['gpio'].call('inputs', self.__read_gpio_inputs, key='inputs')
+
+    async def __set_dc24V_en(self, on):
+        await self.__io['gpio'].call('dc24V_en', self.__dc24V_en.on if on else self.__dc24V_en.off)
+
+    async def __get_parameter(self):
         """
         masterの各種状態を取得する。
         """
-        master_param['parameters']['in_24V']['type']['value'] = 1 if self.__dc24V_in.is_pressed else 0
-        master_param['parameters']['ac_in']['type']['value'] = 0 if self.__ac_in.is_pressed else 1  # 負論理
-        master_param['parameters']['seismometer']['type']['value'] = self.__seismometer.scale
-        master_param['parameters']['wet']['type']['value'] = self.__wet_sensor.filtered_data
+        (dc24V_in, ac_in, _) = await self.__get_gpio_inputs()
+        self.__main.in_24V.value = 1 if dc24V_in else 0
+        self.__main.ac_in.value = 0 if ac_in else 1  # 負論理
+        self.__main.seismometer.value = self.__seismometer.scale
+        self.__main.wet.value = self.__wet_sensor.filtered_data
 
     async def __get_system_dict(self):
         """
         slaveも含め、周期的に保存するデータをdictにして返す。
+        前回から変化した値のみとし、一定間隔とセグメントの先頭では全ての値とする。
         """
-        self.__get_parameter(self.pvsw_param.param['parameters']['mainParameter'])
-        for slave in self.__slaves:
-            await slave.get_system_data()
+        await self.__get_parameter()
+        await self.__poll_scheduler.poll(self.__master_interval_time)
         # timeを更新
-        self.pvsw_param.param['parameters']['mainParameter']['parameters']['time']['type']['value'] = (datetime.now().astimezone().isoformat(timespec="milliseconds"))
-        return self.pvsw_param.get_system_data_dict()
+        self.__main.time.value = (datetime.now().astimezone().isoformat(timespec="milliseconds"))
+        return self.pvsw_param.get_system_data_delta(keyframe=self.__file_process.needs_keyframe())
 
     async def __master_cyclic(self):
         """
         master内の周期処理
         """
-        params = self.pvsw_param.param['parameters']['mainParameter']['parameters']
+        params = self.__main
         
         # reset button
-        if self.__reset_button.is_pressed is False:
-            params['reset']['type']['value'] = 1 
+        (_, _, reset_pressed) = await self.__get_gpio_inputs()
+        if reset_pressed is False:
+            params.reset.value = 1 
 
         # reset alarm
-        if params['reset']['type']['value'] != 0:
-            params['status']['type']['value'] = self.Status.Normal
+        if params.reset.value != 0:
+            params.status.value = self.Status.Normal
             # reset書き込み時は0に戻す。
-            params['reset']['type']['value'] = 0
+            params.reset.value = 0
 
         # seismometer
         (is_full, scale) = await self.__seismometer.get_scale()
-        if is_full and (params['seismic_threshold']['type']['value'] < scale) and (self.__seismometer.SCALE_MIN) < scale:
-            params['status']['type']['value'] = self.Status.AlmSeismic
+        if is_full and (params.seismic_threshold.value < scale) and (self.__seismometer.SCALE_MIN) < scale:
+            params.status.value = self.Status.AlmSeismic
 
         # wet sensor
-        if params['wet_threshold']['type']['value'] < self.__wet_sensor.filtered_data:
-            params['status']['type']['value'] = self.Status.AlmWater
+        if params.wet_threshold.value < self.__wet_sensor.filtered_data:
+            params.status.value = self.Status.AlmWater
+
+        if 'first_alarm_cycle' not in self.startup_times:
+            # センサの値でアラームを判定できた最初の周期
+            self.__mark_startup('first_alarm_cycle')
 
-        if self.Status(params['status']['type']['value']) is not self.Status.Normal:
+        if self.Status(params.status.value) is not self.Status.Normal:
             """Almの場合は、強制的にOFFにする。"""
-            self.__dc24V_en.off()
+            await self.__set_dc24V_en(False)
             return
-        
-        if params['en_24V']['type']['value'] > 0:
-            self.__dc24V_en.on()
-        else:
-            self.__dc24V_en.off()
+
+        await self.__set_dc24V_en(params.en_24V.value > 0)
+
+    async def __run_periodic(self, name, function, interval):
+        """
+        functionを周期interval(sec)で実行する。overrun時の動作はconfigのtask_overrun_policyで指定する。
+        """
+        policy = self.__soft_config.pvsw_config.task_overrun_policy.get(name, DeadlineScheduler.COALESCE)
+        await self.__deadline_scheduler.run(name, function, interval, policy)
+
+    async def __set_control_isolated(self):
+        """
+        指令の反映で例外が発生しても、control_fileの監視と他のタスクを継続する。
+        """
+        try:
+            await self.__set_control()
+        except Exception as e:
+            self.logger.exception(f'set control: {e}')
 
     async def task_system_data_cyclic(self):
         """
         system_dataの周期的タスクを実行する。
         """
-        while True:
-            async with asyncio.TaskGroup() as tg:
-                tg.create_task(asyncio.sleep(self.__master_interval_time))
-                tg.create_task(self.__file_process.save_system_data(await self.__get_system_dict()))
-                tg.create_task(self.__file_process.load_config_file())
+        await self.__run_periodic('system_data', self.__system_data_cyclic, self.__master_interval_time)
+
+    async def __system_data_cyclic(self):
+        if await self.__file_process.save_system_data(await self.__get_system_dict()):
+            self.pvsw_param.commit_system_data_delta()
 
     async def task_control_file_check_cyclic(self):
         """
         以下のタスクを行う。
-        control_fileの監視
         slaveとの通信
         masterの処理
+        control_fileの監視はtask_control_watchで行う。
         """
-        while True:
-            async with asyncio.TaskGroup() as tg:
-                tg.create_task(asyncio.sleep(self.__control_filecheck_interval_time))
-                tg.create_task(self.__set_control())
-                tg.create_task(self.__master_cyclic())
+        await self.__run_periodic('control_file_check', self.__master_cyclic, self.__control_filecheck_interval_time)
+
+    async def task_control_watch(self):
+        """
+        control_fileの追加・更新を検出し、指令を反映させる。
+        """
+        watcher = ControlWatcher(self.__soft_config.file_config.control_path,
+                                 self.__soft_config.file_config.control_name,
+                                 self.__control_filecheck_interval_time)
+        watcher.start()
+        try:
+            # 起動時に既に存在するものを反映させる。
+            await self.__set_control_isolated()
+            while True:
+                await watcher.wait()
+                await self.__set_control_isolated()
+        finally:
+            watcher.stop()
+
+    async def task_remote_fetch_cyclic(self):
+        """
+        サーバからcontrol_file, config_fileをダウンロードする。
+        ダウンロードしたcontrol_fileはtask_control_watchが検出する。
+        同期スクリプトの起動は1周期に2回(既定の30秒で毎分4回)とし、system_dataのアップロード
+        (system_data_upload_intervalに1回と封をしたセグメント)と合わせて毎分数回に抑える。
+        """
+        await self.__run_periodic('remote_fetch', self.__remote_fetch, self.__remote_fetch_interval_time)
+
+    async def __remote_fetch(self):
+        await asyncio.gather(self.__file_process.fetch_control_files(), self.__file_process.load_config_file())
+
+    async def task_metrics_export_cyclic(self):
+        """
+        メトリクスをファイルへ出力する。metrics_interval_timeが0の場合はファイルへ出力しない。
+        """
+        await self.__metrics_exporter.start_http()
+        interval = self.__soft_config.pvsw_config.metrics_interval_time
+        if interval > 0:
+            await self.__run_periodic('metrics', self.__metrics_exporter.export, interval)
 
     async def task_sensor_cyclic(self):
         """
         加速度センサのデータを取得する。
         水センサのデータを取得する。
         """
+        await self.__run_periodic('sensor', self.__sensor_cyclic, self.__accel_sensor_interval_time)
+
+    async def __sensor_cyclic(self):
+        # SPIとI2Cは別のバスなので並列に読み出す。
+        reads = [self.__io['i2c'].call('adc081c021', self.__wet_sensor.set_adc_data)]
+        if not self.__accel_interrupt:
+            reads.append(self.__seismometer.read_accel_data_from_lis2dh12())
+        await asyncio.gather(*reads)
+
+    async def task_accel_interrupt(self):
+        """
+        加速度センサのFIFOがウォーターマークに達するごとにデータを取得する。
+        """
         while True:
-            async with asyncio.TaskGroup() as tg:
-                tg.create_task(asyncio.sleep(self.__accel_sensor_interval_time))
-                self.__seismometer.set_accel_data_from_lis2dh12()
-                self.__wet_sensor.set_adc_data()
+            await self.__seismometer.wait_accel_data_from_lis2dh12()
@@ -2,11 +2,44 @@ from logging import getLogger
 from soft_config import SoftConfig
 import json
 
-    
+
+class ParamSlot:
+    """
+    パラメータ1つ分のレコード
+    値は元のdict(param[...]['type'])を直接参照するため、dictの表示と常に一致する。
+    """
+    __slots__ = ('index', 'path', 'node', 'type_dict', 'type', 'write_enable', 'command')
+
+    def __init__(self, index, path, node):
+        """
+        :param index: slot番号
+        :param path: 'parameters'を除いたkeyのtuple(例: ('mainParameter', 'status'))
+        :param node: パラメータのdict({'command': ..., 'type': {...}})
+        """
+        self.index = index
+        self.path = path
+        self.node = node
+        self.type_dict = node['type']
+        self.type = self.type_dict.get('type')
+        self.write_enable = self.type_dict.get('writeEnable', False)
+        self.command = node.get('command')
+
+    @property
+    def value(self):
+        return self.type_dict['value']
+
+    @value.setter
+    def value(self, value):
+        self.type_dict['value'] = value
+
+
 class PvswParam:
     """
     Pvswの各種パラメータを格納する。
     """
+    # PvswSlaveがfloatを送信する形式(単精度)で表せる絶対値の最大
+    FLOAT_MAX = 3.4028235e38
+
     def __init__(self, file_config: SoftConfig.FileConfig):
         """
         paramのdict型はnullにする。
@@ -16,6 +49,20 @@ class PvswParam:
         self.__logger = getLogger(__name__)
         self.__file_config = file_config
         self.param = self.__get_from_master_file()
+        # パラメータをslot番号で参照できる平坦な配列にする。
+        self.slots = []
+        self.path_to_slot = {}
+        self.__read_plan = []
+        self.__group_num = 1
+        # 差分出力用: サーバへ送信するslotと、前回出力した値
+        self.__read_slots = []
+        # 書き込み検証用: 'parameters'を持つ階層のkeyのtuple
+        self.__group_paths = {()}
+        self.__last_values = None
+        self.__delta_count = 0  # 前回のkeyframeからの差分の出力回数
+        self.__pending = None  # 保存に成功したら反映する(値, 差分の出力回数)
+        if self.param is not None:
+            self.__compile(self.param['parameters'], (), 0)
 
     def __get_from_master_file(self):
         """
@@ -37,56 +84,161 @@ class PvswParam:
         except Exception as e:
             self.__logger.error('error on %s', e)
 
-    def __get_dict_top(self, param_dict):
+    def __compile(self, param_dict, path, group):
         """
-        parameterの先頭を示す。
+        パラメータのtreeを走査し、slotとsystem_data出力用の手順を作成する。
+        :param param_dict: 'parameters'の中身
+        :param path: param_dictまでのkeyのtuple
+        :param group: param_dictに対応する出力dictの番号
         """
-        dict = {}
         for key, value in param_dict.items():
-            match key:
-                case 'parameters':
-                    dict[key] = self.__get_dict_child(value)
-                case _:
-                    pass
-        return dict
+            if 'parameters' in value:
+                child = self.__group_num
+                self.__group_num += 1
+                self.__read_plan.append((group, key, child, None))
+                self.__group_paths.add(path + (key,))
+                self.__compile(value['parameters'], path + (key,), child)
+            elif 'type' in value:
+                slot = ParamSlot(len(self.slots), path + (key,), value)
+                self.slots.append(slot)
+                self.path_to_slot[slot.path] = slot.index
+                if slot.write_enable is False:
+                    # writeEnableは書き込み専用なのでサーバに送信しない.
+                    self.__read_plan.append((group, key, None, slot.type_dict))
+                    self.__read_slots.append(slot)
 
-    def __get_dict_child(self, param_dict):
+    def handle(self, *path):
         """
-        parameterの子要素を示す。
+        パラメータのslotを返す。頻繁に参照するものは事前に取得しておく。
+        :param path: 'parameters'を除いたkey(例: handle('mainParameter', 'status'))
         """
-        dict = {}
-        for key, value in param_dict.items():
-            for i_key, i_value in value.items():
-                if i_key == 'parameters':
-                    dict[key] = self.__get_dict_child(i_value)
-                elif (i_key == 'type') and (i_value['writeEnable'] is False):
-                    # writeEnableは書き込み専用なのでサーバに送信しない.
-                    dict[key] = i_value['value']
-        return dict
+        return self.slots[self.path_to_slot[path]]
+
+    @staticmethod
+    def __check_type(slot_type, value):
+        """
+        valueがパラメータの型として書き込めるか。(PvswSlaveの送信形式の範囲も確認する。)
+        boolはintの派生型だが、数値としては受け付けない。
+        """
+        if isinstance(value, bool):
+            return False
+        match slot_type:
+            case 'uint':
+                return isinstance(value, int) and 0 <= value <= 0xFFFFFFFF
+            case 'int':
+                return isinstance(value, int) and -0x80000000 <= value <= 0x7FFFFFFF
+            case 'float':
+                # nanとinfも範囲外として受け付けない。
+                return isinstance(value, (int, float)) and abs(value) <= PvswParam.FLOAT_MAX
+            case 'str' | 'string':
+                return isinstance(value, str)
+            case _:
+                return True
 
-    def __set_param(self, set_dict, param):
+    def validate_write(self, set_dict):
         """
-        set_dictのkey,valueの構造からデータを格納する。
+        外部からの書き込みデータを一度の走査で検証する。
+        :return: (changes, errors)
+            changes: 書き込む(slot, 値)のリスト
+            errors: 書き込めない項目の説明のリスト。空であれば全て書き込める。
         """
-        for key, value in set_dict.items():
-            if key in param:
-                if isinstance(value, dict):
-                    self.__set_param(value, param[key]['parameters'])
+        changes = []
+        errors = []
+        if not isinstance(set_dict, dict) or not isinstance(set_dict.get('parameters'), dict):
+            return (changes, ['parameters is not found'])
+        # 再帰せず、(keyのtuple, dict)のstackで走査する。
+        stack = [((), set_dict['parameters'])]
+        while len(stack) > 0:
+            (path, values) = stack.pop()
+            for key, value in values.items():
+                key_path = path + (key,)
+                name = '/'.join(key_path)
+                if key_path in self.__group_paths:
+                    if isinstance(value, dict):
+                        stack.append((key_path, value))
+                    else:
+                        errors.append(f'{name}: group cannot be written')
+                    continue
+                index = self.path_to_slot.get(key_path)
+                if index is None:
+                    errors.append(f'{name}: unknown parameter')
+                    continue
+                slot = self.slots[index]
+                if slot.write_enable is not True:
+                    errors.append(f'{name}: read only')
+                elif isinstance(value, dict) or not self.__check_type(slot.type, value):
+                    errors.append(f'{name}: {value!r} is not {slot.type}')
                 else:
-                    param[key]['type']['value'] = value
+                    changes.append((slot, value))
+        return (changes, errors)
 
     def get_system_data_dict(self):
         """
         外部にsystem_dataとして出力するためのDictを生成する。
+        treeを再帰的に走査せず、__compileで作成した手順に従って生成する。
+        """
+        groups = [None] * self.__group_num
+        groups[0] = {}
+        for (parent, key, child, type_dict) in self.__read_plan:
+            if child is not None:
+                groups[child] = groups[parent][key] = {}
+            else:
+                groups[parent][key] = type_dict['value']
+        return {'parameters': groups[0]}
+
+    def get_system_data_delta(self, keyframe=False):
+        """
+        前回保存した出力から変化した値のみのDictを生成する。
+        system_data_keyframe_interval回に1回は全ての値を出力する(keyframe)。
+        次の差分の基準は、保存に成功してcommit_system_data_deltaを呼ぶまで更新しない。
+        :param keyframe: Trueの場合は必ずkeyframeとする。(新しいセグメントの先頭など)
+        :return: {'parameters': {...}, 'keyframe': bool}
+            keyframeでない場合、parametersには変化した値のみが同じ階層で格納される。
+        """
+        values = [slot.type_dict['value'] for slot in self.__read_slots]
+        if keyframe or self.__last_values is None or \
+                self.__delta_count + 1 >= self.__file_config.system_data_keyframe_interval:
+            self.__pending = (values, 0)
+            data = self.get_system_data_dict()
+            data['keyframe'] = True
+            return data
+        parameters = {}
+        for slot, value, last in zip(self.__read_slots, values, self.__last_values):
+            if value != last:
+                group = parameters
+                for key in slot.path[:-1]:
+                    group = group.setdefault(key, {})
+                group[slot.path[-1]] = value
+        self.__pending = (values, self.__delta_count + 1)
+        return {'parameters': parameters, 'keyframe': False}
+
+    def commit_system_data_delta(self):
+        """
+        get_system_data_deltaで生成したレコードを保存できた場合に呼び、次の差分の基準とする。
+        保存に失敗した場合は呼ばないため、次の差分は失われたレコードで変化した値も含む。
         """
-        return self.__get_dict_top(self.param)
+        if self.__pending is not None:
+            (self.__last_values, self.__delta_count) = self.__pending
+            self.__pending = None
 
     def set_param_write_value(self, set_dict):
         """
         外部からの書き込みデータを反映させる。
+        全ての項目を検証し、一つでも書き込めないものがあれば何も反映させない。
         Slaveはこの他に通信処理が必要
+        :return: 値が変化したslotのリスト
         """
-        self.__set_param(set_dict['parameters'], self.param['parameters'])
+        (changes, errors) = self.validate_write(set_dict)
+        if len(errors) > 0:
+            for error in errors:
+                self.__logger.warning('control rejected: ' + error)
+            return []
+        changed = []
+        for slot, value in changes:
+            if slot.value != value:
+                slot.value = value
+                changed.append(slot)
+        return changed
 
     def add_write_action(self, name, command):
         pass
@@ -1,85 +1,345 @@
 import asyncio
 import struct
+import time
+from collections import deque
 from can_communication import CanCommunication
 from enum import IntFlag
 from pvsw_parameter import PvswParam
+from metrics import REGISTRY
 from logging import getLogger
 
 class PvswSlave:
     """
     Slaveの情報
+    要求は(アドレス, コマンド)ごとの応答待ちの表で管理し、pipeline_depthまで応答を待たずに送信する。
+    ただし、応答にヘッダを付けることを確認していないslave(従来のファームウェア)への'CR'/'CW'は、
+    ヘッダのない応答を要求と対応付けられないため、1つずつ送信する。
+    応答に必ずヘッダが付く'B'/'D'の要求は、ヘッダの確認によらず並列に送信する。
     """
-    def __init__(self, can_communication, param):
+    # 要求の先頭(pre_command 2byte + command 2byte)
+    HEADER_SIZE = 4
+    # ファームウェアのブロックの確認応答の先頭('DA' + ブロック番号 4byte)
+    BLOCK_ACK_SIZE = 6
+    # 同じslaveへのtransport protocolの送信が終わるのを待つ間隔(sec)
+    TP_BUSY_INTERVAL = 0.005
+    # 応答に必ずヘッダが付き、ヘッダで照合する要求の先頭('BR'/'BW', ファームウェアのダウンロード)
+    KEYED_PREFIXES = (b'B', b'D')
+
+    def __init__(self, can_communication, param, address=8, response_timeout=0.5, pipeline_depth=4, batch_size=16,
+                 late_reply_guard=0.1):
+        """
+        :param can_communication: CanCommunication
+        :param param: slaveのパラメータのdict
+        :param address: slaveのJ1939アドレス
+        :param response_timeout: 応答を待つ時間(sec)。超えた場合は失敗とする。
+        :param pipeline_depth: 応答を待たずに送信できる要求の数
+        :param batch_size: 1つの要求('BR'/'BW')で読み書きするパラメータ数の上限
+        :param late_reply_guard: タイムアウト後、ヘッダのない応答を破棄する時間(sec)
+        """
         self.__can_communication = can_communication
         self.__param = param
-        self.__j1939_address = 8
+        self.__j1939_address = address
         self.__logger = getLogger(__name__)
+        self.response_timeout = response_timeout
+        self.pipeline_depth = pipeline_depth
+        self.batch_size = batch_size
+        # 'BR'/'BW'に対応しているか(None: 未確認)
+        self.batch_supported = None
+        # 'CR'/'CW'の応答にヘッダを付けるか(None: 未確認)。Trueの場合のみpipelineで並列に送信する。
+        self.header_echo = None
+        self.late_reply_guard = late_reply_guard
+        self.__pipeline = None
+        self.__single = None
+        # タイムアウトした要求への遅れた応答を破棄する期限(time.monotonic)
+        self.__guard_until = 0.0
+        # (アドレス, コマンド): 応答を待つ(送信順の番号, future)のdeque(古い順)
+        self.__in_flight = {}
+        self.__sequence = 0
+        # 通信の記録
+        self.request_count = 0
+        self.timeout_count = 0
+        self.failure_count = 0
+        self.discard_count = 0
+        labels = {'slave': f'{address:02x}'}
+        self.__request_seconds = REGISTRY.histogram('pvsw_slave_request_seconds',
+                                                    'Round trip time of answered slave requests.', labels)
+        REGISTRY.counter('pvsw_slave_requests', 'Requests sent to the slave.', labels,
+                         function=lambda: self.request_count)
+        REGISTRY.counter('pvsw_slave_timeouts', 'Slave requests without a response.', labels,
+                         function=lambda: self.timeout_count)
+        REGISTRY.counter('pvsw_slave_failures', 'Failed slave requests.', labels, function=lambda: self.failure_count)
+        REGISTRY.counter('pvsw_slave_discards', 'Unexpected frames discarded.', labels,
+                         function=lambda: self.discard_count)
+        if self.__can_communication is not None:
+            self.__can_communication.subscribe(CanCommunication.PGN.ProprietaryA, self.__j1939_address,
+                                               self.__resolve)
 
-    async def set_control(self, control):
+    @property
+    def address(self):
+        return self.__j1939_address
+
+    @property
+    def in_flight_count(self):
+        return sum(len(futures) for futures in self.__in_flight.values())
+
+    async def set_control(self, slots):
         """
         スレーブへ通信で送信し、制御を行う
+        :param slots: 値が変化したパラメータのslot(PvswParam.set_param_write_valueの戻り値)のリスト
         """
-        for con_key, con_value in control.items():
-            for para_key, para_value in self.__param['parameters'].items():
-                if con_key == para_key:
-                    para_value[para_key]['value'] = con_value
-                    await self.send(['C', 'W'], para_value[para_key])
+        await self.send_batch(['B', 'W'], [slot.node for slot in slots])
 
     async def get_system_data(self):
         """
         テスト用に簡略化している。todo汎化
         """
         self.__logger.info('can comm start!')
-        await self.send(['C', 'R'], self.__param['parameters']['programName'])
-        await self.send(['C', 'R'], self.__param['parameters']['volt'])
+        await self.send_batch(['B', 'R'], [self.__param['parameters']['programName'],
+                                           self.__param['parameters']['volt']])
 
-    async def send(self, pre_command, para_value):
+    @staticmethod
+    def __encode_value(para_value):
         """
-        can通信を実行する。
+        書き込む値をtypeに従ってbytesにする。書き込めないtypeの場合はNone
         """
-        data = [ord(char) for char in pre_command]
-        data.extend(byte for byte in struct.pack('<H', int(para_value['command'], 16)))
-        if pre_command == ['C', 'W']:
-            match para_value.type:
-                case 'uint':
-                    byte_string = struct.pack('<I', para_value['value'])
-                case 'int':
-                    byte_string = struct.pack('<i', para_value['value'])
-                case 'float':
-                    byte_string = struct.pack('<f', para_value['value'])
-                case _:
-                    return
-            data.extend(byte for byte in byte_string)
-        self.__logger.info(f'data {data}')
-        self.__can_communication.ca.send_pgn(0, CanCommunication.PGN.ProprietaryA >> 8, self.__j1939_address, 6, data)
-        (sa, data) = await self.recv()
-        # フォーマットを整える。
         match para_value['type']['type']:
             case 'uint':
-                value = struct.unpack('<I', bytes(data))[0]
+                return struct.pack('<I', para_value['type']['value'])
             case 'int':
-                value = struct.unpack('<i', bytes(data))[0]
+                return struct.pack('<i', para_value['type']['value'])
             case 'float':
-                value = struct.unpack('<f', bytes(data))[0]
-            case 'str' | 'string':
-                value = bytes(data).decode('ascii')
+                return struct.pack('<f', para_value['type']['value'])
             case _:
-                return
+                return None
+
+    def __decode_value(self, para_value, data):
+        """
+        応答のデータをtypeに従って変換し、valueに格納する。
+        :return: 成功したか
+        """
+        # フォーマットを整える。
+        try:
+            match para_value['type']['type']:
+                case 'uint':
+                    value = struct.unpack('<I', bytes(data))[0]
+                case 'int':
+                    value = struct.unpack('<i', bytes(data))[0]
+                case 'float':
+                    value = struct.unpack('<f', bytes(data))[0]
+                case 'str' | 'string':
+                    value = bytes(data).decode('ascii')
+                case _:
+                    return True
+        except (struct.error, UnicodeDecodeError) as e:
+            self.failure_count += 1
+            self.__logger.warning(f'slave {self.__j1939_address:02x} command {para_value["command"]}: {e}')
+            return False
         para_value['type']['value'] = value
+        return True
 
-    async def recv(self):
+    async def send(self, pre_command, para_value):
+        """
+        can通信を実行する。
+        :return: 応答を受信できたか
+        """
+        command = struct.pack('<H', int(para_value['command'], 16))
+        data = [ord(char) for char in pre_command]
+        data.extend(byte for byte in command)
+        if pre_command == ['C', 'W']:
+            byte_string = self.__encode_value(para_value)
+            if byte_string is None:
+                return False
+            data.extend(byte for byte in byte_string)
+        self.__logger.debug(f'data {data}')
+        data = await self.request(bytes(command), data)
+        if data is None:
+            return False
+        return self.__decode_value(para_value, data)
+
+    async def send_batch(self, pre_command, para_values):
+        """
+        複数のパラメータを1つの要求('BR'/'BW')で読み書きする。
+        batch_sizeを超える場合は分割する。9byte以上の要求はJ1939のtransport protocolで送信される。
+        'BR'/'BW'に応答しないslave(従来のファームウェア)には、1つずつの要求('CR'/'CW')で行う。
+        要求: pre_command(2byte), 数(1byte), [command(2byte), (BWのみ)値(4byte)] × 数
+        応答: pre_command(2byte), 数(1byte), 値 × 数(要求の順)
+              値はtypeに従い、uint, int, floatは4byte、strは長さ(1byte) + 文字列とする。
+        :param pre_command: ['B', 'R'] or ['B', 'W']
+        :param para_values: パラメータのdictのリスト
+        :return: パラメータごとの成否のリスト
+        """
+        if len(para_values) == 1 or self.batch_supported is False:
+            return await self.__send_singles(pre_command, para_values)
+        results = []
+        for offset in range(0, len(para_values), self.batch_size):
+            results.extend(await self.__send_batch(pre_command, para_values[offset:offset + self.batch_size]))
+        return results
+
+    async def __send_singles(self, pre_command, para_values):
         """
-        can通信の受信を行う。
-        受信が完了するまでawaitで待機する。
+        1つずつの要求('CR'/'CW')で読み書きする。応答待ちはpipelineで並列に行う。
         """
-        future = asyncio.get_event_loop().create_future()
+        single = ['C', pre_command[1]]
+        return list(await asyncio.gather(*(self.send(single, para_value) for para_value in para_values)))
 
-        def on_recv(sa, data):
-            future.set_result((sa, data))
+    async def __send_batch(self, pre_command, para_values):
+        """
+        batch_size以下のパラメータを1つの要求で読み書きする。
+        """
+        is_write = pre_command[1] == 'W'
+        data = [ord(char) for char in pre_command]
+        data.append(len(para_values))
+        for para_value in para_values:
+            data.extend(struct.pack('<H', int(para_value['command'], 16)))
+            if is_write:
+                byte_string = self.__encode_value(para_value)
+                if byte_string is None:
+                    # 書き込めないtypeが含まれる場合は1つずつ行う。
+                    return await self.__send_singles(pre_command, para_values)
+                data.extend(byte_string)
+        reply = await self.request(bytes(data[:2]), data, count_timeout=self.batch_supported is True)
+        if reply is None:
+            if self.batch_supported is None:
+                # 1つずつの要求には応答する場合は従来のファームウェアとみなし、以降は1つずつ行う。
+                results = await self.__send_singles(pre_command, para_values)
+                if any(results):
+                    self.batch_supported = False
+                    self.__logger.info(f'slave {self.__j1939_address:02x}: batch command is not supported')
+                return results
+            return [False] * len(para_values)
+        self.batch_supported = True
+        results = [False] * len(para_values)
+        count = min(reply[0], len(para_values)) if len(reply) > 0 else 0
+        offset = 1
+        for index in range(count):
+            # 値の長さはparameterListSlaveのtypeから決まる。
+            if para_values[index]['type']['type'] in ('str', 'string'):
+                length = reply[offset] if offset < len(reply) else 0
+                offset += 1
+            else:
+                length = 4
+            if offset + length > len(reply):
+                self.failure_count += 1
+                self.__logger.warning(f'slave {self.__j1939_address:02x}: batch reply is truncated')
+                break
+            results[index] = self.__decode_value(para_values[index], reply[offset:offset + length])
+            offset += length
+        return results
 
-        self.__can_communication.set_on_ca_received(on_recv)
+    async def request(self, command, data, count_timeout=True, timeout=None):
+        """
+        要求を送信し、応答のデータ(ヘッダを除く)を返す。
+        応答待ちの要求がpipeline_depthに達している場合は空くまで待機する。
+        応答にヘッダを付けることを確認していないslaveへの'CR'/'CW'は、前の'CR'/'CW'が終わってから送信し、
+        タイムアウトした場合はlate_reply_guardの間、次の要求を送信しない。(遅れた応答を次の要求に渡さない)
+        'B'/'D'の要求はヘッダで照合するため、ヘッダの確認によらず待たずに送信する。
+        :param command: コマンド(2byte)。応答との対応付けに使用する。'BR'/'BW'の場合はpre_command、
+                        ファームウェアのブロックの場合は'DA' + ブロック番号
+        :param data: 送信するデータ
+        :param count_timeout: 応答がない場合に失敗として数えるか
+        :param timeout: 応答を待つ時間(sec)。Noneの場合はresponse_timeout
+        :return: 応答のデータ。timeout以内に応答がない場合はNone
+        """
+        if self.__pipeline is None:
+            self.__can_communication.attach_loop()
+            self.__pipeline = asyncio.Semaphore(self.pipeline_depth)
+            self.__single = asyncio.Lock()
+        async with self.__pipeline:
+            if self.header_echo is True or command[:1] in self.KEYED_PREFIXES:
+                return await self.__request(command, data, count_timeout, timeout)
+            async with self.__single:
+                wait = self.__guard_until - time.monotonic()
+                if wait > 0.0:
+                    await asyncio.sleep(wait)
+                return await self.__request(command, data, count_timeout, timeout)
 
-        result = await future
-        self.__can_communication.del_on_ca_received(on_recv)
-        return result
+    async def __request(self, command, data, count_timeout, timeout):
+        key = (self.__j1939_address, command)
+        future = asyncio.get_running_loop().create_future()
+        self.__sequence += 1
+        self.__in_flight.setdefault(key, deque()).append((self.__sequence, future))
+        self.request_count += 1
+        try:
+            start = time.perf_counter()
+            reply = await asyncio.wait_for(self.__send_and_wait(data, future),
+                                           self.response_timeout if timeout is None else timeout)
+            self.__request_seconds.observe(time.perf_counter() - start)
+            return reply
+        except asyncio.TimeoutError:
+            self.__guard_until = time.monotonic() + self.late_reply_guard
+            if not count_timeout:
+                return None
+            self.timeout_count += 1
+            self.failure_count += 1
+            self.__logger.warning(f'slave {self.__j1939_address:02x} command {command.hex()}: no response')
+            return None
+        except Exception as e:
+            self.failure_count += 1
+            self.__logger.error('%s', e)
+            return None
+        finally:
+            self.__remove(key, future)
 
+    async def __send_and_wait(self, data, future):
+        """
+        要求を送信し、応答を待つ。
+        9byte以上の要求は、同じslaveへのtransport protocolの送信が終わるまで送信できない(send_pgnがFalse)ため、
+        終わるのを待って送信する。
+        """
+        while self.__can_communication.ca.send_pgn(0, CanCommunication.PGN.ProprietaryA >> 8,
+                                                   self.__j1939_address, 6, data) is False:
+            await asyncio.sleep(self.TP_BUSY_INTERVAL)
+        return await future
+
+    def __remove(self, key, future):
+        futures = self.__in_flight.get(key)
+        if futures is None:
+            return
+        for entry in futures:
+            if entry[1] is future:
+                futures.remove(entry)
+                break
+        if len(futures) == 0:
+            del self.__in_flight[key]
+
+    def __resolve(self, sa, data):
+        """
+        受信したフレームを応答待ちの要求に渡す。CanCommunicationからイベントループ上で呼ばれる。
+        ヘッダ(pre_command + command)付きの応答はコマンドで、'BR'/'BW'の応答はpre_commandで、
+        ファームウェアのダウンロード('D')の応答はブロックの確認応答('DA')のみブロック番号も含めて照合する。
+        ヘッダのない応答は、応答にヘッダを付けることを確認していないslaveのみ、待っている'CR'/'CW'(1つのみ)への
+        応答とする。
+        対応する要求がない(タイムアウト後、要求していない)フレームと、タイムアウト後のlate_reply_guardの間に
+        受信したヘッダのない応答は破棄する。
+        """
+        data = bytes(data)
+        futures = None
+        payload = data
+        if len(data) >= self.HEADER_SIZE and data[:2] in (b'CR', b'CW'):
+            futures = self.__in_flight.get((sa, data[2:self.HEADER_SIZE]))
+            if futures is not None:
+                payload = data[self.HEADER_SIZE:]
+                if self.header_echo is not True:
+                    self.header_echo = True
+                    self.__logger.info(f'slave {sa:02x}: replies with header, pipeline depth {self.pipeline_depth}')
+        elif len(data) >= 3 and data[0] == ord('B'):
+            futures = self.__in_flight.get((sa, data[:2]))
+            if futures is not None:
+                payload = data[2:]
+        elif len(data) >= 3 and data[0] == ord('D'):
+            size = self.BLOCK_ACK_SIZE if data[1] == ord('A') else 2
+            futures = self.__in_flight.get((sa, data[:size]))
+            if futures is not None:
+                payload = data[size:]
+        if futures is None and self.header_echo is not True and time.monotonic() >= self.__guard_until:
+            pending = [futures for (address, command), futures in self.__in_flight.items()
+                       if address == sa and len(futures) > 0 and command[:1] not in self.KEYED_PREFIXES]
+            if len(pending) > 0:
+                futures = min(pending, key=lambda futures: futures[0][0])
+                self.header_echo = False
+        if futures is None or len(futures) == 0 or futures[0][1].done():
+            self.discard_count += 1
+            self.__logger.debug(f'slave {sa:02x}: unexpected frame discarded')
+            return
+        (_, future) = futures.popleft()
+        future.set_result(list(payload))
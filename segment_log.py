@@ -0,0 +1,255 @@
+import json
+import os
+from collections import deque
+from datetime import datetime, timedelta
+from logging import getLogger
+from pathlib import Path
+
+
+class SystemDataSegment:
+    """
+    system_dataの1セグメント(ファイル)
+    JSON Lines形式で、1行に1レコード({"master_data_xxxxxxxx": {...}})を追記する。
+    保存ごとにファイル全体を読み書きせず、新しいレコードの1行のみを書き込む。
+    """
+    SUFFIX = '.jsonl'
+    LEGACY_SUFFIX = '.json'
+
+    def __init__(self, path):
+        """
+        セグメントを開き、レコード数を数える。
+        書き込み途中で停止した場合に備え、改行で終わっていない最終行は削除する。
+        :param path: セグメントのパス
+        """
+        self.logger = getLogger(__name__)
+        self.path = str(path)
+        self.count = self.__recover()
+
+    def __recover(self):
+        """
+        途中で切れた最終行を削除し、レコード数を返す。
+        """
+        try:
+            with open(self.path, 'rb+') as file:
+                data = file.read()
+                if len(data) > 0 and not data.endswith(b'\n'):
+                    # 最後の改行の直後まで切り詰める。
+                    size = data.rfind(b'\n') + 1
+                    file.truncate(size)
+                    self.logger.warning(f'{self.path}: torn record removed ({len(data) - size} bytes).')
+                    data = data[:size]
+                return data.count(b'\n')
+        except FileNotFoundError:
+            return 0
+
+    @staticmethod
+    def key(index):
+        """
+        レコードのkey(従来のdata.jsonと同じ形式)を返す。
+        """
+        return f'master_data_{index:08x}'
+
+    def append(self, record):
+        """
+        レコードを1行追記する。
+        :return: 書き込んだバイト数
+        """
+        line = json.dumps({self.key(self.count): record}, ensure_ascii=False, separators=(',', ':')) + '\n'
+        data = line.encode('utf-8')
+        with open(self.path, 'ab') as file:
+            file.write(data)
+        self.count += 1
+        return len(data)
+
+    def records(self):
+        """
+        (key, レコード)を順に返す。解釈できない行は読み飛ばす。
+        """
+        with open(self.path, 'r', encoding='utf-8') as file:
+            for line in file:
+                try:
+                    yield from json.loads(line).items()
+                except json.JSONDecodeError:
+                    self.logger.warning(f'{self.path}: broken record skipped.')
+
+    def full_records(self):
+        """
+        差分のレコードを直前のkeyframeに重ね、全ての値を持つ(key, レコード)を順に返す。
+        keyframeより前の差分は復元できないため読み飛ばす。
+        レコードはコピーせずに次の差分で上書きするため、保持する場合は呼び出し側でコピーすること。
+        """
+        current = None
+        for key, record in self.records():
+            if record.pop('keyframe', True):
+                current = record
+            elif current is None:
+                continue
+            else:
+                self.__merge(current['parameters'], record['parameters'])
+            yield (key, current)
+
+    @staticmethod
+    def __merge(dst, src):
+        """
+        srcの値をdstへ再帰的に上書きする。
+        """
+        for key, value in src.items():
+            if isinstance(value, dict) and isinstance(dst.get(key), dict):
+                SystemDataSegment.__merge(dst[key], value)
+            else:
+                dst[key] = value
+
+    def legacy_path(self):
+        """
+        従来形式で出力する場合のパス(拡張子のみ異なる)を返す。
+        """
+        return str(Path(self.path).with_suffix(self.LEGACY_SUFFIX))
+
+    def export_legacy(self, legacy_path=None):
+        """
+        従来のdata.jsonの形式({key: レコード, ...}をindent=4)で出力する。
+        差分のレコードは全ての値を持つレコードに復元する。
+        :param legacy_path: 出力先。Noneの場合はlegacy_path()
+        :return: 出力先のパス
+        """
+        legacy_path = legacy_path if legacy_path is not None else self.legacy_path()
+        tmp_path = legacy_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            # 全体のdictを作らず、json.dump(indent=4)と同じ形式で1レコードずつ書き込む。
+            file.write('{')
+            separator = '\n'
+            for key, record in self.full_records():
+                file.write(separator + '    ' + json.dumps(key) + ': ' +
+                           json.dumps(record, indent=4).replace('\n', '\n    '))
+                separator = ',\n'
+            file.write('}' if separator == '\n' else '\n}')
+        # 書き込み途中のファイルをサーバへ送らないよう、完成後に置き換える。
+        os.replace(tmp_path, legacy_path)
+        return legacy_path
+
+
+class SegmentManager:
+    """
+    system_dataのセグメントを管理する。
+    起動時に一度だけディレクトリを走査し、その後は書き込み中のセグメント、
+    そのレコード数、保持しているセグメントの一覧(古い順)をメモリ上で管理する。
+    保存のたびにディレクトリを走査しないため、ファイル数が保存時間に影響しない。
+    """
+
+    def __init__(self, dir_path, name, record_num, file_num, legacy_export=False):
+        """
+        :param dir_path: セグメントを保存するディレクトリ
+        :param name: system_dataのファイル名(例: data.json)。拡張子を除いた部分を使用する。
+        :param record_num: 1セグメントのレコード数
+        :param file_num: 保持するセグメント数
+        :param legacy_export: 封をしたセグメントを従来形式でも出力するか
+        """
+        self.logger = getLogger(__name__)
+        self.dir_path = Path(dir_path)
+        self.stem = Path(name).stem
+        self.record_num = record_num
+        self.file_num = file_num
+        self.legacy_export = legacy_export
+        self.dir_path.mkdir(parents=True, exist_ok=True)
+        # 既存のセグメントを古い順に並べる。(ファイル名の先頭が作成日時)
+        self.__segments = deque(sorted(
+            entry.name for entry in os.scandir(self.dir_path)
+            if entry.is_file() and self.__is_segment(entry.name)))
+        self.active = None
+        if len(self.__segments) > 0:
+            # 最も新しいセグメントに続けて書き込む。
+            self.active = SystemDataSegment(self.dir_path / self.__segments[-1])
+            if self.active.count >= self.record_num:
+                self.active = None
+        self.expired = []  # 削除待ちのセグメントのパス
+        self.exports = []  # 従来形式での出力待ちのセグメント
+        self.__enforce_retention()
+
+    def __is_segment(self, name):
+        return name.endswith(self.stem + SystemDataSegment.SUFFIX)
+
+    def __new_name(self):
+        """
+        新しいセグメントのファイル名を返す。(例: 20240101120000_data.jsonl)
+        ファイル名の順序が作成順になるよう、既存のものより後の時刻とする。
+        """
+        now = datetime.now().replace(microsecond=0)
+        if len(self.__segments) > 0:
+            last = datetime.strptime(self.__segments[-1].split('_')[0], '%Y%m%d%H%M%S')
+            if now <= last:
+                now = last + timedelta(seconds=1)
+        return now.strftime('%Y%m%d%H%M%S') + '_' + self.stem + SystemDataSegment.SUFFIX
+
+    def __rotate(self):
+        """
+        新しいセグメントを作成し、書き込み先とする。
+        """
+        name = self.__new_name()
+        self.__segments.append(name)
+        self.active = SystemDataSegment(self.dir_path / name)
+        self.__enforce_retention()
+
+    def __enforce_retention(self):
+        """
+        保持数を超えた古いセグメントを削除待ちにする。
+        """
+        while len(self.__segments) > self.file_num:
+            path = self.dir_path / self.__segments.popleft()
+            self.expired.append(str(path))
+            legacy_path = path.with_suffix(SystemDataSegment.LEGACY_SUFFIX)
+            self.expired.append(str(legacy_path))
+
+    def append(self, record):
+        """
+        書き込み中のセグメントにレコードを追記する。
+        レコード数がrecord_numに達したら封をして、次のセグメントへ切り替える。
+        :return: (書き込んだセグメントのパス, 封をしたか)
+        """
+        if self.active is None:
+            self.__rotate()
+        segment = self.active
+        segment.append(record)
+        sealed = segment.count >= self.record_num
+        if sealed:
+            if self.legacy_export:
+                # サーバが従来形式を必要とする場合は、data.jsonの形式でも出力する。(呼び出し側がバックグラウンドで行う)
+                self.exports.append(segment)
+            self.active = None
+        return (segment.path, sealed)
+
+    def sealed_paths(self):
+        """
+        封をしたセグメントのパスを古い順に返す。
+        """
+        active = self.active.path if self.active is not None else None
+        return [str(self.dir_path / name) for name in self.__segments
+                if str(self.dir_path / name) != active]
+
+    def take_expired(self):
+        """
+        削除待ちのセグメントのパスを取り出す。
+        """
+        expired = self.expired
+        self.expired = []
+        return expired
+
+    def take_exports(self):
+        """
+        従来形式での出力待ちのセグメントを取り出す。出力(export_legacy)は別スレッドで行うこと。
+        """
+        exports = self.exports
+        self.exports = []
+        return exports
+
+    def remove_files(self, paths):
+        """
+        セグメントを削除する。時間がかかる場合があるので別スレッドで呼ぶこと。
+        """
+        for path in paths:
+            try:
+                os.remove(path)
+                self.logger.info(f'{path} removed.')
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                self.logger.error('%s', e)
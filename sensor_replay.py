@@ -0,0 +1,198 @@
+import asyncio
+import csv
+import re
+import time
+from logging import getLogger
+import numpy as np
+
+
+class KnetCsvReader:
+    """
+    K-NET形式のCSV(TestData/AA06EA01.csvなど)を読み込む。
+    ファイル全体は読み込まず、chunk_size行ずつ配列にして返す。
+    """
+    DATA_HEADER = 'NS,EW,UD'
+
+    def __init__(self, path, chunk_size=1024):
+        """
+        :param path: CSVファイルのパス
+        :param chunk_size: 一度に読み込む行数
+        """
+        self.path = path
+        self.chunk_size = chunk_size
+        self.fs = None
+        # ヘッダのみ読み込み、サンプリング周波数を取得する。
+        with open(self.path, 'r', encoding='utf-8', errors='replace') as file:
+            self.__read_header(file)
+
+    def __read_header(self, file):
+        """
+        データの列名の行までを読み飛ばし、サンプリング周波数を取得する。
+        """
+        for line in file:
+            if 'SAMPLING RATE' in line:
+                self.fs = float(re.search(r'[0-9.]+', line.split('=')[1]).group())
+            if line.strip().replace(' ', '') == self.DATA_HEADER:
+                return
+        raise ValueError(f'{self.path} has no {self.DATA_HEADER} header')
+
+    def iter_chunks(self):
+        """
+        加速度(gal)をshape (3, n)の配列で順に返す。
+        """
+        with open(self.path, 'r', encoding='utf-8', errors='replace') as file:
+            self.__read_header(file)
+            rows = []
+            for row in csv.reader(file):
+                if len(row) < 3:
+                    continue
+                rows.append((float(row[0]), float(row[1]), float(row[2])))
+                if len(rows) >= self.chunk_size:
+                    yield np.array(rows).T
+                    rows = []
+            if len(rows) > 0:
+                yield np.array(rows).T
+
+
+class ReplayAccelSensor:
+    """
+    LIS2DH12の代わりに、K-NET形式のCSVの加速度を再生する。
+    経過時間(speed倍)に応じたデータをFIFOに見立てて返すため、
+    ハードウェアなしでPvswMasterのセンサ・アラーム処理を動作させることができる。
+    """
+    FIFO_SIZE = 32
+
+    def __init__(self, path, odr=100, speed=1.0, repeat=False, fifo_size=None):
+        """
+        :param path: K-NET形式のCSVファイルのパス
+        :param odr: 出力データレート(Hz)。CSVのサンプリング周波数の約数であること。
+        :param speed: 再生速度(実時間の何倍か)
+        :param repeat: ファイルの最後まで再生したら先頭に戻るか
+        :param fifo_size: FIFOの容量。Noneの場合はspeedに合わせて32×speedとする。
+        """
+        self.logger = getLogger(__name__)
+        self.odr = odr
+        self.speed = speed
+        self.repeat = repeat
+        self.fifo_size = fifo_size if fifo_size is not None else max(self.FIFO_SIZE, int(self.FIFO_SIZE * speed))
+        self.overrun_count = 0
+        self.watermark = 16
+        self.__reader = KnetCsvReader(path)
+        if self.__reader.fs is None or self.__reader.fs % odr != 0:
+            raise ValueError(f'cannot resample {self.__reader.fs}Hz to {odr}Hz')
+        # CSVのサンプリング周波数からodrへ間引く間隔
+        self.__decimation = int(self.__reader.fs // odr)
+        self.__chunks = self.__iter_samples()
+        self.__buf = np.empty((3, 0))
+        self.__start_time = None
+        self.__emitted = 0  # 読み出し済みまたは捨てたサンプル数
+        self.finished = False
+
+    def __iter_samples(self):
+        """
+        odrに間引いた加速度(m/s^2)をchunkごとに返す。
+        """
+        offset = 0
+        while True:
+            for chunk in self.__reader.iter_chunks():
+                # chunkをまたいでも間引き位置がずれないようにする。
+                start = (-offset) % self.__decimation
+                offset += chunk.shape[1]
+                # 単位変換(gal->m/s^2)
+                yield chunk[:, start::self.__decimation] / 100.0
+            if not self.repeat:
+                return
+
+    def __take(self, n):
+        """
+        再生データから先頭n個を取り出す。ファイル終端では少なくなる。
+        """
+        while self.__buf.shape[1] < n and not self.finished:
+            try:
+                self.__buf = np.concatenate((self.__buf, next(self.__chunks)), axis=1)
+            except StopIteration:
+                self.finished = True
+                self.logger.info('replay finished')
+        data = self.__buf[:, :n]
+        self.__buf = self.__buf[:, n:]
+        return data
+
+    def __due(self):
+        """
+        再生開始からの経過時間に対して、まだ取り出していないサンプル数を返す。
+        """
+        now = time.monotonic()
+        if self.__start_time is None:
+            self.__start_time = now
+        return int((now - self.__start_time) * self.speed * self.odr) - self.__emitted
+
+    def get_accel_array(self) -> (np.ndarray, np.ndarray, np.ndarray):
+        """
+        FIFOに溜まっている分のデータを配列状にして返す。
+        FIFOの容量を超えた分は実機と同様に古いものから捨て、overrunとして数える。
+        """
+        due = self.__due()
+        if due > self.fifo_size:
+            self.overrun_count += 1
+            self.logger.warning(f'fifo overrun:{self.overrun_count:0}')
+            self.__take(due - self.fifo_size)
+            self.__emitted += due - self.fifo_size
+            due = self.fifo_size
+        data = self.__take(max(due, 0))
+        self.__emitted += max(due, 0)
+        return (data[0], data[1], data[2])
+
+    def enable_fifo_interrupt(self, watermark=16, pin_factory=None):
+        """
+        LIS2DH12と同じインターフェース。ウォーターマークのみ設定する。
+        """
+        self.watermark = watermark
+
+    async def wait_accel_array(self, io=None) -> (np.ndarray, np.ndarray, np.ndarray):
+        """
+        ウォーターマーク分のデータが溜まる時間まで待機し、データを返す。
+        :param io: LIS2DH12と同じインターフェース。指定した場合はそのスレッドで読み出す。
+        """
+        lack = self.watermark - self.__due()
+        if lack > 0:
+            await asyncio.sleep(lack / (self.odr * self.speed))
+        if io is not None:
+            return await io.call('lis2dh12', self.get_accel_array)
+        return self.get_accel_array()
+
+    def get_temp(self):
+        pass
+
+
+class ReplayWetSensor:
+    """
+    ADC081C021の代わりに、指定した電圧の変化を再生する。
+    """
+    FILT_PARAM = 0.25
+
+    def __init__(self, steps=None, speed=1.0):
+        """
+        :param steps: (再生開始からの時間(sec), 電圧(V))のリスト。時間順に並べる。
+        :param speed: 再生速度(実時間の何倍か)
+        """
+        self.__logger = getLogger(__name__)
+        self.__steps = steps if steps is not None else [(0.0, 0.0)]
+        self.__speed = speed
+        self.__start_time = None
+        self.filtered_data = 0.0
+        self.__filt_buf = 0.0
+
+    def set_adc_data(self):
+        now = time.monotonic()
+        if self.__start_time is None:
+            self.__start_time = now
+        elapsed = (now - self.__start_time) * self.__speed
+        data = 0.0
+        for step_time, volt in self.__steps:
+            if step_time > elapsed:
+                break
+            data = volt
+        # 一時遅れフィルタで計算を行う。(ADC081C021と同じ)
+        self.__filt_buf += data - self.filtered_data
+        self.filtered_data = self.__filt_buf * self.FILT_PARAM
+        self.__logger.debug(self.filtered_data)
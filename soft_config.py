@@ -15,15 +15,26 @@ class SoftConfig(object):
                      control_name='control.json', system_data_name='data.json',
                      parameter_list_master_name="parameterListMaster.json",
                      parameter_list_slave_name='parameterListSlave',
-                     system_data_len=1024, system_data_file_num=10):
+                     system_data_len=1024, system_data_file_num=10,
+                     system_data_legacy_export=False, system_data_keyframe_interval=30,
+                     system_data_upload_interval=60.0):
             self.config_path = config_path
             self.control_path = control_path
             self.system_data_path = data_path
+            # 設定ファイルを読み込めない場合も起動できるよう、同期スクリプトにも初期値を設ける。
+            self.script_path = './Script/'
+            self.script_name = 'mySync.sh'
             self.config_name = config_name
             self.control_name = control_name
             self.system_data_name = system_data_name
             self.system_data_len = system_data_len
             self.system_data_file_num = system_data_file_num
+            # 封をしたセグメントを従来のdata.jsonの形式でも出力するか
+            self.system_data_legacy_export = system_data_legacy_export
+            # 全ての値を保存する(keyframe)間隔。その間は変化した値のみを保存する。1の場合は常に全て保存する。
+            self.system_data_keyframe_interval = system_data_keyframe_interval
+            # 書き込み中のセグメントをサーバへアップロードする最短の間隔(sec)。封をしたセグメントは直ちに行う。
+            self.system_data_upload_interval = system_data_upload_interval
             self.parameter_list_master_name = parameter_list_master_name
             # slaveの種類は複数に渡るため、共通するbasenameを指定する。
             self.parameter_list_slave_name = parameter_list_slave_name
@@ -39,6 +50,11 @@ class SoftConfig(object):
             self.system_data_name = json_data['system_data_name']
             self.system_data_len = json_data['system_data_len']
             self.system_data_file_num = json_data['system_data_file_num']
+            self.system_data_legacy_export = json_data.get('system_data_legacy_export', self.system_data_legacy_export)
+            self.system_data_keyframe_interval = json_data.get('system_data_keyframe_interval',
+                                                               self.system_data_keyframe_interval)
+            self.system_data_upload_interval = json_data.get('system_data_upload_interval',
+                                                             self.system_data_upload_interval)
             self.script_name = json_data['script_name']
             self.parameter_list_master_name = json_data['parameter_list_master_name']
             self.parameter_list_slave_name = json_data['parameter_list_slave_name']
@@ -88,6 +104,39 @@ class SoftConfig(object):
         def __init__(self):
             self.master_interval_time = 5
             self.control_filecheck_interval_time = 0.25
+            self.accel_sensor_interval_time = 0.2
+            # サーバからcontrol, configファイルをダウンロードする周期
+            self.remote_fetch_interval_time = 30
+            # 計測震度の計算方法('fft' or 'stream')
+            self.seismometer_mode = 'fft'
+            # 計測震度の計算を行うexecutor('thread', 'process' or 'none'(イベントループ上で計算))
+            self.scale_executor = 'thread'
+            # 加速度センサの取得方法('poll'(周期読み出し) or 'interrupt'(FIFOウォーターマーク割り込み))
+            self.accel_acquisition_mode = 'poll'
+            # interrupt時のFIFOウォーターマーク(1-31)
+            self.accel_fifo_watermark = 16
+            # slaveの応答を待つ時間(sec)
+            self.slave_response_timeout = 0.5
+            # slave 1台あたり、応答を待たずに送信できる要求の数
+            self.slave_pipeline_depth = 4
+            # 1つの要求('BR'/'BW')で読み書きするパラメータ数の上限
+            self.slave_batch_size = 16
+            # slaveの読み出しに使用するCANバス使用率の上限(0.0-1.0)
+            self.slave_bus_load_limit = 0.5
+            # slaveのソフトのダウンロードに使用するCANバス使用率の上限(0.0-1.0)
+            self.slave_download_bus_load_limit = 0.3
+            # ソフトのダウンロードで確認応答を待たずに送信するブロック数
+            self.slave_download_window = 2
+            # SPI, I2C, gpioの読み書きを行う方法('thread'(バスごとのスレッド) or 'none'(イベントループ上))
+            self.io_executor = 'thread'
+            # 周期タスクの処理が次の周期を超えた場合の動作('skip', 'catch_up' or 'coalesce')
+            self.task_overrun_policy = {'sensor': 'coalesce', 'control_file_check': 'coalesce',
+                                        'system_data': 'coalesce', 'remote_fetch': 'skip', 'metrics': 'skip'}
+            # メトリクスをData directoryのファイルへ出力する周期(sec)(0: 出力しない)とファイル名
+            self.metrics_interval_time = 10
+            self.metrics_file_name = 'metrics.prom'
+            # メトリクスをHTTP(127.0.0.1)で提供するポート(0: 提供しない)
+            self.metrics_http_port = 0
         
         def get_from_file(self, json_data):
             """
@@ -97,8 +146,34 @@ class SoftConfig(object):
             self.master_interval_time = json_data['master_interval_time']
             # controlファイルの更新チェック周期
             self.control_filecheck_interval_time = json_data['control_filecheck_interval_time']
-            # accelセンサのデータ取得周期
-            self.accel_sensor_interval_time = json_data['accel_sensor_interval_time']
+            # サーバからcontrol, configファイルをダウンロードする周期(省略時は30sec)
+            self.remote_fetch_interval_time = json_data.get('remote_fetch_interval_time', self.remote_fetch_interval_time)
+            # accelセンサのデータ取得周期(省略時は0.2sec。FIFO(32個)が100Hzで満杯になる前に読み出す。)
+            self.accel_sensor_interval_time = json_data.get('accel_sensor_interval_time', self.accel_sensor_interval_time)
+            # 計測震度の計算方法(省略時は従来のfft)
+            self.seismometer_mode = json_data.get('seismometer_mode', self.seismometer_mode)
+            # 計測震度の計算を行うexecutor(省略時はthread)
+            self.scale_executor = json_data.get('scale_executor', self.scale_executor)
+            # 加速度センサの取得方法(省略時はpoll)
+            self.accel_acquisition_mode = json_data.get('accel_acquisition_mode', self.accel_acquisition_mode)
+            self.accel_fifo_watermark = json_data.get('accel_fifo_watermark', self.accel_fifo_watermark)
+            # slaveとの通信(省略時は0.5sec, 4要求)
+            self.slave_response_timeout = json_data.get('slave_response_timeout', self.slave_response_timeout)
+            self.slave_pipeline_depth = json_data.get('slave_pipeline_depth', self.slave_pipeline_depth)
+            self.slave_batch_size = json_data.get('slave_batch_size', self.slave_batch_size)
+            self.slave_bus_load_limit = json_data.get('slave_bus_load_limit', self.slave_bus_load_limit)
+            # slaveのソフトのダウンロード(省略時は使用率0.3, 2ブロック)
+            self.slave_download_bus_load_limit = json_data.get('slave_download_bus_load_limit',
+                                                               self.slave_download_bus_load_limit)
+            self.slave_download_window = json_data.get('slave_download_window', self.slave_download_window)
+            # SPI, I2C, gpioの読み書き(省略時はthread)
+            self.io_executor = json_data.get('io_executor', self.io_executor)
+            # 周期タスクのoverrun時の動作(省略したタスクは既定のまま)
+            self.task_overrun_policy = {**self.task_overrun_policy, **json_data.get('task_overrun_policy', {})}
+            # メトリクス(省略時は10secごとにmetrics.promへ出力し、HTTPでは提供しない)
+            self.metrics_interval_time = json_data.get('metrics_interval_time', self.metrics_interval_time)
+            self.metrics_file_name = json_data.get('metrics_file_name', self.metrics_file_name)
+            self.metrics_http_port = json_data.get('metrics_http_port', self.metrics_http_port)
 
     # Configファイルの読込
     CONFIG_PATH = '/home/pi/App/Config/'
@@ -109,9 +184,12 @@ class SoftConfig(object):
     def __new__(cls):
         if not hasattr(cls, '_instance'):
             cls._instance = super().__new__(cls)
-            return cls._instance
+        return cls._instance
         
     def __init__(self):
+        # 2回目以降は読み込み済みの設定を使用する。
+        if hasattr(self, 'pvsw_config'):
+            return
         self.logger = getLogger(__name__)
         # config.jsonの名前と場所は固定する。
         self.file_config = SoftConfig.FileConfig(config_path=self.CONFIG_PATH, config_name=self.CONFIG_NAME)
@@ -125,27 +203,24 @@ class SoftConfig(object):
         設定ファイルのデータを格納する。
         """
         self.logger.info('read config file.')
-        try:
-            self.file_config.get_from_file(json_data['file_config'])
-            self.can_config.get_from_file(json_data['can_config'])
-            self.j1939_config.get_from_file(json_data['j1939_config'])
-            self.pvsw_config.get_from_file(json_data['pvsw_config'])
-        except Exception as e:
-            self.logger.error('error on %s', e)
-            self.logger.info('read ' + self.CONFIG_PATH + self.DEF_CONFIG_NAME)
-            # DEF_CONFIG_JSON_PATHで再設定する。
-            self.read_file(self.CONFIG_PATH + self.DEF_CONFIG_NAME)
+        self.file_config.get_from_file(json_data['file_config'])
+        self.can_config.get_from_file(json_data['can_config'])
+        self.j1939_config.get_from_file(json_data['j1939_config'])
+        self.pvsw_config.get_from_file(json_data['pvsw_config'])
 
     def read_file(self, config_path=CONFIG_PATH + CONFIG_NAME):
         """
         設定ファイルを読み込む。
+        読み込めない場合はdefault_config.jsonを1回だけ読み込み、それも読み込めない場合は初期値のままとする。
+        :return: 読み込めたか
         """
-        try:
-            with open(config_path, 'r', encoding='utf-8') as file:
-                json_load = json.load(file)
-            self.__read_config(json_load)
-        except Exception as e:
-            self.logger.error('error on %s', e)
-            self.logger.info('read ' + self.CONFIG_PATH + self.DEF_CONFIG_NAME)
-            # DEF_CONFIG_JSON_PATHで再設定する。
-            self.read_file(self.CONFIG_PATH + self.DEF_CONFIG_NAME)
+        for path in (config_path, self.CONFIG_PATH + self.DEF_CONFIG_NAME):
+            try:
+                with open(path, 'r', encoding='utf-8') as file:
+                    json_load = json.load(file)
+                self.__read_config(json_load)
+                return True
+            except Exception as e:
+                self.logger.error('error on %s: %s', path, e)
+        self.logger.warning('use default settings.')
+        return False
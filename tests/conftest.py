@@ -0,0 +1,14 @@
+"""
+テストの共通設定
+ハードウェア(spidev, smbus)はベンチマークと同じ偽物に置き換えるため、実機以外でも実行できる。
+"""
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / 'Benchmark'))
+
+from benchmark import install_fake_hardware  # noqa: E402
+
+install_fake_hardware()
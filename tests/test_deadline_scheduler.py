@@ -0,0 +1,46 @@
+"""
+周期タスクのoverrunの記録
+"""
+import asyncio
+import pytest
+from deadline_scheduler import DeadlineScheduler
+
+
+def run_with_stall(policy, stall=0.35, interval=0.1, duration=0.8):
+    """
+    最初の1回のみstall(sec)かかるタスクを実行し、TaskStatsを返す。
+    """
+    scheduler = DeadlineScheduler()
+    calls = []
+
+    async def work():
+        calls.append(None)
+        if len(calls) == 1:
+            await asyncio.sleep(stall)
+
+    async def run():
+        task = asyncio.create_task(scheduler.run('stall', work, interval, policy))
+        await asyncio.sleep(duration)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(run())
+    return scheduler.stats['stall']
+
+
+@pytest.mark.parametrize('policy, skipped, caught_up', [
+    (DeadlineScheduler.SKIP, 3, 0),
+    (DeadlineScheduler.COALESCE, 2, 0),
+    (DeadlineScheduler.CATCH_UP, 0, 3),
+])
+def test_one_stall_is_one_overrun(policy, skipped, caught_up):
+    """
+    1回の遅れは動作によらずoverrun 1回とし、過ぎた周期(0.1, 0.2, 0.3秒)の扱いは別に数える。
+    """
+    stats = run_with_stall(policy)
+    assert stats.overrun_count == 1
+    assert stats.missed_count == 3
+    assert stats.skipped_count == skipped
+    assert stats.caught_up_count == caught_up
+    assert stats.failure_count == 0
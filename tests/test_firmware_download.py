@@ -0,0 +1,54 @@
+"""
+slaveへのファームウェアのダウンロードの中断
+"""
+import asyncio
+import pytest
+from firmware_download import FirmwareDownloader
+
+
+class FakeSlave:
+    """
+    ダウンロードの要求に一定の遅れで応答するslave
+    """
+
+    def __init__(self, address=0x10, delay=0.02):
+        self.address = address
+        self.delay = delay
+        self.blocks = []
+
+    async def request(self, key, data, timeout=None):
+        if key == b'DS':
+            return [0, 0, 0, 0]
+        if key[:2] == b'DA':
+            self.blocks.append(int.from_bytes(bytes(data[2:6]), 'little'))
+            await asyncio.sleep(self.delay)
+            return [FirmwareDownloader.STATUS_OK]
+        return [FirmwareDownloader.STATUS_OK]
+
+
+def test_cancelled_download_stops_sending_and_closes_image(tmp_path):
+    """
+    キャンセルしたダウンロードは送信中のブロックを止め、mmapを閉じてCancelledErrorを返す。
+    """
+    path = tmp_path / 'firmware.bin'
+    path.write_bytes(bytes(range(256)) * 64)
+    slave = FakeSlave()
+    downloader = FirmwareDownloader(bitrate=1000000, max_cmdt_packets=1, bus_load_limit=1.0, window=4)
+    assert downloader.block_size * 10 < path.stat().st_size
+
+    async def run():
+        task = asyncio.create_task(downloader.download(slave, path))
+        await asyncio.sleep(slave.delay * 3.5)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        sent = len(slave.blocks)
+        await asyncio.sleep(slave.delay * 5)
+        return sent
+
+    sent = asyncio.run(run())
+    assert 0 < sent == len(slave.blocks)
+    assert not downloader.results[slave.address]['success']
+    # 中断後は同じslaveへのダウンロードを再び開始できる。
+    slave.delay = 0.0
+    assert asyncio.run(downloader.download(slave, path))
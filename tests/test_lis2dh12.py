@@ -0,0 +1,67 @@
+"""
+LIS2DH12のFIFOウォーターマーク割り込み(INT1)での取得
+INT1はgpiozeroのMockFactory、SPIはベンチマークのFakeSpiDevで置き換える。
+"""
+import asyncio
+import threading
+import time
+import pytest
+from gpiozero.pins.mock import MockFactory
+from lis2dh12 import LIS2DH12
+
+WATERMARK = 16
+
+
+@pytest.fixture
+def sensor():
+    factory = MockFactory()
+    lis2dh12 = LIS2DH12(odr=100)
+    lis2dh12.enable_fifo_interrupt(WATERMARK, pin_factory=factory)
+    yield (lis2dh12, factory.pin(LIS2DH12.INT1_GPIO))
+    factory.reset()
+
+
+def test_int1_wakes_reader(sensor):
+    """
+    INT1の立ち上がりで、タイムアウトを待たずに読み出す。
+    """
+    (lis2dh12, pin) = sensor
+
+    async def run():
+        threading.Timer(0.05, pin.drive_high).start()
+        start = time.perf_counter()
+        result = await lis2dh12.wait_accel_array()
+        return (time.perf_counter() - start, result)
+    (elapsed, (x, y, z)) = asyncio.run(run())
+    assert 0.04 <= elapsed < 0.2
+    assert len(x) == len(y) == len(z) == LIS2DH12.FIFO_SIZE
+
+
+def test_timeout_fallback(sensor):
+    """
+    割り込みがない場合は、ウォーターマーク2回分の時間で読み出す。
+    """
+    (lis2dh12, _) = sensor
+
+    async def run():
+        start = time.perf_counter()
+        result = await lis2dh12.wait_accel_array()
+        return (time.perf_counter() - start, result)
+    (elapsed, (x, _, _)) = asyncio.run(run())
+    assert 2.0 * WATERMARK / lis2dh12.odr <= elapsed < 0.6
+    assert len(x) == LIS2DH12.FIFO_SIZE
+
+
+def test_active_level_reads_immediately(sensor):
+    """
+    INT1がアクティブのままであれば、次の立ち上がりを待たずに読み出す。
+    """
+    (lis2dh12, pin) = sensor
+
+    async def run():
+        pin.drive_high()
+        await lis2dh12.wait_accel_array()
+        start = time.perf_counter()
+        await lis2dh12.wait_accel_array()
+        return time.perf_counter() - start
+    assert asyncio.run(run()) < 0.05
@@ -0,0 +1,123 @@
+"""
+controlファイルの書き込みデータの検証と反映、system_dataの差分の出力
+"""
+import asyncio
+import copy
+import json
+import pytest
+from file_process import FileProcess
+from pvsw_parameter import PvswParam
+from soft_config import SoftConfig
+
+
+def leaf(value_type, value, write_enable, command=None):
+    node = {'type': {'type': value_type, 'value': value, 'writeEnable': write_enable}}
+    if command is not None:
+        node['command'] = command
+    return node
+
+
+@pytest.fixture
+def param(tmp_path):
+    master = {'name': 'master', 'parameters': {'mainParameter': {'parameters': {
+        'status': leaf('int', 0, False),
+        'en_24V': leaf('uint', 0, True),
+        'seismic_threshold': leaf('float', 5.0, True),
+    }}}}
+    slave = {'parameters': {
+        'programName': leaf('str', 'pvsw_slave', False, '0001'),
+        'volt': leaf('float', 24.0, False, '0002'),
+        'offset': leaf('int', 0, True, '0003'),
+    }}
+    (tmp_path / 'parameterListMaster.json').write_text(json.dumps(master), encoding='utf-8')
+    (tmp_path / 'parameterListSlave.json').write_text(json.dumps(slave), encoding='utf-8')
+    file_config = SoftConfig.FileConfig(config_path=str(tmp_path) + '/',
+                                        parameter_list_slave_name='parameterListSlave.json')
+    return PvswParam(file_config)
+
+
+def test_valid_write_returns_changed_slots(param):
+    """
+    全ての項目が書き込める場合は反映し、値が変化したslotのみを返す。
+    """
+    changed = param.set_param_write_value({'parameters': {
+        'mainParameter': {'en_24V': 1, 'seismic_threshold': 5.0},
+        'slave_0001': {'offset': -3},
+    }})
+    assert sorted(slot.path for slot in changed) == [('mainParameter', 'en_24V'), ('slave_0001', 'offset')]
+    assert param.handle('mainParameter', 'en_24V').value == 1
+    assert param.handle('slave_0001', 'offset').value == -3
+    # 同じ値の書き込みは変化なしとする。
+    assert param.set_param_write_value({'parameters': {'mainParameter': {'en_24V': 1}}}) == []
+
+
+@pytest.mark.parametrize('parameters, error', [
+    ({'mainParameter': {'unknown': 1}}, 'mainParameter/unknown: unknown parameter'),
+    ({'mainParameter': {'status': 1}}, 'mainParameter/status: read only'),
+    ({'mainParameter': {'en_24V': -1}}, "mainParameter/en_24V: -1 is not uint"),
+    ({'mainParameter': {'en_24V': 0x100000000}}, 'mainParameter/en_24V: 4294967296 is not uint'),
+    ({'slave_0001': {'offset': 1.5}}, 'slave_0001/offset: 1.5 is not int'),
+    ({'mainParameter': {'seismic_threshold': '6'}}, "mainParameter/seismic_threshold: '6' is not float"),
+    ({'mainParameter': {'seismic_threshold': 1e40}}, 'mainParameter/seismic_threshold: 1e+40 is not float'),
+    ({'mainParameter': {'seismic_threshold': -1e40}}, 'mainParameter/seismic_threshold: -1e+40 is not float'),
+    ({'mainParameter': {'seismic_threshold': 10 ** 40}}, f'mainParameter/seismic_threshold: {10 ** 40} is not float'),
+    ({'mainParameter': {'seismic_threshold': float('inf')}}, 'mainParameter/seismic_threshold: inf is not float'),
+    ({'mainParameter': {'seismic_threshold': float('nan')}}, 'mainParameter/seismic_threshold: nan is not float'),
+    ({'mainParameter': {'seismic_threshold': True}}, 'mainParameter/seismic_threshold: True is not float'),
+    ({'mainParameter': {'en_24V': True}}, 'mainParameter/en_24V: True is not uint'),
+    ({'slave_0001': {'offset': False}}, 'slave_0001/offset: False is not int'),
+    ({'mainParameter': 1}, 'mainParameter: group cannot be written'),
+])
+def test_invalid_entry_rejects_whole_document(param, parameters, error):
+    """
+    書き込めない項目が1つでもあれば、他の正しい項目も反映しない。
+    """
+    document = {'parameters': copy.deepcopy(parameters)}
+    # 正しい項目を1つ加える。
+    document['parameters'].setdefault('slave_0001', {}).setdefault('offset', 7)
+    (_, errors) = param.validate_write(document)
+    assert error in errors
+    assert param.set_param_write_value(document) == []
+    assert param.handle('slave_0001', 'offset').value == 0
+
+
+@pytest.mark.parametrize('value', [PvswParam.FLOAT_MAX, -PvswParam.FLOAT_MAX, 0, 1e-40])
+def test_float_within_single_precision_is_accepted(param, value):
+    """
+    単精度で送信できる範囲のfloatは書き込める。
+    """
+    assert param.validate_write({'parameters': {'mainParameter': {'seismic_threshold': value}}})[1] == []
+
+
+def test_missing_parameters_is_rejected(param):
+    assert param.validate_write({'command': 'x'}) == ([], ['parameters is not found'])
+    assert param.set_param_write_value([]) == []
+
+
+def test_delta_baseline_advances_only_after_commit(param):
+    """
+    保存できなかったレコードで変化した値は、次の差分にも含める。
+    """
+    status = param.handle('mainParameter', 'status')
+    assert param.get_system_data_delta()['keyframe'] is True
+    param.commit_system_data_delta()
+    status.value = 1
+    lost = param.get_system_data_delta()
+    assert lost == {'parameters': {'mainParameter': {'status': 1}}, 'keyframe': False}
+    # 保存に失敗した(commitしない)場合は、同じ変化をもう一度出力する。
+    param.handle('slave_0001', 'volt').value = 23.5
+    retry = param.get_system_data_delta()
+    assert retry == {'parameters': {'mainParameter': {'status': 1}, 'slave_0001': {'volt': 23.5}}, 'keyframe': False}
+    param.commit_system_data_delta()
+    assert param.get_system_data_delta() == {'parameters': {}, 'keyframe': False}
+
+
+def test_failed_save_is_reported(tmp_path):
+    """
+    セグメントに追記できない場合、save_system_dataはFalseを返す。
+    """
+    data_path = tmp_path / 'Data'
+    data_path.write_text('not a directory', encoding='utf-8')
+    file_process = FileProcess(SoftConfig.FileConfig(data_path=str(data_path)))
+    record = {'parameters': {'mainParameter': {'status': 0}}, 'keyframe': True}
+    assert asyncio.run(file_process.save_system_data(record)) is False
@@ -0,0 +1,83 @@
+"""
+PvswSlaveの要求と応答の対応付け
+"""
+import asyncio
+import struct
+import pytest
+
+# can_communicationが使用するcan-j1939がない環境では実行しない。
+pytest.importorskip('j1939')
+
+from pvsw_slave import PvswSlave  # noqa: E402
+
+ADDRESS = 0x10
+
+
+class FakeCan:
+    """
+    送信したデータを記録し、応答はテストから渡すCanCommunication
+    """
+
+    def __init__(self):
+        self.ca = self
+        self.sent = []
+        self.handler = None
+
+    def attach_loop(self, loop=None):
+        pass
+
+    def subscribe(self, pgn, sa, fn):
+        self.handler = fn
+
+    def send_pgn(self, data_page, pdu_format, pdu_specific, priority, data):
+        self.sent.append(bytes(data))
+        return True
+
+    def reply(self, data):
+        self.handler(ADDRESS, list(data))
+
+
+def block_ack(index):
+    return b'DA' + struct.pack('<I', index)
+
+
+def test_download_blocks_are_pipelined_before_header_echo():
+    """
+    ヘッダを付けることを確認していないslaveにも、ファームウェアのブロックは確認応答を待たずに送信する。
+    """
+    can = FakeCan()
+    slave = PvswSlave(can, {}, ADDRESS)
+
+    async def run():
+        tasks = [asyncio.create_task(slave.request(block_ack(index), list(b'DB' + bytes(8)), timeout=1.0))
+                 for index in range(3)]
+        await asyncio.sleep(0.01)
+        assert len(can.sent) == 3
+        for index in reversed(range(3)):
+            can.reply(block_ack(index) + bytes([index]))
+        return await asyncio.gather(*tasks)
+
+    assert asyncio.run(run()) == [[0], [1], [2]]
+    assert slave.header_echo is None
+
+
+def test_reply_without_header_goes_to_single_command():
+    """
+    ヘッダのない応答は、並列に送信した'D'の要求ではなく、待っている'CR'への応答とする。
+    """
+    can = FakeCan()
+    slave = PvswSlave(can, {}, ADDRESS)
+
+    async def run():
+        block = asyncio.create_task(slave.request(block_ack(0), list(b'DB' + bytes(8)), timeout=1.0))
+        single = asyncio.create_task(slave.request(b'\x00\x02', list(b'CR\x00\x02\x00\x00'), timeout=1.0))
+        await asyncio.sleep(0.01)
+        assert len(can.sent) == 2
+        can.reply(struct.pack('<f', 24.0))
+        can.reply(block_ack(0) + b'\x00')
+        return (await single, await block)
+
+    (single, block) = asyncio.run(run())
+    assert single == list(struct.pack('<f', 24.0))
+    assert block == [0]
+    assert slave.header_echo is False
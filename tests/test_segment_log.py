@@ -0,0 +1,80 @@
+"""
+system_dataのセグメント(JSON Lines)の復旧と従来形式での出力
+"""
+import json
+from pathlib import Path
+from segment_log import SegmentManager, SystemDataSegment
+
+
+def record(value, keyframe=True):
+    return {'parameters': {'mainParameter': {'status': 0, 'wet': value}}, 'keyframe': keyframe}
+
+
+def test_torn_record_is_removed(tmp_path):
+    """
+    書き込み途中で停止した最終行は、開き直したときに削除する。
+    """
+    path = tmp_path / '20240101000000_data.jsonl'
+    segment = SystemDataSegment(path)
+    segment.append(record(1))
+    segment.append(record(2))
+    with open(path, 'ab') as file:
+        file.write(b'{"master_data_00000002":{"param')
+    recovered = SystemDataSegment(path)
+    assert recovered.count == 2
+    assert path.read_bytes().endswith(b'\n')
+    assert [key for key, _ in recovered.records()] == ['master_data_00000000', 'master_data_00000001']
+    # 続けて追記した行は次の番号になる。
+    recovered.append(record(3))
+    assert list(recovered.records())[-1][0] == 'master_data_00000002'
+
+
+def test_manager_resumes_active_segment(tmp_path):
+    """
+    再起動後は最も新しい封をしていないセグメントに続けて書き込み、record_numで切り替える。
+    """
+    manager = SegmentManager(tmp_path, 'data.json', record_num=3, file_num=10)
+    (first, _) = manager.append(record(1))
+    manager = SegmentManager(tmp_path, 'data.json', record_num=3, file_num=10)
+    assert manager.append(record(2)) == (first, False)
+    assert manager.append(record(3)) == (first, True)
+    (second, sealed) = manager.append(record(4))
+    assert second != first and not sealed
+    assert manager.sealed_paths() == [first]
+
+
+def test_retention_expires_oldest_segments(tmp_path):
+    """
+    保持数を超えたセグメントは、従来形式のファイルと合わせて削除待ちにする。
+    """
+    manager = SegmentManager(tmp_path, 'data.json', record_num=1, file_num=2)
+    paths = [manager.append(record(value))[0] for value in range(4)]
+    expired = manager.take_expired()
+    assert expired == [paths[0], str(Path(paths[0]).with_suffix('.json')),
+                       paths[1], str(Path(paths[1]).with_suffix('.json'))]
+    manager.remove_files(expired)
+    assert sorted(str(path) for path in tmp_path.iterdir()) == paths[2:]
+    assert manager.sealed_paths() == paths[2:]
+
+
+def test_export_legacy_restores_deltas(tmp_path):
+    """
+    封をしたセグメントは出力待ちとなり、差分を復元した従来のdata.jsonの形式で出力する。
+    """
+    manager = SegmentManager(tmp_path, 'data.json', record_num=3, file_num=10, legacy_export=True)
+    manager.append(record(1))
+    manager.append({'parameters': {'mainParameter': {'wet': 2}}, 'keyframe': False})
+    (path, sealed) = manager.append({'parameters': {}, 'keyframe': False})
+    assert sealed
+    [segment] = manager.take_exports()
+    assert segment.path == path
+    legacy_path = segment.export_legacy()
+    expected = {
+        'master_data_00000000': {'parameters': {'mainParameter': {'status': 0, 'wet': 1}}},
+        'master_data_00000001': {'parameters': {'mainParameter': {'status': 0, 'wet': 2}}},
+        'master_data_00000002': {'parameters': {'mainParameter': {'status': 0, 'wet': 2}}},
+    }
+    with open(legacy_path, 'r', encoding='utf-8') as file:
+        text = file.read()
+    assert json.loads(text) == expected
+    assert text == json.dumps(expected, indent=4)
@@ -0,0 +1,163 @@
+"""
+system_dataのアップロード(UploadManager)
+転送コマンドはtmp_pathに作成したスクリプトに置き換え、呼ばれた順と時刻を記録する。
+"""
+import asyncio
+import time
+from upload_manager import UploadManager
+
+
+def stub(tmp_path, delay=0.0, failures=0):
+    """
+    転送コマンドの代わりのスクリプトを作成する。
+    :param delay: 1回の転送にかかる時間(sec)
+    :param failures: 最初に失敗する回数
+    :return: (コマンド, 記録のパス)
+    """
+    log = tmp_path / 'calls.log'
+    script = tmp_path / 'sync.sh'
+    script.write_text(f'''#!/bin/sh
+echo "$(date +%s.%N) $1 $2" >> "{log}"
+sleep {delay}
+[ "$(wc -l < "{log}")" -gt {failures} ] || exit 1
+''', encoding='utf-8')
+    return (['sh', str(script)], log)
+
+
+def calls(log):
+    """
+    スクリプトが呼ばれた(時刻, ファイルのパス, サーバのディレクトリ)のリスト
+    """
+    if not log.exists():
+        return []
+    return [(float(time_text), path, server) for (time_text, path, server) in
+            (line.split() for line in log.read_text(encoding='utf-8').splitlines())]
+
+
+def segment(tmp_path, name):
+    path = tmp_path / name
+    path.write_text('{}\n', encoding='utf-8')
+    return str(path)
+
+
+async def wait_transfers(uploader, count, timeout=5.0):
+    end = time.monotonic() + timeout
+    while uploader.transfer_count + uploader.failure_count < count:
+        assert time.monotonic() < end, 'upload did not finish'
+        await asyncio.sleep(0.01)
+    # 完了後に続けて転送しないことを確認する。
+    await asyncio.sleep(0.2)
+
+
+def test_updates_during_transfer_are_coalesced(tmp_path):
+    """
+    転送中の更新は1回にまとめ、転送後に更新されていれば(更新回数が変わっていれば)もう一度転送する。
+    """
+    (command, log) = stub(tmp_path, delay=0.2)
+    active = segment(tmp_path, '20240101000000_data.jsonl')
+    uploader = UploadManager(command, 'Data', min_interval=0.0)
+
+    async def run():
+        uploader.mark_dirty(active)
+        await asyncio.sleep(0.05)
+        for _ in range(5):
+            uploader.mark_dirty(active)
+        await wait_transfers(uploader, 2)
+        uploader.stop()
+
+    asyncio.run(run())
+    assert [(path, server) for (_, path, server) in calls(log)] == [(active, 'Data/')] * 2
+    assert uploader.transfer_count == 2
+    assert uploader.transfer_bytes == 2 * len('{}\n')
+
+
+def test_sealed_segments_go_first(tmp_path):
+    """
+    封をしたセグメントを古い順に転送し、書き込み中のセグメントは最後にする。
+    """
+    (command, log) = stub(tmp_path, delay=0.1)
+    first = segment(tmp_path, '20240101000000_data.jsonl')
+    older = segment(tmp_path, '20240102000000_data.jsonl')
+    newer = segment(tmp_path, '20240103000000_data.jsonl')
+    active = segment(tmp_path, '20240104000000_data.jsonl')
+    uploader = UploadManager(command, 'Data', min_interval=0.0)
+
+    async def run():
+        uploader.mark_dirty(first, sealed=True)
+        await asyncio.sleep(0.05)
+        uploader.mark_dirty(active)
+        uploader.mark_dirty(newer, sealed=True)
+        uploader.mark_dirty(older, sealed=True)
+        await wait_transfers(uploader, 4)
+        uploader.stop()
+
+    asyncio.run(run())
+    assert [path for (_, path, _) in calls(log)] == [first, older, newer, active]
+
+
+def test_active_segment_waits_min_interval(tmp_path):
+    """
+    書き込み中のセグメントはmin_intervalに1回までとし、封をした場合は待たずに転送する。
+    """
+    (command, log) = stub(tmp_path)
+    active = segment(tmp_path, '20240101000000_data.jsonl')
+    uploader = UploadManager(command, 'Data', min_interval=0.5)
+
+    async def run():
+        uploader.mark_dirty(active)
+        await wait_transfers(uploader, 1)
+        uploader.mark_dirty(active)
+        await asyncio.sleep(0.1)
+        assert uploader.transfer_count == 1
+        await wait_transfers(uploader, 2)
+        uploader.mark_dirty(active, sealed=True)
+        await wait_transfers(uploader, 3)
+        uploader.stop()
+
+    asyncio.run(run())
+    times = [call_time for (call_time, _, _) in calls(log)]
+    assert len(times) == 3
+    assert times[1] - times[0] >= 0.45
+    assert times[2] - times[1] < 0.45
+
+
+def test_failed_transfer_is_retried_with_backoff(tmp_path):
+    """
+    失敗した場合は再試行し、間隔を倍にしていく。成功したら完了とする。
+    """
+    (command, log) = stub(tmp_path, failures=2)
+    sealed = segment(tmp_path, '20240101000000_data.jsonl')
+    uploader = UploadManager(command, 'Data', retry_min_time=0.1, retry_max_time=1.0)
+
+    async def run():
+        uploader.mark_dirty(sealed, sealed=True)
+        await wait_transfers(uploader, 3)
+        uploader.stop()
+
+    asyncio.run(run())
+    times = [call_time for (call_time, _, _) in calls(log)]
+    assert len(times) == 3
+    assert (uploader.failure_count, uploader.transfer_count) == (2, 1)
+    assert times[1] - times[0] >= 0.09
+    assert times[2] - times[1] >= 0.19
+
+
+def test_removed_segment_is_dropped(tmp_path):
+    """
+    保持数を超えて削除されたセグメントは転送せず、再試行もしない。
+    """
+    (command, log) = stub(tmp_path)
+    removed = segment(tmp_path, '20240101000000_data.jsonl')
+    kept = segment(tmp_path, '20240102000000_data.jsonl')
+    uploader = UploadManager(command, 'Data')
+
+    async def run():
+        uploader.mark_dirty(removed, sealed=True)
+        uploader.mark_dirty(kept, sealed=True)
+        (tmp_path / '20240101000000_data.jsonl').unlink()
+        await wait_transfers(uploader, 1)
+        uploader.stop()
+
+    asyncio.run(run())
+    assert [path for (_, path, _) in calls(log)] == [kept]
+    assert uploader.failure_count == 0
@@ -0,0 +1,168 @@
+import asyncio
+import os
+import time
+from logging import getLogger
+from metrics import REGISTRY
+
+
+class UploadManager:
+    """
+    更新されたsystem_dataのセグメントをサーバへアップロードする。
+    保存のたびに転送を起動せず、更新されたセグメントをまとめて、転送は常に1件のみ実行する。
+    封をしたセグメントを優先し、書き込み中のセグメントはmin_intervalに1回までとする。
+    失敗した場合は指数的に間隔を空けて再試行する。
+    """
+
+    def __init__(self, command, server_dir_path, min_interval=60.0, retry_min_time=2.0, retry_max_time=300.0):
+        """
+        :param command: 転送コマンドの引数のリスト。末尾にファイルのパスとサーバのディレクトリを付けて実行する。
+                        (例: ['bash', '/home/pi/App/Script/mySync.sh', '-U'])
+        :param server_dir_path: サーバのディレクトリのパス(一部)
+        :param min_interval: 書き込み中のセグメントを転送する最短の間隔(sec)
+        :param retry_min_time: 最初の再試行までの時間(sec)
+        :param retry_max_time: 再試行までの時間の上限(sec)
+        """
+        self.logger = getLogger(__name__)
+        self.command = command
+        self.server_dir_path = server_dir_path
+        self.min_interval = min_interval
+        self.retry_min_time = retry_min_time
+        self.retry_max_time = retry_max_time
+        # path: [封をしたか, 更新回数]
+        self.__dirty = {}
+        self.__dirty_event = None
+        self.__task = None
+        # 書き込み中のセグメントを最後に転送した時刻(time.monotonic)
+        self.__last_active_time = None
+        # 転送の記録
+        self.transfer_count = 0
+        self.failure_count = 0
+        self.transfer_bytes = 0
+        self.last_duration = 0.0
+        self.last_bytes = 0
+        self.__upload_seconds = REGISTRY.histogram('pvsw_upload_seconds', 'Time to upload a system_data segment.')
+        REGISTRY.counter('pvsw_uploads', 'Uploaded system_data segments.', function=lambda: self.transfer_count)
+        REGISTRY.counter('pvsw_upload_failures', 'Failed system_data uploads.', function=lambda: self.failure_count)
+        REGISTRY.counter('pvsw_upload_bytes', 'Uploaded system_data bytes.', function=lambda: self.transfer_bytes)
+        REGISTRY.gauge('pvsw_upload_pending', 'Segments waiting for upload.', function=lambda: len(self.__dirty))
+
+    def mark_dirty(self, path, sealed=False):
+        """
+        アップロードが必要なセグメントを登録する。転送中でなければ転送を開始する。
+        :param path: セグメントのパス
+        :param sealed: 封をした(以降は更新されない)セグメントか
+        """
+        entry = self.__dirty.setdefault(path, [False, 0])
+        entry[0] = entry[0] or sealed
+        entry[1] += 1
+        if self.__task is None:
+            self.__dirty_event = asyncio.Event()
+            self.__task = asyncio.create_task(self.__run())
+        self.__dirty_event.set()
+
+    def __next_path(self):
+        """
+        次に転送するセグメントを選ぶ。封をしたもの(古い順)を優先する。
+        """
+        sealed = sorted(path for path, (is_sealed, _) in self.__dirty.items() if is_sealed)
+        if len(sealed) > 0:
+            return sealed[0]
+        return min(self.__dirty)
+
+    def __active_wait(self, sealed):
+        """
+        書き込み中のセグメントを転送できるまでの時間(sec)を返す。
+        """
+        if sealed or self.__last_active_time is None:
+            return 0.0
+        return self.__last_active_time + self.min_interval - time.monotonic()
+
+    async def __run(self):
+        """
+        登録されたセグメントを順に転送する。処理中の例外では終了せず、再試行する。
+        """
+        retry_time = self.retry_min_time
+        try:
+            while True:
+                await self.__dirty_event.wait()
+                self.__dirty_event.clear()
+                while len(self.__dirty) > 0:
+                    path = self.__next_path()
+                    (sealed, version) = self.__dirty[path]
+                    wait = self.__active_wait(sealed)
+                    if wait > 0.0:
+                        # 保存のたびに転送しないよう、間隔が空くまで待つ。封をしたものが登録された場合は先に転送する。
+                        try:
+                            await asyncio.wait_for(self.__dirty_event.wait(), wait)
+                            self.__dirty_event.clear()
+                        except asyncio.TimeoutError:
+                            pass
+                        continue
+                    if not os.path.exists(path):
+                        # 保持数を超えて削除されたものは転送しない。
+                        del self.__dirty[path]
+                        continue
+                    try:
+                        success = await self.__transfer(path, sealed)
+                    except asyncio.CancelledError:
+                        raise
+                    except Exception as e:
+                        self.failure_count += 1
+                        self.logger.exception('%s', e)
+                        success = False
+                    if success:
+                        retry_time = self.retry_min_time
+                        # 転送中に更新されていなければ完了とする。
+                        if self.__dirty.get(path, [False, -1])[1] == version:
+                            del self.__dirty[path]
+                    elif os.path.exists(path):
+                        self.logger.warning(f'upload retry after {retry_time:.1f}s')
+                        await asyncio.sleep(retry_time)
+                        retry_time = min(retry_time * 2.0, self.retry_max_time)
+        finally:
+            # 終了した場合は、次のmark_dirtyで再び開始する。
+            if self.__task is asyncio.current_task():
+                self.__task = None
+
+    async def __transfer(self, path, sealed):
+        """
+        1つのセグメントを転送する。出力は読み捨て、終了を待つ。
+        :return: 成功したか
+        """
+        start = time.monotonic()
+        proc = None
+        try:
+            size = os.path.getsize(path)
+            proc = await asyncio.create_subprocess_exec(
+                *self.command, path, self.server_dir_path + '/',
+                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+            _, stderr = await proc.communicate()
+        except OSError as e:
+            self.failure_count += 1
+            self.logger.error('%s', e)
+            return False
+        except asyncio.CancelledError:
+            # 停止時は転送を中断し、プロセスを残さない。
+            if proc is not None and proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+            raise
+        if not sealed:
+            self.__last_active_time = start
+        duration = time.monotonic() - start
+        self.__upload_seconds.observe(duration)
+        if proc.returncode != 0:
+            self.failure_count += 1
+            self.logger.warning(f'upload failed({proc.returncode}): {path} {stderr.decode(errors="replace").strip()}')
+            return False
+        self.transfer_count += 1
+        self.transfer_bytes += size
+        self.last_duration = duration
+        self.last_bytes = size
+        self.logger.info(f'uploaded {path} {size} bytes in {duration:.2f}s')
+        return True
+
+    def stop(self):
+        if self.__task is not None:
+            self.__task.cancel()
+            self.__task = None